@@ -0,0 +1,88 @@
+"""
+Benchmark of the summary cleaner against the BeautifulSoup path
+
+Collects the raw <summary>/<content> HTML of real feeds and times
+text_cleaner.clean_summary() against BeautifulSoup(s, 'lxml').get_text(),
+reporting how many outputs differ.
+
+Usage
+    python benchmarks/bench_cleaner.py <feed file | directory | URL> [...] [--repeat N]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feedparser
+from bs4 import BeautifulSoup
+from text_cleaner import clean_summary
+
+
+def load_corpus(targets):
+    """ Raw summary HTML of every entry in the given feeds """
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            paths.extend(os.path.join(root, f)
+                         for root, _, files in os.walk(target) for f in sorted(files))
+        else:
+            paths.append(target)
+
+    corpus = []
+    for path in paths:
+        res = feedparser.parse(path)
+        for feed in res.entries:
+            s = feed.get('summary')
+            if s is None and feed.get('content'):
+                s = feed.content[0].value
+            if s:
+                corpus.append(s)
+    return corpus
+
+
+def bs4_clean(s):
+    return BeautifulSoup(s, 'lxml').get_text().encode('ascii', 'ignore').decode('utf-8')
+
+
+def bench(func, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for s in corpus:
+            func(s)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summary cleaner benchmark")
+    parser.add_argument('targets', nargs='+', help="Feed files, directories of feeds or URLs")
+    parser.add_argument('--repeat', type=int, default=5, help="Timing repetitions (best is kept)")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.targets)
+    if not corpus:
+        print("-->No summaries found")
+        return
+    size = sum(len(s) for s in corpus)
+    print("Corpus: {0} summaries, {1:.1f} KB".format(len(corpus), size / 1024.0))
+
+    diff = sum(1 for s in corpus if clean_summary(s) != bs4_clean(s))
+    t_bs4 = bench(bs4_clean, corpus, args.repeat)
+    t_new = bench(clean_summary, corpus, args.repeat)
+
+    print("BeautifulSoup: {0:8.1f} ms ({1:.1f} us/summary)"
+          .format(t_bs4 * 1e3, t_bs4 * 1e6 / len(corpus)))
+    print("text_cleaner:  {0:8.1f} ms ({1:.1f} us/summary)"
+          .format(t_new * 1e3, t_new * 1e6 / len(corpus)))
+    print("Speedup: {0:.1f}x, differing outputs: {1}/{2}"
+          .format(t_bs4 / t_new if t_new else float('inf'), diff, len(corpus)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Crawl benchmark against the local fake feed server
+
+Drives RSSCrawler.crawl() for a number of cycles over synthetic feeds and
+reports throughput, per-feed fetch latency, CPU time per stage and peak
+memory. Runs fully offline.
+
+Usage
+    python benchmarks/crawl_bench.py --cycles 5 --max-concurrency 32 --parse-workers 4
+    python benchmarks/crawl_bench.py --help
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rss_crawler import RSSCrawler
+from politeness import Politeness
+from storage import XMLStorage, SegmentStorage
+from fake_feed_server import FakeFeedServer, ServerConfig, add_arguments
+
+
+STAGES = ('fetch', 'parse', 'clean', 'dedup', 'persist')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_bench(server_config, cycles=3, storage='segment', max_concurrency=32, max_per_host=4,
+              parse_workers=0, queue_size=64):
+    """ Crawl the fake feeds for a number of cycles
+
+    Return
+        Dict of the measurements
+    """
+    data_path = tempfile.mkdtemp(prefix='rss_bench_')
+    try:
+        with FakeFeedServer(server_config) as server:
+            backend = SegmentStorage(data_path) if storage == 'segment' else XMLStorage(data_path)
+            # Local fake hosts: measure the crawler, not the per-host pacing
+            politeness = Politeness(rate=1000.0, burst=1000, max_rate=1000.0, robots=False)
+            crawler = RSSCrawler(data_path, storage=backend, politeness=politeness)
+            crawler.sources = dict(server.sources)
+            crawler.timer.keep_latencies = True
+            crawler.configure(max_concurrency=max_concurrency, max_per_host=max_per_host,
+                              parse_workers=parse_workers, queue_size=queue_size)
+
+            num_feeds, num_entries, wall = 0, 0, 0.0
+            cpu0 = time.process_time()
+            for cycle in range(cycles):
+                t0 = time.time()
+                num_new = crawler.crawl()
+                elapsed = time.time() - t0
+                wall += elapsed
+                num_feeds += len(crawler.sources)
+                num_entries += num_new
+                print("Cycle {0}: {1} feeds, {2} new entries in {3:.2f}s"
+                      .format(cycle + 1, len(crawler.sources), num_new, elapsed))
+            cpu = time.process_time() - cpu0
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+    latencies = crawler.timer.latencies
+    return {'cycles': cycles,
+            'feeds': num_feeds,
+            'entries': num_entries,
+            'wall': wall,
+            'cpu': cpu,
+            'feeds_per_sec': num_feeds / wall if wall else 0.0,
+            'entries_per_sec': num_entries / wall if wall else 0.0,
+            'latency_p50': percentile(latencies, 0.50),
+            'latency_p99': percentile(latencies, 0.99),
+            'stages': dict((s, crawler.timer.cpu.get(s, 0.0)) for s in STAGES),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def report(result):
+    print("\nCrawled {feeds} feeds over {cycles} cycles in {wall:.2f}s (process CPU {cpu:.2f}s)"
+          .format(**result))
+    print("Throughput:   {feeds_per_sec:.1f} feeds/s, {entries_per_sec:.1f} new entries/s"
+          .format(**result))
+    print("Fetch latency: p50 {0:.1f} ms, p99 {1:.1f} ms"
+          .format(result['latency_p50'] * 1e3, result['latency_p99'] * 1e3))
+    print("CPU by stage:")
+    for stage in STAGES:
+        print("    {0:8s} {1:8.3f}s".format(stage, result['stages'][stage]))
+    print("Peak RSS:     {:.1f} MB".format(result['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl benchmark on a local fake feed server")
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--storage', choices=['segment', 'xml'], default='segment')
+    parser.add_argument('--max-concurrency', type=int, default=32,
+                        help="Concurrent fetches (0: serial crawler)")
+    parser.add_argument('--max-per-host', type=int, default=4)
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help="Parse processes (0: parse on the fetching thread)")
+    parser.add_argument('--queue-size', type=int, default=64)
+    server_group = parser.add_argument_group('fake feed server')
+    add_arguments(server_group)
+    args = vars(parser.parse_args())
+
+    bench_args = dict((k, args.pop(k)) for k in ('cycles', 'storage', 'max_concurrency',
+                                                 'max_per_host', 'parse_workers', 'queue_size'))
+    report(run_bench(ServerConfig(**args), **bench_args))
+
+
+if __name__ == '__main__':
+    main()
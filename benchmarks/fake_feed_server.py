@@ -0,0 +1,255 @@
+"""
+Local fake feed server for crawl benchmarks
+
+Serves synthetic RSS 2.0 and Atom feeds from a set of local HTTP servers,
+one port per simulated host, with configurable latency, feed size, entry
+churn, failure rate and a fraction of slow hosts. Feeds carry ETags and
+answer conditional requests with 304, like most real feed servers.
+
+Usage
+    python benchmarks/fake_feed_server.py [--hosts N] [--feeds N] ...
+
+"""
+from __future__ import absolute_import, print_function
+import time
+import random
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from xml.sax.saxutils import escape
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+WORDS = ('market bank payment startup fintech funding round crypto lending regulator '
+         'insurance wallet mobile growth investor platform customer launch report quarter '
+         'revenue deal merger data cloud security compliance transfer').split()
+
+
+class ServerConfig(object):
+    def __init__(self, hosts=4, feeds_per_host=25, entries=30, summary_words=60, churn=0.2,
+                 new_per_update=3, latency=0.02, slow_hosts=0.25, slow_latency=0.5,
+                 failure_rate=0.02, atom_ratio=0.3, seed=1):
+        """ Shape of the simulated feed population
+
+        Arguments
+            hosts:          Number of simulated hosts (one local port each)
+            feeds_per_host: Number of feeds served by every host
+            entries:        Number of entries per feed
+            summary_words:  Length of every entry summary (words)
+            churn:          Probability that a feed has new entries on a request
+            new_per_update: Number of entries added by an update
+            latency:        Response latency of a normal host (seconds)
+            slow_hosts:     Fraction of hosts that are slow
+            slow_latency:   Response latency of a slow host (seconds)
+            failure_rate:   Probability that a request fails with a 5xx
+            atom_ratio:     Fraction of feeds served as Atom instead of RSS
+            seed:           Random seed
+        """
+        self.hosts = hosts
+        self.feeds_per_host = feeds_per_host
+        self.entries = entries
+        self.summary_words = summary_words
+        self.churn = churn
+        self.new_per_update = new_per_update
+        self.latency = latency
+        self.slow_hosts = slow_hosts
+        self.slow_latency = slow_latency
+        self.failure_rate = failure_rate
+        self.atom_ratio = atom_ratio
+        self.seed = seed
+
+
+class _Feed(object):
+    def __init__(self, name, atom, config, rng):
+        self.name = name
+        self.atom = atom
+        self.config = config
+        self.rng = rng
+        self.serial = 0
+        self.entries = []
+        self.lock = threading.Lock()
+        self._add(config.entries)
+
+    def _add(self, num):
+        for _ in range(num):
+            self.serial += 1
+            words = [self.rng.choice(WORDS) for _ in range(self.config.summary_words)]
+            title = ' '.join(words[:8]).capitalize() + ' #{}'.format(self.serial)
+            summary = '<p>{0}</p><p><a href="http://example.com/">{1}</a> &amp; more</p>'.format(
+                ' '.join(words), words[0])
+            self.entries.insert(0, (self.serial, title, summary, time.time()))
+        del self.entries[self.config.entries:]
+        self._body = None
+
+    def body(self):
+        """ Current document and its ETag, after a possible update """
+        with self.lock:
+            if self.rng.random() < self.config.churn:
+                self._add(self.config.new_per_update)
+            if self._body is None:
+                self._body = (self._render_atom() if self.atom else self._render_rss()).encode('utf-8')
+                self._etag = '"{}"'.format(hashlib.sha1(self._body).hexdigest()[:16])
+            return self._body, self._etag
+
+    def _render_rss(self):
+        items = ''.join(
+            '<item><guid>urn:{0}:{1}</guid><title>{2}</title>'
+            '<link>http://example.com/{0}/{1}</link><description>{3}</description>'
+            '<pubDate>{4}</pubDate></item>'.format(self.name, n, escape(t), escape(s),
+                                                   formatdate(ts, usegmt=True))
+            for n, t, s, ts in self.entries)
+        return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                '<title>{0}</title><link>http://example.com/{0}</link><ttl>5</ttl>{1}'
+                '</channel></rss>'.format(self.name, items))
+
+    def _render_atom(self):
+        items = ''.join(
+            '<entry><id>urn:{0}:{1}</id><title>{2}</title>'
+            '<link href="http://example.com/{0}/{1}"/><summary type="html">{3}</summary>'
+            '<published>{4}</published></entry>'.format(
+                self.name, n, escape(t), escape(s),
+                time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts)))
+            for n, t, s, ts in self.entries)
+        return ('<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                '<title>{0}</title><id>urn:{0}</id><updated>{1}</updated>{2}</feed>'
+                .format(self.name, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), items))
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _make_handler(feeds, latency, config, rng):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            feed = feeds.get(self.path)
+            if feed is None:
+                self.send_error(404)
+                return
+            if rng.random() < config.failure_rate:
+                self.send_response(503)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body, etag = feed.body()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'application/atom+xml' if feed.atom else 'application/rss+xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+
+def start_servers(config):
+    """ Start the fake hosts in background threads of the current process
+
+    Return
+        (list of servers, {feed URL: (source, category)})
+    """
+    rng = random.Random(config.seed)
+    num_slow = int(round(config.hosts * config.slow_hosts))
+    servers, sources = [], {}
+    for h in range(config.hosts):
+        feeds = {}
+        for i in range(config.feeds_per_host):
+            name = 'host{0}_feed{1}'.format(h, i)
+            feeds['/feed/{}'.format(i)] = _Feed(name, rng.random() < config.atom_ratio, config,
+                                                random.Random(rng.random()))
+        latency = config.slow_latency if h < num_slow else config.latency
+        server = _ThreadingServer(('127.0.0.1', 0),
+                                  _make_handler(feeds, latency, config, random.Random(h)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        port = server.server_address[1]
+        for i in range(config.feeds_per_host):
+            sources['http://127.0.0.1:{0}/feed/{1}'.format(port, i)] = \
+                ('host{}'.format(h), 'feed{}'.format(i))
+    return servers, sources
+
+
+def _serve(config, conn):
+    servers, sources = start_servers(config)
+    conn.send(sources)
+    # Serve until the parent closes the pipe
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+    for server in servers:
+        server.shutdown()
+
+
+class FakeFeedServer(object):
+    def __init__(self, config=None):
+        """ Fake feed hosts run in a child process, so their CPU is not charged to the crawler
+
+        Arguments
+            config: ServerConfig
+        """
+        self.config = config or ServerConfig()
+        self.sources = {}
+        self._process = None
+        self._conn = None
+
+    def start(self):
+        """ Start the hosts and return {feed URL: (source, category)} """
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(self.config, child))
+        self._process.daemon = True
+        self._process.start()
+        self.sources = self._conn.recv()
+        return self.sources
+
+    def stop(self):
+        if self._process is not None:
+            self._conn.close()
+            self._process.join(5)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_arguments(parser):
+    """ Command line options of ServerConfig """
+    defaults = ServerConfig()
+    for name in sorted(vars(defaults)):
+        value = getattr(defaults, name)
+        parser.add_argument('--' + name.replace('_', '-'), dest=name, type=type(value),
+                            default=value)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Fake feed server")
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    servers, feed_urls = start_servers(ServerConfig(**vars(args)))
+    for url in sorted(feed_urls):
+        print(url)
+    print("Serving {} feeds, Ctrl-C to stop".format(len(feed_urls)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
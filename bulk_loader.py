@@ -0,0 +1,209 @@
+"""
+Bulk loader of the archives into table 'rss_feeds'
+
+Streams every data/<source>/<category>.xml (iterparse, constant memory) or
+data/<source>/<category>/ segment directory, loads several archives in
+parallel worker processes, and writes through batched multi-row upserts on
+uid (the UNIQUE key on uid is checked, and added if the table lacks it,
+before the workers start), so re-running never duplicates rows. Each
+archive records a checkpoint after every committed batch, so an interrupted
+import resumes where it stopped, and an archive that grew since only loads
+its new entries.
+
+Usage
+    python bulk_loader.py <data path> [--workers N] [--batch-size N] [--sqlite DB]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import json
+import time
+import hashlib
+import argparse
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fsutil import atomic_write
+from storage import FIELDS, STATE_DIRS, SegmentStorage
+from db_sink import MySQLSink, SQLiteSink
+from date_normalizer import to_gmt
+
+
+MYSQL_CONFIG = {'host': 'localhost',
+                'user': 'root',
+                'password': 'yaochen',
+                'database': 'test_db_rss'}
+
+
+def find_archives(data_path):
+    """ (archive path, source, category) of every archive under data_path: the
+    <source>/<category>.xml documents and the <source>/<category>/ segment directories """
+    archives = []
+    for source in sorted(os.listdir(data_path)):
+        src_dir = os.path.join(data_path, source)
+        if not os.path.isdir(src_dir) or source in STATE_DIRS:
+            continue
+        for f in sorted(os.listdir(src_dir)):
+            path = os.path.join(src_dir, f)
+            if f.endswith('.xml'):
+                archives.append((path, source, f[:-4]))
+            elif os.path.isdir(path):
+                archives.append((path, source, f))
+    return archives
+
+
+def archive_stat(path):
+    """ (size, mtime) of an archive; those of all its segments for a segment directory """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+    stats = [os.stat(os.path.join(path, f)) for f in os.listdir(path) if '.ndjson' in f]
+    return sum(st.st_size for st in stats), max([st.st_mtime for st in stats] or [0])
+
+
+def iter_entries(archive_path):
+    """ Stream the entries of an archive, releasing each element once read """
+    if os.path.isdir(archive_path):
+        src_dir, category = os.path.split(archive_path)
+        data_path, source = os.path.split(src_dir)
+        for record in SegmentStorage(data_path).iter_records(source, category):
+            yield dict((f, record.get(f)) for f in FIELDS)
+        return
+    root = None
+    for event, elem in ET.iterparse(archive_path, events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == 'entry':
+            yield dict((f, elem.findtext(f)) for f in FIELDS)
+            # Cleared entries stay children of <data> until the root lets go of them too
+            root.clear()
+
+
+class Checkpoint(object):
+    def __init__(self, checkpoint_dir, archive_path):
+        """ Load progress of one archive
+
+        Arguments
+            checkpoint_dir: Directory of the checkpoint files
+            archive_path:   Path of the archive
+        """
+        name = hashlib.sha1(os.path.abspath(archive_path).encode('utf-8')).hexdigest() + '.json'
+        self.path = os.path.join(checkpoint_dir, name)
+        size, mtime = archive_stat(archive_path)
+        self.state = {'file': archive_path, 'size': size, 'mtime': mtime,
+                      'loaded': 0, 'complete': False}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+            if saved['size'] == size and saved['mtime'] == mtime:
+                self.state = saved
+            elif size > saved['size']:
+                # Archives only grow by entries appended at the end: load the new ones
+                self.state['loaded'] = saved['loaded']
+            # A shrunk archive was rewritten and is reloaded from the start (the upsert keeps
+            # it idempotent)
+
+    def save(self, loaded, complete=False):
+        self.state['loaded'] = loaded
+        self.state['complete'] = complete
+        with atomic_write(self.path) as f:
+            json.dump(self.state, f)
+
+
+def load_archive(archive_path, source, category, checkpoint_dir, batch_size, sqlite_path=None,
+                 mysql_config=None):
+    """ Load one archive (runs in a worker process)
+
+    Return
+        (archive path, number of entries loaded now, skipped because already loaded)
+    """
+    checkpoint = Checkpoint(checkpoint_dir, archive_path)
+    if checkpoint.state['complete']:
+        return archive_path, 0, True
+
+    if sqlite_path:
+        sink = SQLiteSink(sqlite_path, batch_size=batch_size)
+    else:
+        sink = MySQLSink(pool_size=1, batch_size=batch_size, **(mysql_config or MYSQL_CONFIG))
+
+    done = checkpoint.state['loaded']
+    loaded = 0
+    try:
+        for i, record in enumerate(iter_entries(archive_path)):
+            # Entries committed before an interruption
+            if i < done:
+                continue
+            record['gmt_date'] = to_gmt(record['published_date'], (source, category)) or ''
+            sink.write(source, category, [record])
+            loaded += 1
+            if loaded % batch_size == 0:
+                sink.flush()
+                if sink.rows:
+                    raise IOError("database unavailable")
+                checkpoint.save(done + loaded)
+        sink.flush()
+        if sink.rows:
+            raise IOError("database unavailable")
+        checkpoint.save(done + loaded, complete=True)
+    finally:
+        sink._disconnect()
+    return archive_path, loaded, False
+
+
+def bulk_load(data_path, workers=4, batch_size=1000, checkpoint_dir=None, sqlite_path=None,
+              mysql_config=None):
+    """ Load every archive under data_path
+
+    Arguments
+        data_path:      Path of data directory
+        workers:        Number of archives loaded in parallel
+        batch_size:     Rows per multi-row insert / checkpoint
+        checkpoint_dir: Directory of the checkpoints (default: <data_path>/.load_checkpoints)
+        sqlite_path:    Load into a SQLite stand-in instead of MySQL
+        mysql_config:   mysql.connector connection arguments
+    """
+    checkpoint_dir = checkpoint_dir or os.path.join(data_path, '.load_checkpoints')
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    # Once, in the parent: the workers must not race to migrate the table
+    if not sqlite_path and not MySQLSink(**(mysql_config or MYSQL_CONFIG)).ensure_unique_uid():
+        return
+    archives = find_archives(data_path)
+    print("Loading {0} archives with {1} workers".format(len(archives), workers))
+
+    time_start = time.time()
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_archive, archive_path, source, category,
+                                   checkpoint_dir, batch_size, sqlite_path, mysql_config)
+                   for archive_path, source, category in archives]
+        for future in as_completed(futures):
+            try:
+                archive_path, loaded, skipped = future.result()
+            except Exception as e:
+                print("-->Error {}".format(e))
+                continue
+            total += loaded
+            if skipped:
+                print("Already loaded:", archive_path)
+            else:
+                print("Loaded {0} entries from {1}".format(loaded, archive_path))
+
+    elapsed = time.time() - time_start
+    print("Done: {0} entries in {1:.1f}s ({2:.0f} entries/s)"
+          .format(total, elapsed, total / elapsed if elapsed else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load the archives into rss_feeds")
+    parser.add_argument('data_path', help="Path of data directory")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--checkpoint-dir', default=None)
+    parser.add_argument('--sqlite', default=None, help="Load into this SQLite database instead")
+    args = parser.parse_args()
+    bulk_load(args.data_path, workers=args.workers, batch_size=args.batch_size,
+              checkpoint_dir=args.checkpoint_dir, sqlite_path=args.sqlite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Columnar export of the archive
+
+Converts the crawled entries into Parquet (or Arrow IPC) files partitioned
+by source and day of gmt_date:
+
+    <out>/source=<source>/day=<YYYY-MM-DD>/part-<run>-<n>.parquet
+
+category is a dictionary-encoded column and gmt_date a timestamp; source
+and day come back from the partition directories (as dictionary columns)
+when the export is read with read_table(), which memory-maps the files
+(uncompressed Arrow IPC files are then read without any copy).
+
+Exports are incremental: the archives are append-only, so the position of
+the last exported entry of every feed (see the iter_from() of the storage
+backends) is kept in _export_state.json and each run seeks to it and reads
+only the entries after it; a feed whose archive did not change is not even
+opened. A run writes its files to _staging/ first and records
+the moves into the partitions in the state before making them, so that an
+interrupted run is completed (or discarded) by the next one. Partitions
+that accumulate more than max_parts files are compacted into one file the
+same way.
+
+Requires pyarrow.
+
+Usage
+    python columnar_export.py <data path> <output path> [--xml] [--format arrow]
+                              [--max-parts 16]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import json
+import shutil
+import argparse
+from itertools import islice
+from fsutil import atomic_write
+from storage import FIELDS, SegmentStorage, XMLStorage
+from date_normalizer import to_gmt
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    from pyarrow import fs as pafs
+except ImportError:
+    pa = None
+
+
+STATE_FILE = '_export_state.json'
+STAGING_DIR = '_staging'
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def _table(category, rows):
+    """ Arrow table of the entries of one feed """
+    columns = dict((field, pa.array([r[field] for r in rows], pa.string()))
+                   for field in FIELDS + ('gmt_date',))
+    # Missing dates become nulls
+    columns['gmt_date'] = pc.strptime(columns['gmt_date'], format='%Y-%m-%d %H:%M:%S',
+                                      unit='s', error_is_null=True)
+    columns['category'] = pa.array([category] * len(rows), pa.string()).dictionary_encode()
+    return pa.table(columns)
+
+
+class ColumnarExporter(object):
+    def __init__(self, storage, out_path, fmt='parquet', batch_rows=50000, max_parts=16):
+        """ Incremental exporter of an archive to partitioned columnar files
+
+        Arguments
+            storage:    Storage backend of the archive (XMLStorage or SegmentStorage)
+            out_path:   Output directory
+            fmt:        'parquet' or 'arrow' (uncompressed Arrow IPC, zero-copy reads)
+            batch_rows: Entries buffered before they are written out
+            max_parts:  Files of a partition above which it is compacted
+        """
+        if pa is None:
+            raise ImportError("Columnar export needs pyarrow")
+        assert fmt in EXTENSIONS
+
+        self.storage = storage
+        self.out_path = out_path
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.max_parts = max_parts
+        self.state_path = os.path.join(out_path, STATE_FILE)
+        self.state = {'format': fmt, 'run': 0, 'feeds': {}, 'pending': []}
+        self._staged = []
+        self._num_parts = 0
+
+    def _load(self):
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+            if self.state['format'] != self.fmt:
+                raise ValueError("{0} holds a {1} export".format(self.out_path,
+                                                                  self.state['format']))
+        self._apply()
+
+    def _save(self):
+        with atomic_write(self.state_path) as f:
+            json.dump(self.state, f)
+
+    def _apply(self):
+        """ Make the file moves / deletions recorded in the state (idempotent) """
+        for src, dst in self.state['pending']:
+            if not os.path.exists(src):
+                continue
+            if dst is None:
+                os.remove(src)
+            else:
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                os.replace(src, dst)
+        if self.state['pending']:
+            self.state['pending'] = []
+            self._save()
+        # Files staged by a run that never recorded its moves
+        shutil.rmtree(os.path.join(self.out_path, STAGING_DIR), ignore_errors=True)
+
+    def _stamp(self, source, category):
+        """ (size, mtime) of the archive of a feed, to skip unchanged feeds """
+        if isinstance(self.storage, XMLStorage):
+            paths = [os.path.join(self.storage.root_path, source, category + '.xml')]
+        else:
+            seg_dir = os.path.join(self.storage.root_path, source, category)
+            paths = [os.path.join(seg_dir, f) for f in os.listdir(seg_dir)]
+        stats = [os.stat(p) for p in paths if os.path.isfile(p)]
+        return [sum(s.st_size for s in stats), max([s.st_mtime for s in stats] or [0])]
+
+    def _part_path(self, source, day):
+        name = 'part-{0:06d}-{1:06d}{2}'.format(self.state['run'], self._num_parts,
+                                                 EXTENSIONS[self.fmt])
+        self._num_parts += 1
+        return os.path.join('source=' + source, 'day=' + day, name)
+
+    def _write(self, table, rel_path):
+        """ Write a table to the staging area and remember where it goes """
+        path = os.path.join(self.out_path, STAGING_DIR, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if self.fmt == 'parquet':
+            pq.write_table(table, path)
+        else:
+            feather.write_feather(table, path, compression='uncompressed')
+        self._staged.append([path, os.path.join(self.out_path, rel_path)])
+
+    def _flush(self, source, category, days):
+        for day in sorted(days):
+            self._write(_table(category, days[day]), self._part_path(source, day))
+        days.clear()
+
+    def export(self):
+        """ Export the entries added since the last run
+
+        Return
+            Number of entries exported
+        """
+        self._load()
+        self.state['run'] += 1
+        self._staged, self._num_parts = [], 0
+        feeds = self.state['feeds']
+        total = 0
+        for source, category in self.storage.feeds():
+            key = '{0}/{1}'.format(source, category)
+            done = feeds.get(key, {'count': 0, 'stamp': None})
+            stamp = self._stamp(source, category)
+            if stamp == done['stamp']:
+                continue
+
+            num, buffered, days = 0, 0, {}
+            position = done.get('position')
+            if position is None and done['count']:
+                # State of an export that did not keep positions: skip to it once
+                records = islice(self.storage.iter_from(source, category), done['count'], None)
+            else:
+                records = self.storage.iter_from(source, category, position)
+            for record, position in records:
+                row = dict((f, record.get(f)) for f in FIELDS)
+                # XML archives do not keep gmt_date
+                row['gmt_date'] = record.get('gmt_date') or \
+                    to_gmt(row['published_date'], (source, category)) or ''
+                days.setdefault(row['gmt_date'][:10] or 'unknown', []).append(row)
+                num += 1
+                buffered += 1
+                if buffered >= self.batch_rows:
+                    self._flush(source, category, days)
+                    buffered = 0
+            self._flush(source, category, days)
+            feeds[key] = {'count': done['count'] + num, 'stamp': stamp, 'position': position}
+            if num:
+                print("Exported {0} entries of {1} ({2})".format(num, source, category))
+            total += num
+        # The counts and the moves of the staged files are committed together
+        self.state['pending'] = self._staged
+        self._save()
+        self._apply()
+        self.compact()
+        return total
+
+    def compact(self):
+        """ Rewrite every partition holding more than max_parts files as one file """
+        for root, dirs, files in os.walk(self.out_path):
+            dirs[:] = [d for d in dirs if not d.startswith(('_', '.'))]
+            parts = sorted(os.path.join(root, f) for f in files
+                           if f.endswith(EXTENSIONS[self.fmt]) and not f.startswith(('_', '.')))
+            if len(parts) <= self.max_parts:
+                continue
+            if self.fmt == 'parquet':
+                tables = [pq.read_table(p) for p in parts]
+            else:
+                tables = [feather.read_table(p) for p in parts]
+            table = pa.concat_tables(tables).unify_dictionaries().combine_chunks()
+            self._staged = []
+            rel_dir = os.path.relpath(root, self.out_path)
+            name = 'part-{0:06d}-compact{1}'.format(self.state['run'], EXTENSIONS[self.fmt])
+            self._write(table, os.path.join(rel_dir, name))
+            self.state['pending'] = self._staged + [[p, None] for p in parts]
+            self._save()
+            self._apply()
+            print("Compacted {0} files of {1}".format(len(parts), rel_dir))
+
+
+def read_table(out_path, fmt='parquet', columns=None, filter=None):
+    """ Read an export as one Arrow table (memory-mapped)
+
+    Arguments
+        out_path: Output directory of the export
+        fmt:      'parquet' or 'arrow'
+        columns:  Columns to read (default: all, with source and day)
+        filter:   pyarrow.dataset expression, e.g. ds.field('source') == 'reuters_us'
+
+    Return
+        pyarrow.Table
+    """
+    if pa is None:
+        raise ImportError("Reading a columnar export needs pyarrow")
+    dataset = ds.dataset(out_path, format='ipc' if fmt == 'arrow' else 'parquet',
+                         partitioning=ds.HivePartitioning.discover(infer_dictionary=True),
+                         filesystem=pafs.LocalFileSystem(use_mmap=True))
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the archive to partitioned columnar "
+                                                 "files")
+    parser.add_argument('data_path')
+    parser.add_argument('out_path')
+    parser.add_argument('--xml', action='store_true', help="XML archives, not segments")
+    parser.add_argument('--format', choices=sorted(EXTENSIONS), default='parquet')
+    parser.add_argument('--batch-rows', type=int, default=50000)
+    parser.add_argument('--max-parts', type=int, default=16)
+    args = parser.parse_args()
+
+    if pa is None:
+        print("-->Columnar export needs pyarrow (pip install pyarrow)")
+        sys.exit(1)
+    storage = XMLStorage(args.data_path) if args.xml else SegmentStorage(args.data_path)
+    exporter = ColumnarExporter(storage, args.out_path, fmt=args.format,
+                                batch_rows=args.batch_rows, max_parts=args.max_parts)
+    print("Exported {} entries".format(exporter.export()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Publication date normalization
+
+Feed dates come in a handful of shapes, nearly all RFC-822 (RSS) or
+ISO-8601 (Atom). Those are matched by precompiled patterns and converted
+with integer arithmetic; the format that parsed the last date of a
+(source, category) is tried first for its next date, and dateutil is only
+used for dates neither pattern matches.
+
+"""
+from __future__ import absolute_import, print_function
+import re
+import time
+import calendar
+from email.utils import formatdate
+from dateutil.parser import parse
+from dateutil import tz
+
+
+# UTC/GMT conversion
+to_zone = tz.tzutc()
+
+GMT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+          'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+
+# RFC-822 zone names, offsets in minutes
+ZONES = {'UT': 0, 'UTC': 0, 'GMT': 0, 'Z': 0,
+         'EST': -300, 'EDT': -240, 'CST': -360, 'CDT': -300,
+         'MST': -420, 'MDT': -360, 'PST': -480, 'PDT': -420}
+
+# [Mon, ]05 Oct 2026 10:00[:00] +0200|GMT
+RFC822 = re.compile(r'^\s*(?:[A-Za-z]{3,9},?\s+)?(\d{1,2})\s+([A-Za-z]{3})[a-z]*\.?\s+(\d{2,4})'
+                    r'\s+(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?\s*([+-]\d{4}|[A-Za-z]{1,5})?\s*$')
+
+# 2026-10-05T10:00[:00[.123]][Z|+02:00]
+ISO8601 = re.compile(r'^\s*(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,]\d+)?)?)?'
+                     r'\s*(Z|[+-]\d{2}(?::?\d{2})?)?\s*$')
+
+
+def _epoch(year, month, day, hour, minute, second, offset):
+    # timegm() silently rolls an impossible date (Feb 30) over into the next month
+    if not (1 <= year <= 9999 and 1 <= month <= 12 and hour < 24 and minute < 60 and second <= 60):
+        return None
+    if not 1 <= day <= calendar.monthrange(year, month)[1]:
+        return None
+    return calendar.timegm((year, month, day, hour, minute, second)) - offset * 60
+
+
+def parse_rfc822(value):
+    """ Epoch seconds of an RFC-822 date (None if it is not one) """
+    m = RFC822.match(value)
+    if m is None:
+        return None
+    day, mon, year, hour, minute, second, zone = m.groups()
+    month = MONTHS.get(mon.lower())
+    if month is None:
+        return None
+    year = int(year)
+    if year < 100:
+        year += 2000 if year < 50 else 1900
+    if not zone:
+        offset = 0
+    elif zone[0] in '+-':
+        offset = int(zone[1:3]) * 60 + int(zone[3:5])
+        offset = -offset if zone[0] == '-' else offset
+    else:
+        offset = ZONES.get(zone.upper())
+        if offset is None:
+            return None
+    return _epoch(year, month, int(day), int(hour), int(minute), int(second or 0), offset)
+
+
+def parse_iso8601(value):
+    """ Epoch seconds of an ISO-8601 date (None if it is not one) """
+    m = ISO8601.match(value)
+    if m is None:
+        return None
+    year, month, day, hour, minute, second, zone = m.groups()
+    offset = 0
+    if zone and zone != 'Z':
+        digits = zone[1:].replace(':', '')
+        offset = int(digits[:2]) * 60 + int(digits[2:4] or 0)
+        offset = -offset if zone[0] == '-' else offset
+    return _epoch(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                  int(second or 0), offset)
+
+
+def parse_any(value):
+    """ Epoch seconds of a date in any format dateutil understands (None if it cannot) """
+    try:
+        dt = parse(value)
+    except (ValueError, OverflowError, TypeError):
+        return None
+    # Naive dates are taken as GMT
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=to_zone)
+    return calendar.timegm(dt.astimezone(to_zone).timetuple())
+
+
+class DateNormalizer(object):
+    # Fast paths, in the order tried on a date whose key has no known format
+    parsers = (('rfc822', parse_rfc822), ('iso8601', parse_iso8601))
+
+    def __init__(self):
+        """ Date parser caching the winning format of every (source, category) """
+        self.formats = {}
+        self.misses = 0
+        self._by_name = dict(self.parsers)
+
+    def to_epoch(self, value, key=None):
+        """ Epoch seconds of a date
+
+        Arguments
+            value: Date string
+            key:   Cache key of the date's origin, e.g. (source, category)
+
+        Return
+            Epoch seconds (None if the date cannot be parsed)
+        """
+        if not value:
+            return None
+        name = self.formats.get(key)
+        if name is not None:
+            epoch = self._by_name[name](value)
+            if epoch is not None:
+                return epoch
+        for other, parser in self.parsers:
+            if other != name:
+                epoch = parser(value)
+                if epoch is not None:
+                    self.formats[key] = other
+                    return epoch
+        self.misses += 1
+        return parse_any(value)
+
+    def to_gmt(self, value, key=None):
+        """ '%Y-%m-%d %H:%M:%S' GMT of a date (None if it cannot be parsed) """
+        epoch = self.to_epoch(value, key)
+        if epoch is None:
+            return None
+        return time.strftime(GMT_FORMAT, time.gmtime(epoch))
+
+
+# Shared by the module-level helpers (one cache per process)
+_normalizer = DateNormalizer()
+
+
+def to_gmt(value, key=None):
+    """ '%Y-%m-%d %H:%M:%S' GMT of a date with the shared normalizer """
+    return _normalizer.to_gmt(value, key)
+
+
+def now_rfc822():
+    """ Current time as an RFC-822 date, for entries without any date """
+    return formatdate(usegmt=True)
+
+
+def _feedparser_handler(value):
+    # Misses are left to feedparser's own handlers
+    epoch = parse_rfc822(value)
+    if epoch is None:
+        epoch = parse_iso8601(value)
+    return time.gmtime(epoch) if epoch is not None else None
+
+
+def register_feedparser(feedparser):
+    """ Let feedparser try the fast paths before its own date handlers """
+    feedparser.registerDateHandler(_feedparser_handler)
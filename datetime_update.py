@@ -1,58 +1,123 @@
-from dateutil.parser import parse
-from dateutil import tz
+"""
+Backfill the missing gmt_date of rss_feeds (rss) or fin_tech (twitter)
+
+Rows are read in keyset-paginated chunks (WHERE key > last ORDER BY key
+LIMIT n), their dates parsed by the date normalizer (which remembers the
+format of every source and category), and each chunk is applied with one
+joined UPDATE from a temporary table. The last key of every committed chunk is
+saved, so an interrupted backfill resumes where it stopped.
+
+Usage
+    python datetime_update.py rss|twitter [--chunk-size N] [--restart]
+
+"""
+from __future__ import absolute_import, print_function
+import os
 import sys
+import json
+import time
+import argparse
 import mysql.connector as mdb
+from fsutil import atomic_write
+from date_normalizer import DateNormalizer
 
 
-name = ''
-try:
-    name = sys.argv[1]
-except Exception as e:
-    print("Missing argument...")
-    sys.exit()
-
-print("Connecting to database...")
-cnx = mdb.connect(host='localhost',
-                  user='root',
-                  password='yaochen',
-                  database='test_db_{}'.format(name))
-cur = cnx.cursor()
-
-# UTC/GMT conversion
-to_zone = tz.tzutc()
-
-query = ''
-if name == 'rss':
-    query = "SELECT id, published_date FROM rss_feeds AND gmt_date IS NULL"
-elif name == 'twitter':
-    query = "SELECT tweetid, timestamp FROM fin_tech WHERE checked = 1 and validated = 1 AND gmt_date IS NULL"
-
-try:
-    cur.execute(query)
-except Exception as e:
-    print("Error: {}".format(e.args[1]))
-
-rows = cur.fetchall()
-print("Total # fetch results:", len(rows))
-if not rows:
-    print("No results fetched...")
-    sys.exit()
-
-gmt_dt = ''
-for row in rows:
-    if name == 'rss':
-        gmt_dt = str(parse(row[1]).astimezone(to_zone)).split('+')[0]
-        query = "UPDATE rss_feeds SET gmt_date = STR_TO_DATE(%s, '%Y-%m-%d %T') WHERE id = %s;"
-    elif name == 'twitter':
-        gmt_dt = row[1]
-        query = "UPDATE fin_tech SET gmt_date = STR_TO_DATE(%s, '%Y-%m-%d %T') WHERE tweetid = %s;"
-    try:
-        cur.execute(query, (gmt_dt, row[0]))
+# (table, key column, date column, format cache key columns, extra condition) by mode
+TABLES = {'rss': ('rss_feeds', 'id', 'published_date', 'source, category', ''),
+          'twitter': ('fin_tech', 'tweetid', 'timestamp', 'NULL',
+                      'AND checked = 1 AND validated = 1')}
+
+
+def backfill(cnx, name, chunk_size=5000, state_path=None, restart=False):
+    """ Fill gmt_date of the rows missing it
+
+    Arguments
+        cnx:        MySQL connection
+        name:       'rss' or 'twitter'
+        chunk_size: Number of rows read and updated per transaction
+        state_path: JSON file holding the last committed key (resume point)
+        restart:    Ignore the saved resume point
+
+    Return
+        (number of rows updated, number of rows whose date could not be parsed)
+    """
+    table, key, column, origin, condition = TABLES[name]
+    last = None
+    if state_path and os.path.isfile(state_path) and not restart:
+        with open(state_path, 'r') as f:
+            last = json.load(f).get('last')
+        print("Resuming after {0} = {1}".format(key, last))
+
+    select = ("SELECT {0}, {1}, {2} FROM {3} WHERE gmt_date IS NULL {4} {{}} ORDER BY {0} LIMIT %s"
+              .format(key, column, origin, table, condition))
+    cur = cnx.cursor()
+    cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS gmt_fix (PRIMARY KEY (id))"
+                " SELECT {0} AS id, gmt_date FROM {1} LIMIT 0".format(key, table))
+    insert = "INSERT INTO gmt_fix (id, gmt_date) VALUES (%s, STR_TO_DATE(%s, '%Y-%m-%d %T'))"
+    update = ("UPDATE {0} t JOIN gmt_fix f ON t.{1} = f.id SET t.gmt_date = f.gmt_date"
+              .format(table, key))
+
+    normalizer = DateNormalizer()
+    updated = failed = 0
+    time_start = time.time()
+    while True:
+        if last is None:
+            cur.execute(select.format(''), (chunk_size,))
+        else:
+            cur.execute(select.format('AND {} > %s'.format(key)), (last, chunk_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+
+        fixes = []
+        for row in rows:
+            row_key, value = row[:2]
+            # Twitter timestamps are stored in GMT already
+            gmt_dt = value if name == 'twitter' else normalizer.to_gmt(value, row[2:])
+            if gmt_dt:
+                fixes.append((row_key, gmt_dt))
+            else:
+                failed += 1
+        if fixes:
+            cur.executemany(insert, fixes)
+            cur.execute(update)
+            cur.execute("DELETE FROM gmt_fix")
         cnx.commit()
-    except Exception as e:
-        print("Error: {}".format(e.args[1]))
-        # pass
-    sys.stdout.write("\rProcess at: {:.1%}".format(rows.index(row) / len(rows)))
-    sys.stdout.flush()
+        updated += len(fixes)
+
+        if state_path:
+            with atomic_write(state_path) as f:
+                json.dump({'last': last}, f)
+        elapsed = time.time() - time_start
+        sys.stdout.write("\rUpdated {0} rows ({1} unparsable), {2:.0f} rows/s"
+                         .format(updated, failed, updated / elapsed if elapsed else 0))
+        sys.stdout.flush()
 
-print("\nDone...")
\ No newline at end of file
+    cur.execute("DROP TEMPORARY TABLE IF EXISTS gmt_fix")
+    cur.close()
+    # Finished: the next backfill starts from the beginning
+    if state_path and os.path.isfile(state_path):
+        os.remove(state_path)
+    print()
+    return updated, failed
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Backfill gmt_date")
+    arg_parser.add_argument('name', choices=sorted(TABLES))
+    arg_parser.add_argument('--chunk-size', type=int, default=5000)
+    arg_parser.add_argument('--restart', action='store_true', help="Ignore the saved resume point")
+    args = arg_parser.parse_args()
+
+    print("Connecting to database...")
+    cnx = mdb.connect(host='localhost',
+                      user='root',
+                      password='yaochen',
+                      database='test_db_{}'.format(args.name))
+    try:
+        backfill(cnx, args.name, chunk_size=args.chunk_size,
+                 state_path='.gmt_backfill_{}.json'.format(args.name), restart=args.restart)
+    finally:
+        cnx.close()
+    print("Done...")
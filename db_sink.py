@@ -0,0 +1,215 @@
+"""
+Buffered database writers for crawled entries
+
+Rows are buffered and written with executemany() in a single transaction
+per flush instead of one INSERT and COMMIT per entry. The connection is
+kept open across flushes and re-established (a bounded number of times)
+when it drops.
+
+"""
+from __future__ import absolute_import, print_function
+import time
+import sqlite3
+
+
+COLUMNS = ('uid', 'title', 'link', 'summary', 'published_date', 'gmt_date', 'source', 'category')
+
+
+class DBSink(object):
+    # Subclasses provide the INSERT statement and the connection errors worth retrying
+    query = None
+    retry_errors = ()
+
+    def __init__(self, connect, batch_size=500, max_retries=3, retry_delay=1.0):
+        """ Buffered writer of entries into table 'rss_feeds'
+
+        Arguments
+            connect:     Callable returning a DB-API connection
+            batch_size:  Number of buffered rows that triggers a flush
+            max_retries: Number of reconnect attempts per flush
+            retry_delay: Initial delay (seconds) between reconnect attempts, doubled each time
+        """
+        self.connect = connect
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.cnx = None
+        self.rows = []
+
+    def write(self, source, category, records):
+        """ Buffer the records of a feed, flushing once the batch is full
+
+        Arguments
+            source:   Source name
+            category: Category name
+            records:  List of entry dicts
+        """
+        for r in records:
+            self.rows.append((r['uid'], r['title'], r['link'], r['summary'],
+                              r['published_date'], r['gmt_date'], source, category))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered rows in one transaction
+
+        Return
+            Number of rows written
+        """
+        if not self.rows:
+            return 0
+        rows, self.rows = self.rows, []
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.cnx is None:
+                    self.cnx = self.connect()
+                return self._write(rows)
+            except self.retry_errors as e:
+                self._disconnect()
+                if attempt == self.max_retries:
+                    print("-->Database unavailable ({}), keep {} rows for the next flush"
+                          .format(e, len(rows)))
+                    self.rows = rows + self.rows
+                    return 0
+                print("-->Database error ({}), reconnecting in {:.0f}s".format(e, delay))
+                time.sleep(delay)
+                delay *= 2
+            except Exception:
+                # Not a connection problem: keep the rows and give the connection back
+                self._disconnect()
+                self.rows = rows + self.rows
+                raise
+
+    def _write(self, rows):
+        cursor = self.cnx.cursor()
+        try:
+            cursor.executemany(self.query, rows)
+            self.cnx.commit()
+            return len(rows)
+        except self.retry_errors:
+            raise
+        except Exception as e:
+            # A bad row fails the whole batch, write row by row to isolate it
+            self.cnx.rollback()
+            print("-->Batch insert failed ({}), insert row by row".format(e))
+            num = 0
+            for row in rows:
+                try:
+                    cursor.execute(self.query, row)
+                    num += 1
+                except self.retry_errors:
+                    raise
+                except Exception as e:
+                    print("-->Error {} at UID: {}".format(e, row[0]))
+            self.cnx.commit()
+            return num
+        finally:
+            cursor.close()
+
+    def _disconnect(self):
+        if self.cnx is not None:
+            try:
+                self.cnx.close()
+            except Exception:
+                pass
+            self.cnx = None
+
+    def close(self):
+        """ Flush the remaining rows and release the connection """
+        self.flush()
+        self._disconnect()
+
+
+class MySQLSink(DBSink):
+    # Re-inserting a known UID is a no-op given the UNIQUE key on uid (see ensure_unique_uid)
+    query = ("INSERT INTO rss_feeds"
+             " (uid, title, link, summary, published_date, gmt_date, source, category)"
+             " VALUES (%s, %s, %s, %s, %s, STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s)"
+             " ON DUPLICATE KEY UPDATE uid = uid")
+
+    def __init__(self, pool_size=2, batch_size=500, max_retries=3, retry_delay=1.0, **config):
+        """ Buffered writer into MySQL through a connection pool
+
+        Arguments
+            pool_size:   Number of pooled connections
+            batch_size:  Number of buffered rows that triggers a flush
+            max_retries: Number of reconnect attempts per flush
+            retry_delay: Initial delay (seconds) between reconnect attempts
+            config:      mysql.connector connection arguments
+        """
+        import mysql.connector as mdb
+        from mysql.connector import pooling
+
+        self.retry_errors = (mdb.errors.OperationalError, mdb.errors.InterfaceError)
+        self._mdb = mdb
+        self._pooling = pooling
+        self._pool = None
+        self.pool_size = pool_size
+        self.config = config
+        super(MySQLSink, self).__init__(self._get_connection, batch_size=batch_size,
+                                        max_retries=max_retries, retry_delay=retry_delay)
+
+    def _get_connection(self):
+        # The pool is created lazily so a database outage at startup is retried like any other
+        if self._pool is None:
+            self._pool = self._pooling.MySQLConnectionPool(pool_name='rss_crawler',
+                                                           pool_size=self.pool_size,
+                                                           **self.config)
+        return self._pool.get_connection()
+
+    def ensure_unique_uid(self):
+        """ Check that rss_feeds has the UNIQUE key on uid the upsert relies on, and add it
+        if it is missing (a one-time migration: run it once, before any writer starts)
+
+        Return
+            False if the key is missing and could not be added (e.g. duplicate uids)
+        """
+        # A connection of its own: the pool may not exist yet, or belong to another process
+        cnx = self._mdb.connect(**self.config)
+        cursor = cnx.cursor()
+        try:
+            cursor.execute("SHOW INDEX FROM rss_feeds WHERE Column_name = 'uid' AND Non_unique = 0")
+            if cursor.fetchall():
+                return True
+            print("-->No UNIQUE key on rss_feeds.uid, adding it")
+            try:
+                cursor.execute("ALTER TABLE rss_feeds ADD UNIQUE KEY uid_unique (uid)")
+            except Exception as e:
+                print("-->Cannot add the UNIQUE key on rss_feeds.uid ({}): remove the duplicate "
+                      "uids (or give uid a VARCHAR type) first".format(e))
+                return False
+            return True
+        finally:
+            cursor.close()
+            cnx.close()
+
+
+class SQLiteSink(DBSink):
+    query = ("INSERT OR IGNORE INTO rss_feeds"
+             " (uid, title, link, summary, published_date, gmt_date, source, category)"
+             " VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    retry_errors = (sqlite3.OperationalError,)
+    schema = ("CREATE TABLE IF NOT EXISTS rss_feeds ("
+              " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+              " uid TEXT UNIQUE, title TEXT, link TEXT, summary TEXT,"
+              " published_date TEXT, gmt_date TEXT, source TEXT, category TEXT)")
+
+    def __init__(self, db_path, batch_size=500, max_retries=3, retry_delay=1.0):
+        """ Buffered writer into a SQLite stand-in of the rss_feeds table
+
+        Arguments
+            db_path:     Path of the SQLite database (':memory:' for a throwaway one)
+            batch_size:  Number of buffered rows that triggers a flush
+            max_retries: Number of reconnect attempts per flush
+            retry_delay: Initial delay (seconds) between reconnect attempts
+        """
+        self.db_path = db_path
+        super(SQLiteSink, self).__init__(self._get_connection, batch_size=batch_size,
+                                         max_retries=max_retries, retry_delay=retry_delay)
+
+    def _get_connection(self):
+        cnx = sqlite3.connect(self.db_path)
+        cnx.execute(self.schema)
+        return cnx
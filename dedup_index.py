@@ -0,0 +1,141 @@
+"""
+Dedup index of crawled entries
+
+Keeps the UIDs and titles already stored for every (source, category) as
+64-bit hashes in memory, so the crawler can tell whether an entry is new
+without reading the XML archive. The index is checkpointed to a compact
+binary file and loaded once at startup.
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import struct
+import hashlib
+from array import array
+from fsutil import atomic_write
+
+
+MAGIC = b'RSSDEDUP1\n'
+_KEY = struct.Struct('<HHQQ')
+
+
+def key_hash(text):
+    """ 64-bit hash of a UID or title """
+    return struct.unpack('<Q', hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest())[0]
+
+
+def _pack(values):
+    arr = array('Q', sorted(values))
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(raw):
+    arr = array('Q')
+    arr.frombytes(raw)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return set(arr)
+
+
+class DedupIndex(object):
+    def __init__(self, path):
+        """ Seen UIDs and titles per (source, category)
+
+        Arguments
+            path: Path of the index checkpoint file
+        """
+        self.path = path
+        self.feeds = {}
+        self.dirty = False
+
+    def load(self):
+        """ Load the index checkpoint if there is one """
+        self.feeds = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    print("-->Invalid dedup index {}, ignore".format(self.path))
+                    return self
+                while True:
+                    header = f.read(_KEY.size)
+                    if not header:
+                        break
+                    len_src, len_cat, num_uid, num_title = _KEY.unpack(header)
+                    source = f.read(len_src).decode('utf-8')
+                    category = f.read(len_cat).decode('utf-8')
+                    uids = _unpack(f.read(num_uid * 8))
+                    titles = _unpack(f.read(num_title * 8))
+                    self.feeds[(source, category)] = (uids, titles)
+            print("Loaded dedup index of {} feeds".format(len(self.feeds)))
+        self.dirty = False
+        return self
+
+    def save(self):
+        """ Checkpoint the index if anything changed """
+        if not self.dirty:
+            return
+        with atomic_write(self.path, 'wb') as f:
+            f.write(MAGIC)
+            for (source, category), (uids, titles) in self.feeds.items():
+                src = source.encode('utf-8')
+                cat = category.encode('utf-8')
+                f.write(_KEY.pack(len(src), len(cat), len(uids), len(titles)))
+                f.write(src)
+                f.write(cat)
+                f.write(_pack(uids))
+                f.write(_pack(titles))
+        self.dirty = False
+
+    def has(self, source, category):
+        """ Whether the index already covers a feed """
+        return (source, category) in self.feeds
+
+    def reset(self, source, category):
+        """ Start an empty index for a feed """
+        self.feeds[(source, category)] = (set(), set())
+        self.dirty = True
+
+    def seed(self, source, category, records):
+        """ Build the index of a feed from its stored entries (one-off migration)
+
+        Arguments
+            source:   Source name
+            category: Category name
+            records:  Iterable of stored entry dicts
+        """
+        uids, titles = set(), set()
+        for record in records:
+            if record.get('uid'):
+                uids.add(key_hash(record['uid']))
+            if record.get('title'):
+                titles.add(key_hash(record['title']))
+        self.feeds[(source, category)] = (uids, titles)
+        self.dirty = True
+
+    def seen(self, source, category, uid, title):
+        """ Whether an entry with the same UID or title was already stored """
+        uids, titles = self.feeds.get((source, category), ((), ()))
+        return (bool(uid) and key_hash(uid) in uids) or (bool(title) and key_hash(title) in titles)
+
+    def add(self, source, category, uid, title):
+        """ Mark an entry as stored
+
+        Return
+            (UID hash, title hash), None for an empty UID / title
+        """
+        uid_hash = key_hash(uid) if uid else None
+        title_hash = key_hash(title) if title else None
+        self.add_hashes(source, category, [uid_hash] if uid else [], [title_hash] if title else [])
+        return uid_hash, title_hash
+
+    def add_hashes(self, source, category, uid_hashes, title_hashes):
+        """ Mark entries as stored by their hashes (journal replay) """
+        if (source, category) not in self.feeds:
+            self.reset(source, category)
+        uids, titles = self.feeds[(source, category)]
+        uids.update(uid_hashes)
+        titles.update(title_hashes)
+        self.dirty = True
@@ -0,0 +1,183 @@
+"""
+Feed URL discovery
+
+Scrapes the RSS index pages of the target sites concurrently with per-site
+rules made of precompiled CSS selectors, keeps a JSON index of every feed
+URL with the time it was first and last seen, and refreshes feed_url.csv
+incrementally: only sites whose discovery is older than a given age are
+re-scraped, and their feeds are diffed against the registry.
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import csv
+import json
+import time
+import soupsieve
+from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from fsutil import atomic_write
+from http_client import HTTPClient
+
+
+class SiteRule(object):
+    def __init__(self, group, item, group_slice=(0, 1), has_string=None, table=False):
+        """ How to find the feed links on the RSS index page of a site
+
+        Arguments
+            group:       CSS selector of the blocks holding the feed links
+            item:        CSS selector of a feed link (or table row) inside a block
+            group_slice: (start, stop) of the matched blocks to use
+            has_string:  True/False: keep only links whose text is / is not a single string
+            table:       Items are <tr> rows of (category, link) cells
+        """
+        self.group = soupsieve.compile(group)
+        self.item = soupsieve.compile(item)
+        self.group_slice = group_slice
+        self.has_string = has_string
+        self.table = table
+
+    def extract(self, soup):
+        """ Feed links of a parsed index page as {url: category} """
+        links = {}
+        start, stop = self.group_slice
+        for gp in self.group.select(soup, limit=stop)[start:]:
+            tags = self.item.select(gp)
+            if not tags:
+                print("-->No target tag found!")
+            for t in tags:
+                if self.table:
+                    td = t.find_all('td', limit=2)
+                    anchor = td[1].find('a') if len(td) > 1 else None
+                    if anchor is None or not anchor.get('href'):
+                        continue
+                    category = td[0].get_text()
+                    link = anchor.get('href')
+                else:
+                    if self.has_string is not None and (t.string is not None) != self.has_string:
+                        continue
+                    s = t.get_text().replace('\n', '').replace('/', '')
+                    category = s.replace("'", '').replace('"', '').strip()
+                    link = t.get('href')
+                links[link] = category
+        return links
+
+
+# Rules by site; 'reuters_us', 'reuters_uk', ... use the 'reuters' rule
+SITE_RULES = {'reuters': SiteRule('div.module', 'a[href]:not([class])',
+                                  group_slice=(1, 3), has_string=True),
+              'associated_press': SiteRule('div.rssmTblFrm', 'a[href][class]', has_string=True),
+              'nytimes': SiteRule('div[class="columnGroup doubleRule"]', 'a[href]:not([class])',
+                                  has_string=False),
+              'finextra': SiteRule('table', 'tr', table=True)}
+
+
+def rule_for(site):
+    """ Scraping rule of a site """
+    if site in SITE_RULES:
+        return SITE_RULES[site]
+    return SITE_RULES.get(site.split('_')[0])
+
+
+class FeedDiscovery(object):
+    def __init__(self, targets, csv_path, max_workers=8, fetch=None):
+        """ Discover the feed URLs of the target sites
+
+        Arguments
+            targets:     {site: RSS index page URL}
+            csv_path:    Path of the feed URL registry (feed_url.csv)
+            max_workers: Number of index pages fetched concurrently
+            fetch:       Callable url -> response (default: a new HTTPClient's get)
+        """
+        self.targets = targets
+        self.csv_path = csv_path
+        self.index_path = os.path.join(os.path.dirname(csv_path), 'discovery.json')
+        self.max_workers = max_workers
+        self.fetch = fetch or HTTPClient(pool_maxsize=max_workers).get
+
+        self.index = {'sites': {}, 'feeds': {}}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+    def scrape(self, site):
+        """ Feed links of one site as {url: category} (None if the page is unavailable) """
+        rule = rule_for(site)
+        if rule is None:
+            print("-->No discovery rule for {}".format(site))
+            return None
+        try:
+            res = self.fetch(self.targets[site])
+            assert res.status_code == 200
+        except Exception:
+            print("Cannot connect to {}, try again later".format(self.targets[site]))
+            return None
+        return rule.extract(BeautifulSoup(res.content, 'lxml'))
+
+    def stale_sites(self, max_age):
+        """ Sites never discovered or discovered more than max_age seconds ago """
+        now = time.time()
+        return [site for site in self.targets
+                if now - self.index['sites'].get(site, {}).get('fetched', 0) >= max_age]
+
+    def refresh(self, max_age=0, seeds=None):
+        """ Re-discover the stale sites and update feed_url.csv with the difference
+
+        Arguments
+            max_age: Re-scrape sites discovered more than max_age seconds ago (0: all)
+            seeds:   {url: (source, category)} feeds to keep in the registry regardless
+
+        Return
+            (registry {url: (source, category)}, added URLs, removed URLs)
+        """
+        registry = self.read_csv()
+        for url in seeds or {}:
+            registry.setdefault(url, seeds[url])
+
+        sites = self.stale_sites(max_age)
+        added, removed = [], []
+        if sites or not os.path.isfile(self.csv_path):
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = dict(zip(sites, executor.map(self.scrape, sites)))
+
+            now = time.time()
+            for site in sites:
+                links = results[site]
+                # Keep the previous feeds of a site that could not be scraped
+                if links is None:
+                    continue
+                self.index['sites'][site] = {'fetched': now, 'feeds': len(links)}
+                for url in [u for u in registry if registry[u][0] == site and u not in links]:
+                    del registry[url]
+                    removed.append(url)
+                for url, category in links.items():
+                    if url not in registry:
+                        added.append(url)
+                    registry[url] = (site, category)
+                    feed = self.index['feeds'].setdefault(url, {'first_seen': now})
+                    feed.update({'source': site, 'category': category, 'last_seen': now})
+
+            self.write_csv(registry)
+            with atomic_write(self.index_path) as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            print("Discovery of {0} sites: {1} added, {2} removed, {3} URLs in total"
+                  .format(len(sites), len(added), len(removed), len(registry)))
+        return registry, added, removed
+
+    def read_csv(self):
+        """ Current feed URL registry as {url: (source, category)} """
+        registry = {}
+        if os.path.isfile(self.csv_path):
+            with open(self.csv_path, 'r') as f:
+                for row in csv.DictReader(f):
+                    registry[row['URL']] = (row['Source'], row['Category'])
+        return registry
+
+    def write_csv(self, registry):
+        with atomic_write(self.csv_path) as f:
+            writer = csv.DictWriter(f, fieldnames=['URL', 'Source', 'Category'])
+            writer.writeheader()
+            for url in registry:
+                writer.writerow({'URL': url,
+                                 'Source': registry[url][0],
+                                 'Category': registry[url][1]})
@@ -0,0 +1,151 @@
+"""
+Feed entry normalization
+
+The one place where a feedparser entry becomes a stored record: id -> link
+fallback for the UID, character folding of the title, summary -> content
+fallback, published -> feed updated -> now fallback for the date, and the
+GMT conversion. Each entry is read with a single dict lookup per field into
+a compact __slots__ record. Entries read back from our own <data><entry>
+archives name their fields after the record (uid, published_date), which
+ARCHIVE_KEYS maps to the feedparser keys.
+
+"""
+from __future__ import absolute_import, print_function
+import time
+from text_cleaner import clean_summary, normalize_text
+from date_normalizer import GMT_FORMAT, to_gmt, now_rfc822
+
+
+# feedparser key -> key of the entries of an archive parsed with feedparser
+ARCHIVE_KEYS = {'id': 'uid', 'published': 'published_date'}
+
+
+class Entry(object):
+    __slots__ = ('uid', 'title', 'link', 'summary', 'published_date', 'gmt_date', 'cluster')
+
+    def __init__(self, uid, title, link, summary, published_date, gmt_date, cluster=None):
+        """ Normalized feed entry
+
+        Reads like a dict of its fields (record['uid'], record.get('link'),
+        dict(record)) so it can stand in for the entry dicts of the storage
+        backends and the database sinks. cluster is the near-duplicate cluster
+        id, set by the crawler when it tags near duplicates (left out of the
+        fields while unset).
+        """
+        self.uid = uid
+        self.title = title
+        self.link = link
+        self.summary = summary
+        self.published_date = published_date
+        self.gmt_date = gmt_date
+        self.cluster = cluster
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def keys(self):
+        return self.__slots__ if self.cluster is not None else self.__slots__[:-1]
+
+    def __repr__(self):
+        return 'Entry({!r})'.format(dict(self))
+
+
+def _note(events, name, log, source, category, **fields):
+    events[name] = events.get(name, 0) + 1
+    if log is not None:
+        log.event(name, source=source, category=category, **fields)
+
+
+def normalize_entry(entry, feed_updated, source, category, text_mode='ascii', seen=None,
+                    events=None, log=None, keys=None):
+    """ Turn a feedparser entry into an Entry
+
+    Arguments
+        entry:        feedparser entry
+        feed_updated: (updated, updated_parsed) of the feed, the date of undated entries
+        source:       Source name
+        category:     Category name
+        text_mode:    Character normalization of title and summary (see text_cleaner)
+        seen:         Callable (uid, title) -> bool; known entries are not built
+        events:       Dict counting the problems found (and 'known' entries)
+        log:          EventLog the problems are logged to
+        keys:         {feedparser key: entry key} of entries named otherwise (ARCHIVE_KEYS)
+
+    Return
+        Entry, or None if the entry is known or unusable
+    """
+    events = {} if events is None else events
+    get = entry.get
+    id_key, published_key = 'id', 'published'
+    if keys is not None:
+        id_key, published_key = keys.get('id', 'id'), keys.get('published', 'published')
+
+    # Some feed doesn't have ID key, we use link instead
+    link = get('link')
+    uid = get(id_key)
+    if uid is None:
+        _note(events, 'missing_id', log, source, category)
+        uid = link
+        if uid is None:
+            _note(events, 'missing_link', log, source, category)
+            return None
+
+    title = get('title')
+    if title is None:
+        _note(events, 'missing_title', log, source, category, uid=uid)
+        return None
+    title = normalize_text(title, text_mode)
+
+    if seen is not None and seen(uid, title):
+        events['known'] = events.get('known', 0) + 1
+        return None
+
+    summary = get('summary')
+    if summary is None:
+        content = get('content')
+        if not content:
+            _note(events, 'missing_content', log, source, category, uid=uid)
+            return None
+        _note(events, 'missing_summary', log, source, category, uid=uid)
+        summary = content[0].get('value')
+
+    published = get(published_key)
+    gmt_tp = get(published_key + '_parsed')
+    if published is None:
+        _note(events, 'missing_published', log, source, category, uid=uid)
+        published, gmt_tp = feed_updated
+        if published is None:
+            _note(events, 'missing_updated', log, source, category, uid=uid)
+            published, gmt_tp = now_rfc822(), None
+    # UTC/GMT conversion %Y-%m-%d %T, from feedparser's parse when the normalizer misses
+    gmt_dt = to_gmt(published, (source, category))
+    if gmt_dt is None:
+        gmt_dt = time.strftime(GMT_FORMAT, gmt_tp) if gmt_tp else ''
+
+    # Remove HTML markup and fold the characters of the summary
+    return Entry(uid, title, link or uid, clean_summary(summary, text_mode), published, gmt_dt)
+
+
+def normalize_feed(res, source, category, text_mode='ascii', seen=None, events=None, log=None,
+                   keys=None):
+    """ Normalize the entries of a parsed feed
+
+    Arguments
+        res:      feedparser result
+        (others): See normalize_entry
+
+    Return
+        List of Entry (known and unusable entries left out)
+    """
+    events = {} if events is None else events
+    feed_updated = (res.feed.get('updated'), res.feed.get('updated_parsed'))
+    entries = []
+    for entry in res.entries:
+        record = normalize_entry(entry, feed_updated, source, category, text_mode, seen,
+                                 events, log, keys)
+        if record is not None:
+            entries.append(record)
+    return entries
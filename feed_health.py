@@ -0,0 +1,223 @@
+"""
+Per-feed health and quarantine
+
+Tracks for every feed its consecutive failures (errors, timeouts, HTTP
+errors), its consecutive empty or unparseable responses and its fetch
+latency. A circuit breaker moves a feed into quarantine after threshold
+failures (or empty_threshold empty responses in a row): it is then only
+fetched as a probe, the probes spaced exponentially from probe_base up to
+probe_max, and the first good probe brings it back into the crawl. The
+state is kept in feed_health.csv so dead feeds stay quarantined across
+restarts.
+
+Usage
+    python feed_health.py <feed_health.csv> [--all]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import csv
+import time
+import argparse
+from fsutil import atomic_write
+
+
+FIELDS = ['URL', 'Failures', 'Empties', 'Latency', 'LastError', 'LastOK', 'Quarantined',
+          'Reason', 'Probes', 'NextProbe']
+
+
+def _float(value):
+    return float(value) if value else None
+
+
+class FeedHealth(object):
+    def __init__(self, csv_path=None, threshold=5, empty_threshold=10, probe_base=3600,
+                 probe_max=7 * 24 * 3600):
+        """ Health of the feeds and circuit breaker
+
+        Arguments
+            csv_path:        Path of the CSV storing the health of the feeds
+            threshold:       Consecutive failures that quarantine a feed
+            empty_threshold: Consecutive empty or unparseable responses that quarantine a feed
+            probe_base:      Delay (seconds) before the first probe of a quarantined feed
+            probe_max:       Longest delay between two probes
+        """
+        self.csv_path = csv_path
+        self.threshold = threshold
+        self.empty_threshold = empty_threshold
+        self.probe_base = probe_base
+        self.probe_max = probe_max
+        self.states = {}
+        self.dirty = False
+
+    def load(self, csv_path=None):
+        """ Load the health of the feeds from CSV
+
+        Arguments
+            csv_path: Path of the CSV (default: current path)
+        """
+        if csv_path is not None:
+            self.csv_path = csv_path
+        self.states = {}
+        if self.csv_path and os.path.isfile(self.csv_path):
+            with open(self.csv_path, 'r') as f:
+                for row in csv.DictReader(f):
+                    self.states[row['URL']] = {'failures': int(row['Failures']),
+                                               'empties': int(row['Empties']),
+                                               'latency': _float(row['Latency']),
+                                               'last_error': row['LastError'] or None,
+                                               'last_ok': _float(row['LastOK']),
+                                               'quarantined': _float(row['Quarantined']),
+                                               'reason': row['Reason'] or None,
+                                               'probes': int(row['Probes']),
+                                               'next_probe': _float(row['NextProbe'])}
+        self.dirty = False
+        return self
+
+    def save(self):
+        """ Write the health of the feeds back to CSV if anything changed """
+        if not self.dirty or not self.csv_path:
+            return
+        with atomic_write(self.csv_path) as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for url in self.states:
+                state = self.states[url]
+                writer.writerow({'URL': url,
+                                 'Failures': state['failures'],
+                                 'Empties': state['empties'],
+                                 'Latency': '' if state['latency'] is None else
+                                            '{:.3f}'.format(state['latency']),
+                                 'LastError': state['last_error'] or '',
+                                 'LastOK': state['last_ok'] or '',
+                                 'Quarantined': state['quarantined'] or '',
+                                 'Reason': state['reason'] or '',
+                                 'Probes': state['probes'],
+                                 'NextProbe': state['next_probe'] or ''})
+        self.dirty = False
+
+    def _state(self, url):
+        if url not in self.states:
+            self.states[url] = {'failures': 0, 'empties': 0, 'latency': None,
+                                'last_error': None, 'last_ok': None, 'quarantined': None,
+                                'reason': None, 'probes': 0, 'next_probe': None}
+        return self.states[url]
+
+    def is_quarantined(self, url):
+        state = self.states.get(url)
+        return state is not None and state['quarantined'] is not None
+
+    def next_probe(self, url):
+        """ Time the next probe of a quarantined feed is due (None if it is not quarantined) """
+        state = self.states.get(url)
+        return state['next_probe'] if state is not None and state['quarantined'] else None
+
+    def due(self, url, now=None):
+        """ Whether a feed is to be fetched: it is healthy or its probe is due """
+        next_probe = self.next_probe(url)
+        return next_probe is None or next_probe <= (time.time() if now is None else now)
+
+    def latency(self, url, seconds):
+        """ Record the latency of a fetch (exponentially weighted) """
+        state = self._state(url)
+        previous = state['latency']
+        state['latency'] = seconds if previous is None else 0.3 * seconds + 0.7 * previous
+        self.dirty = True
+
+    def success(self, url, num_entries=None, now=None):
+        """ Record a good response
+
+        Arguments
+            url:         Feed URL
+            num_entries: Number of entries in the feed (None: not parsed, e.g. 304); a feed
+                         without entries is empty or unparseable
+        """
+        now = time.time() if now is None else now
+        state = self._state(url)
+        state['failures'] = 0
+        if num_entries == 0:
+            state['empties'] += 1
+            state['last_error'] = 'empty or unparseable'
+            self._trip(url, state, now)
+            return
+        if num_entries is not None:
+            state['empties'] = 0
+        elif state['reason'] == 'empty':
+            # Not modified: still as empty as when it was quarantined
+            self._trip(url, state, now)
+            return
+        state['last_ok'] = now
+        if state['quarantined'] is not None:
+            print("Feed {0} is back after {1:.1f} h in quarantine"
+                  .format(url, (now - state['quarantined']) / 3600))
+            state['quarantined'], state['reason'], state['next_probe'] = None, None, None
+            state['probes'] = 0
+        self.dirty = True
+
+    def failure(self, url, error, now=None):
+        """ Record a failed fetch (error, timeout or HTTP error) """
+        now = time.time() if now is None else now
+        state = self._state(url)
+        state['failures'] += 1
+        state['last_error'] = str(error)[:200]
+        self._trip(url, state, now)
+
+    def _trip(self, url, state, now):
+        """ Quarantine a feed that went over a threshold, or space the probes of one that is """
+        self.dirty = True
+        if state['quarantined'] is not None:
+            state['probes'] += 1
+            state['next_probe'] = now + min(self.probe_max,
+                                            self.probe_base * 2 ** state['probes'])
+        elif state['failures'] >= self.threshold or state['empties'] >= self.empty_threshold:
+            state['quarantined'] = now
+            state['reason'] = 'failures' if state['failures'] >= self.threshold else 'empty'
+            state['probes'] = 0
+            state['next_probe'] = now + self.probe_base
+            print("-->Quarantined {0} ({1}): {2}".format(url, state['reason'],
+                                                           state['last_error']))
+
+    def quarantined(self):
+        """ URLs of the quarantined feeds """
+        return [url for url in self.states if self.states[url]['quarantined'] is not None]
+
+    def report(self, sources=None, show_all=False):
+        """ Print the quarantined feeds (every tracked feed with show_all)
+
+        Arguments
+            sources: {url: (source, category)} to name the feeds
+        """
+        now = time.time()
+        urls = sorted(self.states if show_all else self.quarantined(),
+                      key=lambda u: self.states[u]['quarantined'] or now)
+        if not urls:
+            print("No quarantined feed")
+            return
+        print("{} quarantined feeds:".format(len(self.quarantined())))
+        for url in urls:
+            state = self.states[url]
+            name = url
+            if sources and url in sources:
+                name = '{0} ({1})'.format(*sources[url])
+            latency = '-' if state['latency'] is None else '{:.2f}s'.format(state['latency'])
+            if state['quarantined'] is None:
+                status = 'ok'
+            else:
+                status = '{0} for {1:.1f} h, {2} probes, next in {3:.1f} h'.format(
+                    state['reason'], (now - state['quarantined']) / 3600, state['probes'],
+                    max(0, state['next_probe'] - now) / 3600)
+            print("    {0}  failures {1}, empties {2}, latency {3}, {4}: {5}"
+                  .format(name, state['failures'], state['empties'], latency, status,
+                          state['last_error'] or ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the quarantined feeds")
+    parser.add_argument('csv_path', help="feed_health.csv of a data directory")
+    parser.add_argument('--all', action='store_true', help="Every tracked feed")
+    args = parser.parse_args()
+    FeedHealth(args.csv_path).load().report(show_all=args.all)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,13 +10,16 @@ import os
 import sys
 import csv
 import time
-import requests
 import feedparser
 import xml.etree.ElementTree as ET
 import mysql.connector as mdb
 from bs4 import BeautifulSoup
-# from dateutil.parser import parse
-# from dateutil import tz
+from http_client import HTTPClient
+from politeness import Politeness
+from storage import FIELDS
+from entry_normalizer import normalize_feed
+from scheduler import parse_retry_after
+from metrics import EventLog
 
 
 # RSS URLs required to be scraped in the following sources
@@ -39,13 +42,18 @@ sources = {'https://thefintechtimes.com/feed/': ('FinTech', 'fintechtimes'),
            'https://news.google.com/news?cf=all&hl=en&pz=1&ned=us&q=fintech&output=rss':
                ('FinTech', 'google_news')}
 
+# Keep-alive connections shared by the index pages and the feeds
+http = HTTPClient()
+# Paces the requests of every host and honors robots.txt, 429 and 503
+politeness = Politeness(fetch=http.get)
+
 n = len(sources)
 # Begin to gather feed URLs
 for source in targets:
     csv_dir = './data/{}/feed_url.csv'.format(source)
 
     if not os.path.isfile(csv_dir):
-        r = requests.get(targets[source])
+        r = http.get(targets[source])
         # url = urlopen(rss_sources[src])
         # content = url.read()
         soup = BeautifulSoup(r.content, 'lxml')
@@ -115,8 +123,8 @@ print("\nStarted at:", time.asctime(time_start))
 print("Running for: {} min".format(timeout))
 print("Terminated at:", asc_time_end)
 
-# UTC/GMT conversion
-# to_zone = tz.tzutc()
+# Per-entry feed problems, rate-limited
+log = EventLog()
 
 while time.time() < time_end:
     time_left = (time_end - time.time()) / 60
@@ -140,14 +148,24 @@ while time.time() < time_end:
         # (category, src)
         category, source = sources[url]
         # print(category, src)
+        if not politeness.allowed(url):
+            print("-->{0} ({1}) is disallowed by robots.txt".format(category, source))
+            continue
+        if politeness.ready_in(url) > politeness.max_wait:
+            print("-->{0} ({1}) is throttled, try again later...".format(category, source))
+            continue
+        politeness.wait(url)
         try:
             # print("Connecting to {} ({})".format(src, category))
-            r = requests.get(url)
+            r = http.get(url)
             # print(r.status_code)
         except Exception:
             print("-->Failed to connect to {0} ({1})\n"
                   "-->try again later...".format(category, source))
-            time.sleep(5)
+            continue
+        politeness.observe(url, r.status_code, parse_retry_after(r.headers.get('Retry-After')))
+        if r.status_code in (429, 503):
+            print("-->{0} ({1}) asks us to slow down, try again later...".format(category, source))
             continue
 
         content = r.content
@@ -165,142 +183,33 @@ while time.time() < time_end:
             # Retrieve the current sets of UIDs, titles in the XML file
             id_set = set(map(lambda i: i.text, data.iter('uid')))
             title_set = set(map(lambda i: i.text, data.iter('title')))
-            for feed in res.entries:
-                # Some feed doesn't have id key, we use link instead
-                try:
-                    fd_id = feed.id
-                except AttributeError:
-                    print("-->No <id> found in {0} ({1})\n"
-                          "-->try <link>...".format(category, source))
-                    # pass
-                    try:
-                        fd_id = feed.link
-                    except AttributeError:
-                        print("-->No <link> found in {0} ({1})\n"
-                              "-->ignore...".format(category, source))
-                        continue
-                fd_title = feed.title.encode('ascii', 'ignore').decode('utf-8')
-                if fd_id not in id_set and fd_title not in title_set:
-                    entry = ET.SubElement(data, 'entry')
-                    uid = ET.SubElement(entry, 'uid')
-                    uid.text = fd_id
-
-                    title = ET.SubElement(entry, 'title')
-                    # Remove non-ascii chars in title
-                    title.text = fd_title
-
-                    link = ET.SubElement(entry, 'link')
-                    link.text = feed.link
-
-                    summary = ET.SubElement(entry, 'summary')
-                    s = feed.summary
-                    if s is None:
-                        print("-->Empty <summary> found at UID: {0}, in {1} ({2})\n"
-                              "-->try <content>...".format(fd_id, category, source))
-                        try:
-                            s = feed.content[0].value
-                        except AttributeError:
-                            print("-->No <content>...")
-                    # Remove HTML markup and non-ascii chars in summary
-                    s = BeautifulSoup(s, 'lxml').get_text()
-                    summary.text = s.encode('ascii', 'ignore').decode('utf-8')
-
-                    published = ET.SubElement(entry, 'published_date')
-                    try:
-                        published.text = feed.published
-                        gmt_tp = feed.published_parsed
-                    except AttributeError:
-                        print("-->No <published> found in {0} ({1})\n"
-                              "-->try <updated>...".format(category, source))
-                        try:
-                            published.text = res.feed.updated
-                            gmt_tp = res.feed.updated_parsed
-                        except AttributeError:
-                            print("-->No <updated> found in {0} ({1})\n"
-                                  "-->use system GMT...".format(category, source))
-                            gmt_tp = time.gmtime()
-
-                    # # UTC/GMT conversion %Y-%m-%d %T
-                    # gmt_dt = str(parse(published.text).astimezone(to_zone)).split('+')[0]
-                    gmt_dt = time.strftime('%Y-%m-%d %H:%M:%S', gmt_tp) if gmt_tp else ''
-
-                    # Insert row into database table 'rss_feeds'
-                    try:
-                        query = ("INSERT INTO rss_feeds"
-                                 " (uid, title, link, summary, published_date, gmt_date, category, source)"
-                                 " VALUE (%s, %s, %s, %s, %s, STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s);")
-                        cursor.execute(query, (uid.text, title.text, link.text, summary.text, published.text,
-                                               gmt_dt, category, source))
-                        cnx.commit()
-                    except Exception as e:
-                        print("-->Error {}".format(e.args[1]))
-
-                    num_update += 1
-
-            if num_update:
-                print("Found {0} update in {1} ({2})".format(num_update, category, source))
-                tree.write(xml_dir)
-                time.sleep(0.5)
         else:
             print("Creating a new XML file...")
             data = ET.Element('data')
-            for feed in res.entries:
-                entry = ET.SubElement(data, 'entry')
-                uid = ET.SubElement(entry, 'uid')
-                try:
-                    uid.text = feed.id
-                except AttributeError as e:
-                    print("-->No <id> found in {0} ({1})\n"
-                          "-->try <link>...".format(category, source))
-                    # pass
-                    try:
-                        uid.text = feed.link
-                    except AttributeError:
-                        print("-->No <link> found in {0} ({1})\n"
-                              "-->ignore...".format(category, source))
-                        continue
-
-                title = ET.SubElement(entry, 'title')
-                title.text = feed.title.encode('ascii', 'ignore').decode('utf-8')
-
-                link = ET.SubElement(entry, 'link')
-                link.text = feed.link
-
-                summary = ET.SubElement(entry, 'summary')
-                s = feed.summary
-                if s is None:
-                    print("-->Empty <summary> found at UID: {0}, in {1} ({2})\n"
-                          "-->try <content>...".format(uid.text, category, source))
-                    try:
-                        s = feed.content[0].value
-                    except AttributeError as e:
-                        print("-->No <content>...")
-                # Remove HTML markup in the summary
-                s = BeautifulSoup(s, 'lxml').get_text()
-                summary.text = s.encode('ascii', 'ignore').decode('utf-8')
-
-                published = ET.SubElement(entry, 'published_date')
-                try:
-                    published.text = feed.published
-                except AttributeError as e:
-                    print("-->No <published> found in {0} ({1})\n"
-                          "-->try <updated>...".format(category, source))
-                    published.text = res.feed.updated
-
             tree = ET.ElementTree(data)
-            num_update = len(res.entries)
+            id_set, title_set = set(), set()
 
-            tree.write(xml_dir)
-            time.sleep(0.5)
-            try:
-                query = ("LOAD XML LOCAL INFILE '" + xml_dir + "' INTO TABLE rss_feeds"
-                         " ROWS IDENTIFIED BY '<entry>' SET category = %s, source = %s;")
-                cursor.execute(query, (category, source))
-                cnx.commit()
-            except Exception as e:
-                print("Error {}".format(e.args[1]))
+        entries = normalize_feed(res, source, category, log=log,
+                                 seen=lambda uid, title: uid in id_set or title in title_set)
+        for e in entries:
+            entry = ET.SubElement(data, 'entry')
+            for field in FIELDS:
+                ET.SubElement(entry, field).text = e[field]
 
-            print("Found {0} update in {1} ({2})...".format(num_update, category, source))
+            # Insert row into database table 'rss_feeds'
+            try:
+                query = ("INSERT INTO rss_feeds"
+                         " (uid, title, link, summary, published_date, gmt_date, category, source)"
+                         " VALUE (%s, %s, %s, %s, %s, STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s);")
+                cursor.execute(query, (e.uid, e.title, e.link, e.summary, e.published_date,
+                                       e.gmt_date, category, source))
+            except Exception as err:
+                print("-->Error {}".format(err.args[1]))
+        cnx.commit()
+
+        if entries:
+            print("Found {0} update in {1} ({2})".format(len(entries), category, source))
+            tree.write(xml_dir)
 
     cursor.close()
     cnx.close()
@@ -0,0 +1,112 @@
+"""
+Per-feed HTTP validators
+
+Stores the ETag, Last-Modified and body hash of every feed next to the
+feed_url.csv registry, so that unchanged feeds can be skipped before parsing.
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import csv
+import hashlib
+from fsutil import atomic_write
+
+
+FIELDS = ['URL', 'ETag', 'LastModified', 'Hash']
+
+
+def content_hash(content):
+    """ Hash of a feed body used to detect unchanged responses """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+class FeedStateStore(object):
+    def __init__(self, csv_path=None):
+        """ Conditional GET state of the feeds
+
+        Arguments
+            csv_path: Path of the CSV storing the validators
+        """
+        self.csv_path = csv_path
+        self.states = {}
+        self.dirty = False
+
+    def load(self, csv_path=None):
+        """ Load the validators from CSV
+
+        Arguments
+            csv_path: Path of the CSV storing the validators (default: current path)
+        """
+        if csv_path is not None:
+            self.csv_path = csv_path
+        self.states = {}
+        if self.csv_path and os.path.isfile(self.csv_path):
+            with open(self.csv_path, 'r') as f:
+                for row in csv.DictReader(f):
+                    self.states[row['URL']] = {'etag': row['ETag'] or None,
+                                               'last_modified': row['LastModified'] or None,
+                                               'hash': row['Hash'] or None}
+        self.dirty = False
+        return self
+
+    def save(self):
+        """ Write the validators back to CSV if anything changed """
+        if not self.dirty or not self.csv_path:
+            return
+        with atomic_write(self.csv_path) as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for url in self.states:
+                state = self.states[url]
+                writer.writerow({'URL': url,
+                                 'ETag': state['etag'] or '',
+                                 'LastModified': state['last_modified'] or '',
+                                 'Hash': state['hash'] or ''})
+        self.dirty = False
+
+    def get_state(self, url):
+        """ Validators of a feed as a dict (None if unknown) """
+        return self.states.get(url)
+
+    def set_state(self, url, state):
+        """ Restore the validators of a feed (journal replay) """
+        self.states[url] = state
+        self.dirty = True
+
+    def forget(self, url):
+        """ Drop the validators of a feed (its last body was not processed) """
+        if self.states.pop(url, None) is not None:
+            self.dirty = True
+
+    def request_headers(self, url):
+        """ Conditional request headers for a feed """
+        headers = {}
+        state = self.states.get(url)
+        if state:
+            if state['etag']:
+                headers['If-None-Match'] = state['etag']
+            if state['last_modified']:
+                headers['If-Modified-Since'] = state['last_modified']
+        return headers
+
+    def is_unchanged(self, url, digest):
+        """ Whether the body hash matches the last processed body of the feed """
+        state = self.states.get(url)
+        return state is not None and state['hash'] == digest
+
+    def update(self, url, headers, digest):
+        """ Record the validators of a processed response
+
+        Arguments
+            url:     Feed URL
+            headers: Response headers
+            digest:  Hash of the response body
+        """
+        state = {'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified'),
+                 'hash': digest}
+        if self.states.get(url) != state:
+            self.states[url] = state
+            self.dirty = True
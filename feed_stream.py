@@ -0,0 +1,174 @@
+"""
+Streaming feed parser
+
+Large feeds (multi-megabyte aggregator queries) are parsed while they
+download: the body is fed chunk by chunk to an incremental lxml parser, each
+entry is normalized as soon as its closing tag arrives and is then dropped
+from the tree, so memory stays bounded by one entry plus one chunk. Feeds
+list their newest entries first, so the download stops once a run of
+entries is already in the dedup index. Leading whitespace before the XML
+declaration (BetaKit) is stripped from the first chunk only.
+
+The entries are mapped to the same fields feedparser gives (RSS 2.0,
+RSS 1.0 and Atom) and go through entry_normalizer like any other feed.
+
+"""
+from __future__ import absolute_import, print_function
+import time
+from lxml import etree
+from entry_normalizer import normalize_entry
+from scheduler import feed_min_interval
+
+
+CHUNK_SIZE = 64 * 1024
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS1 = '{http://purl.org/rss/1.0/}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+SY = '{http://purl.org/rss/1.0/modules/syndication/}'
+
+ENTRY_TAGS = frozenset(['item', RSS1 + 'item', ATOM + 'entry'])
+
+# Entry element -> feedparser key
+ENTRY_FIELDS = {'title': 'title', RSS1 + 'title': 'title', ATOM + 'title': 'title',
+                'link': 'link', RSS1 + 'link': 'link', ATOM + 'link': 'link',
+                'guid': 'id', ATOM + 'id': 'id',
+                'description': 'summary', RSS1 + 'description': 'summary',
+                ATOM + 'summary': 'summary',
+                CONTENT + 'encoded': 'content', ATOM + 'content': 'content',
+                'pubDate': 'published', ATOM + 'published': 'published',
+                ATOM + 'issued': 'published',
+                DC + 'date': 'updated', ATOM + 'updated': 'updated', ATOM + 'modified': 'updated'}
+
+# Feed element -> feedparser key
+FEED_FIELDS = {'ttl': 'ttl',
+               SY + 'updatePeriod': 'sy_updateperiod',
+               SY + 'updateFrequency': 'sy_updatefrequency',
+               'lastBuildDate': 'updated', DC + 'date': 'updated', ATOM + 'updated': 'updated',
+               'pubDate': 'published', ATOM + 'published': 'published'}
+
+
+class StreamedFeed(object):
+    def __init__(self, response, result, size):
+        """ A feed response parsed while it downloaded
+
+        Stands in for the response in the crawl: the body is gone, the parse
+        output is kept instead.
+
+        Arguments
+            response: Streamed HTTP response (closed)
+            result:   Output of stream_feed
+            size:     Number of body bytes read
+        """
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.result = result
+        self.size = size
+
+
+def lstrip_chunks(chunks):
+    """ Drop the whitespace before the document, copying the first chunk only """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        chunk = chunk.lstrip()
+        if chunk:
+            yield chunk
+            break
+    for chunk in chunks:
+        yield chunk
+
+
+def _text(elem):
+    """ Text of an element, serializing the markup of XHTML content """
+    if elem.get('type') == 'xhtml' and len(elem):
+        return ''.join(etree.tostring(child, encoding='unicode', with_tail=True)
+                       for child in elem).strip()
+    return (elem.text or '').strip()
+
+
+def _entry(elem):
+    """ feedparser-like dict of an entry element """
+    entry = {}
+    for child in elem:
+        key = ENTRY_FIELDS.get(child.tag)
+        if key is None or key in entry:
+            continue
+        if child.tag == ATOM + 'link':
+            # The alternate link is the entry's page
+            if child.get('rel', 'alternate') == 'alternate':
+                entry['link'] = child.get('href')
+        elif key == 'content':
+            entry['content'] = [{'value': _text(child)}]
+        else:
+            entry[key] = _text(child)
+    return entry
+
+
+def stream_feed(chunks, source, category, text_mode='ascii', seen=None, known_run=3, log=None):
+    """ Parse a feed body as it downloads
+
+    Arguments
+        chunks:    Iterable of raw body chunks (bytes)
+        source:    Source name
+        category:  Category name
+        text_mode: Character normalization of titles and summaries (see text_cleaner)
+        seen:      Callable (uid, title) -> bool; known entries are not built
+        known_run: Stop reading after this many known entries in a row (0: read it all);
+                   more than one so that a pinned old entry does not cut the feed short
+        log:       EventLog the entry problems are logged to
+
+    Return
+        (shortest polling interval asked by the feed, list of entry records,
+         {stage: CPU seconds} of the 'parse' and 'clean' stages,
+         {event: count} of the entries seen, already known and the problems found),
+        with events['stopped_early'] = 1 if the download stopped at known entries
+    """
+    t_parse, t_clean = 0.0, 0.0
+    events = {'seen': 0, 'known': 0}
+    feed = {}
+    records = []
+    run = 0
+    depth = 0
+    parser = etree.XMLPullParser(events=('start', 'end'), recover=True, resolve_entities=False,
+                                 huge_tree=True)
+    for chunk in lstrip_chunks(chunks):
+        t0 = time.thread_time()
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if elem.tag not in ENTRY_TAGS:
+                if event == 'end' and not depth and elem.tag in FEED_FIELDS:
+                    feed.setdefault(FEED_FIELDS[elem.tag], _text(elem))
+                continue
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+
+            entry = _entry(elem)
+            # Drop the entry and the siblings before it from the tree
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+            t_parse += time.thread_time() - t0
+            t0 = time.thread_time()
+
+            events['seen'] += 1
+            known = events['known']
+            updated = feed.get('updated') or feed.get('published')
+            record = normalize_entry(entry, (updated, None), source, category, text_mode, seen,
+                                     events, log)
+            if record is not None:
+                records.append(record)
+            run = run + 1 if events['known'] > known else 0
+            t_clean += time.thread_time() - t0
+            t0 = time.thread_time()
+            if known_run and run >= known_run:
+                break
+        t_parse += time.thread_time() - t0
+        if known_run and run >= known_run:
+            events['stopped_early'] = 1
+            break
+    return feed_min_interval(feed), records, {'parse': t_parse, 'clean': t_clean}, events
@@ -0,0 +1,98 @@
+"""
+Concurrent feed fetcher
+
+Feeds are downloaded on a thread pool driven by an asyncio event loop, with a
+global limit on in-flight requests and a separate limit per host so that a
+large number of feeds on the same site are not requested all at once. With a
+Politeness policy the per-host limit and the pacing of every host come from
+it: a fetch waiting for its host's token awaits on the event loop, so the
+other hosts keep being fetched meanwhile.
+
+"""
+from __future__ import absolute_import, print_function
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from http_client import HTTPClient
+
+
+class AsyncFetcher(object):
+    def __init__(self, max_concurrency=32, max_per_host=4, fetch=None, politeness=None):
+        """ Fetch many feed URLs concurrently
+
+        Arguments
+            max_concurrency: Maximum number of requests in flight
+            max_per_host:    Maximum number of requests in flight to a single host
+            fetch:           Blocking callable url -> response (default: the get of an
+                             HTTPClient pooling max_per_host connections per host)
+            politeness:      Politeness pacing the requests of every host (overrides
+                             max_per_host with its per-host connection ceilings)
+        """
+        assert max_concurrency > 0 and max_per_host > 0
+
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.fetch = fetch or HTTPClient(pool_maxsize=max_per_host).get
+        self.politeness = politeness
+
+        self._executor = None
+        self._global = None
+        self._hosts = {}
+
+    def fetch_all(self, urls, callback):
+        """ Fetch every URL and hand each result to the callback as soon as it completes
+
+        The callback is always invoked on the calling thread, so it may safely
+        parse and persist without extra locking.
+
+        Arguments
+            urls:     Iterable of feed URLs
+            callback: Callable (url, response, error); exactly one of response/error is None
+        """
+        loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            loop.run_until_complete(self._gather(loop, urls, callback))
+        finally:
+            self._executor.shutdown(wait=True)
+            loop.close()
+            self._executor = None
+            self._global = None
+            self._hosts = {}
+
+    async def _gather(self, loop, urls, callback):
+        self._global = asyncio.Semaphore(self.max_concurrency)
+        tasks = [loop.create_task(self._fetch_one(loop, url, callback)) for url in urls]
+        if tasks:
+            await asyncio.wait(tasks)
+        # Surface errors raised by the callback instead of dropping them
+        for task in tasks:
+            task.result()
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self._hosts:
+            limit = self.max_per_host
+            if self.politeness is not None:
+                limit = self.politeness.max_connections(url)
+            self._hosts[host] = asyncio.Semaphore(limit)
+        return self._hosts[host]
+
+    async def _wait_turn(self, url):
+        """ Wait until the host of a URL takes a request (raise HostDeferred if it won't soon) """
+        delay = self.politeness.acquire(url)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.politeness.acquire(url)
+
+    async def _fetch_one(self, loop, url, callback):
+        response, error = None, None
+        async with self._host_limit(url):
+            try:
+                if self.politeness is not None:
+                    await self._wait_turn(url)
+                async with self._global:
+                    response = await loop.run_in_executor(self._executor, self.fetch, url)
+            except Exception as e:
+                error = e
+        callback(url, response, error)
@@ -0,0 +1,36 @@
+"""
+File system helpers
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w', encoding=None):
+    """ Write a file through a temporary file renamed over the target on success
+
+    Readers never see a half-written file, and a crash leaves the previous
+    version in place.
+
+    Arguments
+        path:     Destination file path
+        mode:     File mode of the temporary file ('w' or 'wb')
+        encoding: Text encoding (text mode only)
+    """
+    dir_name = os.path.dirname(path) or '.'
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
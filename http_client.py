@@ -0,0 +1,123 @@
+"""
+Shared HTTP client
+
+One keep-alive session for all feed and index page requests, so the many
+feeds of a host reuse a few pooled connections instead of a new TCP+TLS
+handshake per fetch. Every request has connect and read timeouts, asks for
+compressed bodies (brotli when a decoder is installed) and, with http2=True
+and httpx installed, is sent over HTTP/2 where the server supports it.
+
+"""
+from __future__ import absolute_import, print_function
+import requests
+from requests.adapters import HTTPAdapter
+
+# A brotli decoder lets urllib3 / httpx accept 'br' bodies
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    try:
+        import brotlicffi
+        HAS_BROTLI = True
+    except ImportError:
+        HAS_BROTLI = False
+
+# HTTP/2 needs httpx and its h2 extra
+try:
+    import httpx
+    import h2
+    HAS_HTTP2 = True
+except ImportError:
+    httpx = None
+    HAS_HTTP2 = False
+
+
+USER_AGENT = 'rss-crawler/1.0'
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if HAS_BROTLI else 'gzip, deflate'
+
+
+class HTTPClient(object):
+    def __init__(self, pool_maxsize=4, pool_connections=64, host_pool_sizes=None,
+                 timeout=(5.0, 30.0), http2=False, user_agent=USER_AGENT):
+        """ Pooled keep-alive HTTP client (thread-safe)
+
+        Arguments
+            pool_maxsize:     Connections kept open per host
+            pool_connections: Number of hosts whose pools are kept
+            host_pool_sizes:  {host: connections} overriding pool_maxsize for busy hosts
+            timeout:          (connect, read) timeouts in seconds
+            http2:            Use HTTP/2 through httpx when it is installed
+            user_agent:       User-Agent header of every request
+        """
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.headers = {'User-Agent': user_agent, 'Accept-Encoding': ACCEPT_ENCODING}
+        self.http2 = http2 and HAS_HTTP2
+        if http2 and not HAS_HTTP2:
+            print("-->HTTP/2 needs httpx[http2], falling back to HTTP/1.1")
+
+        if self.http2:
+            # httpx pools per host internally; the per-host sizes become a global ceiling
+            connections = max([pool_maxsize] + list((host_pool_sizes or {}).values()))
+            self.session = httpx.Client(
+                http2=True, headers=self.headers, follow_redirects=True,
+                timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+                limits=httpx.Limits(max_connections=pool_connections * connections,
+                                    max_keepalive_connections=pool_connections * connections))
+            return
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        for host, size in (host_pool_sizes or {}).items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            self.session.mount('http://{}/'.format(host), adapter)
+            self.session.mount('https://{}/'.format(host), adapter)
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        """ GET a URL with the client's timeouts
+
+        Arguments
+            url:     URL to fetch
+            headers: Extra request headers (e.g. conditional GET headers)
+            timeout: (connect, read) timeouts overriding the client's
+            stream:  Return once the headers are in; the body is then read with read() or
+                     iter_body(), and the response closed if it is not read to the end
+
+        Return
+            Response with status_code, headers and content
+        """
+        timeout = timeout or self.timeout
+        if self.http2:
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+            if stream:
+                request = self.session.build_request('GET', url, headers=headers,
+                                                     timeout=timeout)
+                return self.session.send(request, stream=True)
+            return self.session.get(url, headers=headers, timeout=timeout)
+        return self.session.get(url, headers=headers, timeout=timeout, stream=stream)
+
+    def read(self, response):
+        """ Body of a response, reading it if it was streamed """
+        if self.http2:
+            return response.read()
+        return response.content
+
+    def iter_body(self, response, chunk_size=64 * 1024):
+        """ Decoded body chunks of a streamed response """
+        if self.http2:
+            return response.iter_bytes(chunk_size)
+        return response.iter_content(chunk_size)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
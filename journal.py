@@ -0,0 +1,104 @@
+"""
+Write-ahead journal of crawl progress
+
+Every processed feed appends one JSON line to journal.wal (flushed and
+fsynced before the crawler moves on): its HTTP validators, its scheduler
+state and the hashes of the entries it added to the dedup index. After each
+crawl cycle, once feed_state.csv and dedup.idx are saved, the run state
+(deadline, scheduler) is written to snapshot.json with an atomic rename and
+the journal is truncated. A restart loads the snapshot and replays the
+journal instead of rebuilding anything from the archives.
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import json
+from fsutil import atomic_write
+
+
+class CrawlJournal(object):
+    def __init__(self, path, fsync=True):
+        """ Snapshot plus write-ahead journal in a directory
+
+        Arguments
+            path:  Directory of snapshot.json and journal.wal
+            fsync: fsync every journal record (False trades durability for speed)
+        """
+        self.path = path
+        self.snapshot_path = os.path.join(path, 'snapshot.json')
+        self.wal_path = os.path.join(path, 'journal.wal')
+        self.fsync = fsync
+        self.seq = 0
+        self._wal = None
+
+    def recover(self):
+        """ Read the last snapshot and the journal records written after it
+
+        Return
+            (snapshot dict or None, list of journal records)
+        """
+        snapshot = None
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+        self.seq = snapshot.get('seq', 0) if snapshot else 0
+        records = []
+        if os.path.isfile(self.wal_path):
+            good = 0
+            with open(self.wal_path, 'rb') as f:
+                for line in f:
+                    # A crash while appending leaves a torn last line
+                    if not line.endswith(b'\n'):
+                        break
+                    good += len(line)
+                    record = json.loads(line.decode('utf-8'))
+                    # Records already in the snapshot (crash before the truncation)
+                    if record['seq'] <= self.seq:
+                        continue
+                    self.seq = record['seq']
+                    records.append(record)
+            if good < os.path.getsize(self.wal_path):
+                # Cut the torn line so that new records start on a line of their own
+                with open(self.wal_path, 'r+b') as f:
+                    f.truncate(good)
+        return snapshot, records
+
+    def append(self, record):
+        """ Durably add a record to the journal """
+        if self._wal is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._wal = open(self.wal_path, 'a', encoding='utf-8')
+        self.seq += 1
+        record['seq'] = self.seq
+        self._wal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._wal.flush()
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+
+    def checkpoint(self, snapshot):
+        """ Replace the snapshot and truncate the journal it supersedes
+
+        Arguments
+            snapshot: JSON-serializable run state
+        """
+        snapshot['seq'] = self.seq
+        with atomic_write(self.snapshot_path) as f:
+            json.dump(snapshot, f)
+        self.close()
+        # An empty journal replaces the old one atomically too
+        with atomic_write(self.wal_path):
+            pass
+
+    def reset(self):
+        """ Forget the previous run """
+        self.close()
+        for path in (self.snapshot_path, self.wal_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        self.seq = 0
+
+    def close(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
@@ -1,36 +1,15 @@
-import os
-import time
-import mysql.connector as mdb
-
+"""
+Load the XML archives of data/ into table 'rss_feeds'
 
-cwd = os.getcwd()
-#print(cwd)
+Kept for the old entry point; the import is done by bulk_loader.py
+(streaming, parallel, idempotent on uid and resumable).
 
-cnx = mdb.connect(host='localhost',
-                  user='root',
-                  password='yaochen',
-                  database='test_db_rss',
-                  unix_socket='/tmp/mysql_default3059569.sock')
-cursor = cnx.cursor()
+"""
+from __future__ import absolute_import, print_function
+import os
+from bulk_loader import MYSQL_CONFIG, bulk_load
 
-for data_dir in os.listdir(cwd + '/data'):
-    print("Processing directory:", data_dir)
-    try:
-        for file in os.listdir(cwd + '/data/' + data_dir):
-            if file.endswith('.xml'):
-                print("Processing {0} file:".format(file))
-                xml_dir = cwd + '/data/' + data_dir + '/' + file
-                category = file.replace('.xml', '')
-                try:
-                    query = ("LOAD XML LOCAL INFILE '" + xml_dir + "' INTO TABLE rss_feeds "
-                             "ROWS IDENTIFIED BY '<entry>' SET category=%s, source=%s;")
-                    cursor.execute(query, (category, data_dir))
-                    cnx.commit()
-                    time.sleep(0.5)
-                except Exception as e:
-                    print("Error {}".format(e.args[1]))
-    except NotADirectoryError:
-        print("Not a dir!")
 
-cursor.close()
-cnx.close()
+if __name__ == '__main__':
+    config = dict(MYSQL_CONFIG, unix_socket='/tmp/mysql_default3059569.sock')
+    bulk_load(os.path.join(os.getcwd(), 'data'), mysql_config=config)
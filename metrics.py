@@ -0,0 +1,309 @@
+"""
+Crawl instrumentation
+
+Counters, gauges and histograms with labels, exposed as Prometheus text on
+a local HTTP endpoint and written as a periodic JSON snapshot, plus an event
+log that rate-limits repeated structured log lines.
+
+"""
+from __future__ import absolute_import, print_function
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from fsutil import atomic_write
+
+
+# Histogram buckets (upper bounds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """ Bucketed distribution of observed values
+
+        Arguments
+            buckets: Sorted upper bounds of the buckets (an overflow bucket is added)
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile (inf in the overflow bucket) """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{0}="{1}"'.format(k, escape(v)) for k, v in pairs) + '}'
+
+
+class Metrics(object):
+    def __init__(self):
+        """ Registry of labelled counters, gauges and histograms (thread-safe) """
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text, buckets=None):
+        """ Set the help text (and the histogram buckets) of a metric """
+        self.help[name] = text
+        if buckets is not None:
+            self.buckets[name] = buckets
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[(name, _labels_key(labels))] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+            hist.observe(value)
+
+    def render(self):
+        """ Prometheus text exposition of every metric """
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges),
+                                 ('histogram', self.histograms)):
+                by_name = defaultdict(list)
+                for name, key in series:
+                    by_name[name].append(key)
+                for name in sorted(by_name):
+                    if name in self.help:
+                        lines.append('# HELP {0} {1}'.format(name, self.help[name]))
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                    for key in sorted(by_name[name]):
+                        value = series[(name, key)]
+                        if kind != 'histogram':
+                            lines.append('{0}{1} {2}'.format(name, _format_labels(key), value))
+                            continue
+                        total = 0
+                        for bound, n in zip(value.buckets + ('+Inf',), value.counts):
+                            total += n
+                            lines.append('{0}_bucket{1} {2}'.format(
+                                name, _format_labels(key, [('le', bound)]), total))
+                        lines.append('{0}_sum{1} {2}'.format(name, _format_labels(key), value.sum))
+                        lines.append('{0}_count{1} {2}'.format(name, _format_labels(key),
+                                                              value.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ JSON-serializable copy of every metric, with histogram quantiles """
+        with self._lock:
+            return {'time': time.time(),
+                    'counters': [{'name': name, 'labels': dict(key), 'value': value}
+                                 for (name, key), value in sorted(self.counters.items())],
+                    'gauges': [{'name': name, 'labels': dict(key), 'value': value}
+                               for (name, key), value in sorted(self.gauges.items())],
+                    'histograms': [{'name': name, 'labels': dict(key), 'count': h.count,
+                                    'sum': h.sum, 'p50': h.quantile(0.5),
+                                    'p90': h.quantile(0.9), 'p99': h.quantile(0.99)}
+                                   for (name, key), h in sorted(self.histograms.items())]}
+
+    def top(self, name, n=10):
+        """ The n label sets with the largest value of a counter, as [(labels, value)] """
+        with self._lock:
+            series = [(dict(key), value) for (m, key), value in self.counters.items() if m == name]
+        return sorted(series, key=lambda s: -s[1])[:n]
+
+
+class MetricsServer(object):
+    def __init__(self, metrics, port=9108, host='127.0.0.1'):
+        """ Local HTTP endpoint serving the metrics at /metrics
+
+        Arguments
+            metrics: Metrics registry
+            port:    Port to listen on (0: any free port)
+            host:    Interface to listen on
+        """
+        self.metrics = metrics
+        self.address = (host, port)
+        self._server = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = HTTPServer(self.address, Handler)
+        self.address = self._server.server_address
+        thread = threading.Thread(target=self._server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        print("Metrics at http://{0}:{1}/metrics".format(*self.address))
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class SnapshotWriter(object):
+    def __init__(self, metrics, path, interval=60.0):
+        """ Write the metrics as JSON to a file periodically (atomically replaced)
+
+        Arguments
+            metrics:  Metrics registry
+            path:     Path of the snapshot file
+            interval: Seconds between snapshots
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        with atomic_write(self.path) as f:
+            json.dump(self.metrics.snapshot(), f, indent=1)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                print("-->Cannot write metrics snapshot: {}".format(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='metrics-snapshot')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the writer and write a last snapshot """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+
+class EventLog(object):
+    def __init__(self, name='rss_crawler', interval=60.0, burst=5):
+        """ Structured log lines, at most burst lines per event name and interval
+
+        Lines over the limit are counted and the count is reported as
+        'suppressed' on the next line of the same event.
+
+        Arguments
+            name:     Logger name
+            interval: Rate limit window (seconds)
+            burst:    Lines allowed per event name and window
+        """
+        self.logger = logging.getLogger(name)
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def event(self, name, level=logging.WARNING, **fields):
+        """ Log an event as one JSON line, e.g. event('missing_summary', source='reuters') """
+        now = time.time()
+        with self._lock:
+            start, emitted, suppressed = self._windows.get(name, (now, 0, 0))
+            if now - start >= self.interval:
+                start, emitted = now, 0
+            if emitted >= self.burst:
+                self._windows[name] = (start, emitted, suppressed + 1)
+                return
+            self._windows[name] = (start, emitted + 1, 0)
+        fields['event'] = name
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self.logger.log(level, json.dumps(fields, sort_keys=True, default=str))
+
+
+class StageTimer(object):
+    def __init__(self, metrics=None, keep_latencies=False):
+        """ CPU time per crawl stage and wall-clock latency per feed fetch
+
+        Arguments
+            metrics:        Metrics registry also receiving the stage CPU time
+            keep_latencies: Keep every fetch latency (for a benchmark's percentiles); a
+                            long-running crawl has them in the fetch_latency_seconds histogram
+        """
+        self.cpu = defaultdict(float)
+        self.latencies = []
+        self.keep_latencies = keep_latencies
+        self.metrics = metrics
+        self._lock = threading.Lock()
+
+    def add(self, stage, cpu):
+        with self._lock:
+            self.cpu[stage] += cpu
+        if self.metrics is not None:
+            self.metrics.inc('stage_cpu_seconds_total', cpu, stage=stage)
+
+    @contextmanager
+    def stage(self, name):
+        """ Charge the CPU time of the current thread inside the block to a stage """
+        t0 = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.thread_time() - t0)
+
+    def add_latency(self, seconds):
+        if not self.keep_latencies:
+            return
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.cpu.clear()
+            self.latencies = []
@@ -0,0 +1,309 @@
+"""
+Near-duplicate index of entries across sources
+
+The same wire story reaches us through many feeds (every Reuters edition,
+AP, Google News, ...) under different UIDs and slightly different titles, so
+the exact dedup index misses it. Every new entry gets a MinHash signature of
+the word 3-grams of its title and summary; LSH banding of the signatures
+finds the earlier entries it probably shares most shingles with, and the
+best candidate above the similarity threshold gives the entry its cluster.
+The num_perm hash functions of a shingle are the 32-bit words of one
+SHAKE-128 digest, so a signature costs one C hash call per shingle and a
+column-wise min.
+
+Signatures, UID hashes and cluster ids live in flat arrays, the LSH buckets
+in one dict of 64-bit keys per generation; when a generation is full a new
+one starts and the one before the last is dropped, which bounds the memory
+to two generations of recent entries. MinHash runs vectorized when numpy is
+installed and in plain Python otherwise (same signatures either way).
+
+Usage
+    python near_dup.py build <data path> [--index <path>] [--xml]
+    python near_dup.py clusters <index path> [--min-size 2]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import re
+import sys
+import zlib
+import struct
+import hashlib
+import argparse
+from array import array
+from fsutil import atomic_write
+from dedup_index import key_hash
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MAGIC = b'RSSNEARDUP1\n'
+_HEADER = struct.Struct('<HHQQH')
+_GENERATION = struct.Struct('<QQQ')
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def _pack(arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(typecode, raw):
+    arr = array(typecode)
+    arr.frombytes(raw)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def shingles(text, size=3):
+    """ Word n-grams of a text (the text itself if it has fewer words) """
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        return {' '.join(words).encode('utf-8')} if words else set()
+    return set(' '.join(words[i:i + size]).encode('utf-8')
+               for i in range(len(words) - size + 1))
+
+
+class _Generation(object):
+    __slots__ = ('base', 'sigs', 'uids', 'clusters', 'buckets')
+
+    def __init__(self, base):
+        """ Entries base, base + 1, ... of the index """
+        self.base = base
+        self.sigs = array('I')
+        self.uids = array('Q')
+        self.clusters = array('Q')
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.uids)
+
+
+class NearDupIndex(object):
+    def __init__(self, path, collapse=False, num_perm=64, bands=16, threshold=0.6,
+                 capacity=250000, seed=1):
+        """ Clusters of near-duplicate entries
+
+        Arguments
+            path:      Path of the index checkpoint file
+            collapse:  Near duplicates are not stored (False: stored and tagged with a cluster)
+            num_perm:  MinHash signature length
+            bands:     LSH bands (num_perm / bands rows each); more bands find
+                       less similar candidates
+            threshold: Estimated Jaccard similarity from which entries are duplicates
+            capacity:  Entries per generation (two generations are kept)
+            seed:      Seed of the MinHash hash functions
+        """
+        assert num_perm % bands == 0
+
+        self.path = path
+        self.collapse = collapse
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.capacity = capacity
+        self.seed = seed
+        self._salt = struct.pack('<Q', seed)
+
+        self.generations = [_Generation(0)]
+        self.next_doc = 0
+        self.dirty = False
+
+    def signature(self, text):
+        """ MinHash signature of a text (None if it has no words) """
+        grams = shingles(text)
+        if not grams:
+            return None
+        size = 4 * self.num_perm
+        salt = self._salt
+        digests = [hashlib.shake_128(salt + g).digest(size) for g in grams]
+        if np is not None:
+            values = np.frombuffer(b''.join(digests), dtype='<u4').reshape(len(digests), -1)
+            return array('I', values.min(axis=0).astype(np.uint32).tobytes())
+        return array('I', map(min, zip(*[_unpack('I', d) for d in digests])))
+
+    def _band_keys(self, sig):
+        rows = self.rows
+        return [(band << 32) | zlib.crc32(sig[band * rows:(band + 1) * rows].tobytes())
+                for band in range(self.bands)]
+
+    def _similarity(self, sig, gen, i):
+        k = self.num_perm
+        other = gen.sigs[i * k:(i + 1) * k]
+        return sum(1 for a, b in zip(sig, other) if a == b) / float(k)
+
+    def add(self, uid, title, summary=''):
+        """ Index an entry and find its cluster
+
+        Arguments
+            uid:     UID of the entry
+            title:   Title of the entry
+            summary: Cleaned summary of the entry
+
+        Return
+            (cluster id (None for an entry without words),
+             True if the entry is a near duplicate of an earlier one)
+        """
+        sig = self.signature('{0} {1}'.format(title or '', summary or ''))
+        doc = self.next_doc
+        if sig is None:
+            return None, False
+        keys = self._band_keys(sig)
+
+        best, cluster = self.threshold, doc
+        checked = set()
+        uid_hash = key_hash(uid) if uid else 0
+        for gen in self.generations:
+            get = gen.buckets.get
+            for key in keys:
+                i = get(key)
+                if i is None or (gen.base, i) in checked:
+                    continue
+                checked.add((gen.base, i))
+                if uid_hash and gen.uids[i] == uid_hash:
+                    # Indexed before (its write failed and is retried): not its own duplicate
+                    return gen.clusters[i], False
+                similarity = self._similarity(sig, gen, i)
+                if similarity >= best:
+                    best, cluster = similarity, gen.clusters[i]
+
+        gen = self.generations[-1]
+        if len(gen) >= self.capacity:
+            gen = _Generation(doc)
+            self.generations = [self.generations[-1], gen]
+        i = len(gen)
+        gen.sigs.extend(sig)
+        gen.uids.append(key_hash(uid) if uid else 0)
+        gen.clusters.append(cluster)
+        # The first entry of a bucket stays its representative
+        for key in keys:
+            gen.buckets.setdefault(key, i)
+        self.next_doc += 1
+        self.dirty = True
+        return cluster, cluster != doc
+
+    def cluster_of(self, uid):
+        """ Cluster id of an indexed entry (None if it left the index) """
+        h = key_hash(uid)
+        for gen in reversed(self.generations):
+            try:
+                return gen.clusters[gen.uids.index(h)]
+            except ValueError:
+                continue
+        return None
+
+    def clusters(self, min_size=2):
+        """ {cluster id: [UID hashes]} of the clusters with at least min_size entries """
+        members = {}
+        for gen in self.generations:
+            for uid, cluster in zip(gen.uids, gen.clusters):
+                members.setdefault(cluster, []).append(uid)
+        return dict((c, m) for c, m in members.items() if len(m) >= min_size)
+
+    def __len__(self):
+        return sum(len(gen) for gen in self.generations)
+
+    def load(self):
+        """ Load the index checkpoint if there is one (and it has the same parameters) """
+        self.generations = [_Generation(0)]
+        self.next_doc = 0
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    print("-->Invalid near-duplicate index {}, ignore".format(self.path))
+                    return self
+                num_perm, bands, seed, next_doc, num_gen = _HEADER.unpack(f.read(_HEADER.size))
+                if (num_perm, bands, seed) != (self.num_perm, self.bands, self.seed):
+                    print("-->Near-duplicate index {} has other parameters, ignore"
+                          .format(self.path))
+                    return self
+                generations = []
+                for _ in range(num_gen):
+                    base, count, num_buckets = _GENERATION.unpack(f.read(_GENERATION.size))
+                    gen = _Generation(base)
+                    gen.sigs = _unpack('I', f.read(count * num_perm * 4))
+                    gen.uids = _unpack('Q', f.read(count * 8))
+                    gen.clusters = _unpack('Q', f.read(count * 8))
+                    keys = _unpack('Q', f.read(num_buckets * 8))
+                    values = _unpack('Q', f.read(num_buckets * 8))
+                    gen.buckets = dict(zip(keys, values))
+                    generations.append(gen)
+            self.generations = generations or [_Generation(0)]
+            self.next_doc = next_doc
+            print("Loaded near-duplicate index of {} entries".format(len(self)))
+        self.dirty = False
+        return self
+
+    def save(self):
+        """ Checkpoint the index if anything changed """
+        if not self.dirty:
+            return
+        with atomic_write(self.path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER.pack(self.num_perm, self.bands, self.seed, self.next_doc,
+                                 len(self.generations)))
+            for gen in self.generations:
+                f.write(_GENERATION.pack(gen.base, len(gen), len(gen.buckets)))
+                f.write(_pack(gen.sigs))
+                f.write(_pack(gen.uids))
+                f.write(_pack(gen.clusters))
+                f.write(_pack(array('Q', gen.buckets.keys())))
+                f.write(_pack(array('Q', gen.buckets.values())))
+        self.dirty = False
+
+
+def build(storage, index):
+    """ Index the stored entries of every feed (entries already indexed are added again)
+
+    Return
+        (number of entries, number of near duplicates)
+    """
+    num, dups = 0, 0
+    for source, category in storage.feeds():
+        for record in storage.iter_records(source, category):
+            _, dup = index.add(record.get('uid'), record.get('title'), record.get('summary'))
+            num += 1
+            dups += dup
+    return num, dups
+
+
+def main():
+    from storage import SegmentStorage, XMLStorage
+
+    parser = argparse.ArgumentParser(description="Near-duplicate index tools")
+    sub = parser.add_subparsers(dest='command')
+    build_cmd = sub.add_parser('build', help="Index the entries of a data directory")
+    build_cmd.add_argument('data_path')
+    build_cmd.add_argument('--index', help="Index path (default: <data path>/near_dup.idx)")
+    build_cmd.add_argument('--xml', action='store_true', help="XML archives, not segments")
+    clusters_cmd = sub.add_parser('clusters', help="Print the cluster sizes")
+    clusters_cmd.add_argument('index')
+    clusters_cmd.add_argument('--min-size', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        storage = XMLStorage(args.data_path) if args.xml else SegmentStorage(args.data_path)
+        index = NearDupIndex(args.index or os.path.join(args.data_path, 'near_dup.idx'))
+        num, dups = build(storage, index)
+        index.save()
+        print("Indexed {0} entries, {1} near duplicates".format(num, dups))
+    elif args.command == 'clusters':
+        clusters = NearDupIndex(args.index).load().clusters(args.min_size)
+        for cluster in sorted(clusters, key=lambda c: -len(clusters[c])):
+            print("{0}\t{1}".format(cluster, len(clusters[cluster])))
+        print("{} clusters".format(len(clusters)))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Staged crawl pipeline
+
+    fetch (threads) -> [fetched queue] -> parse (process pool) -> [parsed queue] -> write
+
+The fetch stage runs the network I/O, the parse stage runs the CPU-bound
+feed parsing and cleaning in worker processes, and a single writer on the
+calling thread owns dedup, storage and the database. Both hand-offs are
+bounded, so a slow stage blocks the one before it; the time spent blocked
+and the queue high-water marks are reported as backpressure statistics.
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+_STOP = object()
+
+
+class StageStats(object):
+    def __init__(self):
+        """ Counters of one pipeline run """
+        self.fetched = 0
+        self.parsed = 0
+        self.skipped = 0
+        self.fetch_blocked = 0.0
+        self.parse_blocked = 0.0
+        self.write_idle = 0.0
+        self.fetched_peak = 0
+        self.inflight_peak = 0
+
+    def report(self, queue_size):
+        return ("Pipeline: fetched {0}, parsed {1}, skipped {2} | "
+                "fetch queue peak {3}/{8}, blocked {4:.1f}s | "
+                "parse in flight peak {5}/{8}, blocked {6:.1f}s | writer idle {7:.1f}s"
+                .format(self.fetched, self.parsed, self.skipped,
+                        self.fetched_peak, self.fetch_blocked,
+                        self.inflight_peak, self.parse_blocked, self.write_idle, queue_size))
+
+
+class CrawlPipeline(object):
+    def __init__(self, fetcher, parse, parse_workers=None, queue_size=64, metrics=None):
+        """ Fetch / parse / write pipeline
+
+        Arguments
+            fetcher:       AsyncFetcher used by the fetch stage
+            parse:         Picklable module-level function run in the parse workers
+            parse_workers: Number of parse processes (default: number of CPUs)
+            queue_size:    Capacity of each hand-off between stages
+            metrics:       Metrics registry receiving the queue depths
+        """
+        self.fetcher = fetcher
+        self.parse = parse
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.metrics = metrics
+
+        self.stats = StageStats()
+        self._executor = None
+
+    def run(self, urls, prepare, write):
+        """ Push the URLs through the pipeline
+
+        Arguments
+            urls:    Feed URLs to crawl
+            prepare: Callable (url, response, error) -> parse arguments tuple, or None to skip
+                     parsing; runs on the dispatcher thread and must not modify shared state
+            write:   Callable (url, response, error, result) run on the calling thread for
+                     every URL; result is the parse output (None if parsing was skipped)
+        """
+        self.stats = StageStats()
+        urls = list(urls)
+        if not urls:
+            return self.stats
+
+        fetched = queue.Queue(maxsize=self.queue_size)
+        parsed = queue.Queue()
+        inflight = threading.BoundedSemaphore(self.queue_size)
+        inflight_count = [0]
+        lock = threading.Lock()
+
+        def gauge(name, depth):
+            if self.metrics is not None:
+                self.metrics.set('pipeline_queue_depth', depth, queue=name)
+
+        def on_fetched(url, response, error):
+            t0 = time.time()
+            fetched.put((url, response, error))
+            self.stats.fetch_blocked += time.time() - t0
+            self.stats.fetched += 1
+            self.stats.fetched_peak = max(self.stats.fetched_peak, fetched.qsize())
+            gauge('fetched', fetched.qsize())
+
+        def fetch_stage():
+            try:
+                self.fetcher.fetch_all(urls, on_fetched)
+            finally:
+                fetched.put(_STOP)
+
+        def finish(url, response, future):
+            try:
+                parsed.put((url, response, None, future.result()))
+            except Exception as e:
+                parsed.put((url, response, e, None))
+
+        def dispatch_stage():
+            while True:
+                item = fetched.get()
+                if item is _STOP:
+                    break
+                url, response, error = item
+
+                t0 = time.time()
+                inflight.acquire()
+                self.stats.parse_blocked += time.time() - t0
+                with lock:
+                    inflight_count[0] += 1
+                    self.stats.inflight_peak = max(self.stats.inflight_peak, inflight_count[0])
+                    gauge('parsing', inflight_count[0])
+
+                args = None
+                if error is None:
+                    try:
+                        args = prepare(url, response, error)
+                    except Exception as e:
+                        error = e
+                if args is None:
+                    parsed.put((url, response, error, None))
+                    continue
+                future = self._executor.submit(self.parse, *args)
+                future.add_done_callback(lambda f, u=url, r=response: finish(u, r, f))
+
+        self._executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+        threads = [threading.Thread(target=fetch_stage, name='fetch'),
+                   threading.Thread(target=dispatch_stage, name='dispatch')]
+        try:
+            for t in threads:
+                t.daemon = True
+                t.start()
+
+            for _ in range(len(urls)):
+                t0 = time.time()
+                url, response, error, result = parsed.get()
+                self.stats.write_idle += time.time() - t0
+                try:
+                    write(url, response, error, result)
+                except Exception as e:
+                    # Keep draining, the upstream stages are blocked on this loop
+                    print("-->Error writing {0}: {1}".format(url, e))
+                if result is None:
+                    self.stats.skipped += 1
+                else:
+                    self.stats.parsed += 1
+                with lock:
+                    inflight_count[0] -= 1
+                    gauge('parsing', inflight_count[0])
+                gauge('fetched', fetched.qsize())
+                gauge('parsed', parsed.qsize())
+                inflight.release()
+        finally:
+            for t in threads:
+                t.join()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        print(self.stats.report(self.queue_size))
+        return self.stats
@@ -0,0 +1,251 @@
+"""
+Per-host politeness
+
+Every host gets a token bucket that paces the requests sent to it, a
+ceiling on concurrent connections and a robots.txt policy (Disallow rules
+and Crawl-delay, fetched once per host and refreshed daily). A 429 or 503
+blocks the host for its Retry-After (or an exponential backoff) and halves
+its request rate; every successful response raises the rate again by a
+small step up to max_rate, so well-behaved hosts are crawled as fast as
+they allow while strict ones settle at the rate they tolerate.
+
+Waiting for a host never blocks other hosts: the fetchers ask ready_in()
+and await / pick another feed, and a host blocked for longer than max_wait
+has its feeds deferred to the next cycle instead of stalling this one.
+
+"""
+from __future__ import absolute_import, print_function
+import time
+import threading
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+from http_client import USER_AGENT
+
+
+class RobotsDisallowed(Exception):
+    """ robots.txt forbids fetching the URL """
+
+
+class HostDeferred(Exception):
+    def __init__(self, url, delay):
+        """ The host of a URL will not take requests for a while
+
+        Arguments
+            url:   URL whose fetch is deferred
+            delay: Seconds before the host takes requests again
+        """
+        Exception.__init__(self, "{0} throttled for {1:.0f}s".format(urlparse(url).netloc, delay))
+        self.url = url
+        self.delay = delay
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now=None):
+        """ Token bucket
+
+        Arguments
+            rate:  Tokens added per second
+            burst: Bucket capacity (requests that may go out back to back)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time() if now is None else now
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def ready_in(self, now):
+        """ Seconds until a token is available """
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Host(object):
+    __slots__ = ('bucket', 'blocked_until', 'backoff', 'robots', 'robots_due', 'max_rate',
+                 'lock')
+
+    def __init__(self, rate, burst, max_rate, now):
+        self.bucket = TokenBucket(rate, burst, now)
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self.robots = None
+        # Time robots.txt is (re)fetched, None: not fetched yet
+        self.robots_due = None
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+
+
+class Politeness(object):
+    def __init__(self, rate=2.0, burst=4, max_rate=10.0, min_rate=0.05, max_per_host=4,
+                 host_connections=None, robots=True, fetch=None, user_agent=USER_AGENT,
+                 min_backoff=30.0, max_backoff=3600.0, max_wait=60.0, robots_ttl=24 * 3600,
+                 robots_retry=300):
+        """ Request pacing of every host
+
+        Arguments
+            rate:             Initial requests per second to a host
+            burst:            Requests that may go out back to back to a host
+            max_rate:         Highest rate a host is raised to while it responds well
+            min_rate:         Lowest rate a throttling host is slowed down to
+            max_per_host:     Concurrent connections to a host
+            host_connections: {host: connections} overriding max_per_host
+            robots:           Honor robots.txt (Disallow and Crawl-delay)
+            fetch:            Callable url -> response used for robots.txt
+            user_agent:       User agent matched against the robots.txt rules
+            min_backoff:      Block of a host after a 429/503 without Retry-After (doubling)
+            max_backoff:      Longest block of a host
+            max_wait:         Longest wait for a host within a crawl; fetches of hosts blocked
+                              for longer are deferred
+            robots_ttl:       Seconds before a host's robots.txt is fetched again
+            robots_retry:     Seconds before a robots.txt that failed (5xx or error) is
+                              fetched again
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_per_host = max_per_host
+        self.host_connections = host_connections or {}
+        self.robots = robots
+        self.fetch = fetch
+        self.user_agent = user_agent
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.robots_ttl = robots_ttl
+        self.robots_retry = robots_retry
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url, now=None):
+        host = urlparse(url).netloc
+        state = self.hosts.get(host)
+        if state is None:
+            with self._lock:
+                state = self.hosts.get(host)
+                if state is None:
+                    now = time.time() if now is None else now
+                    state = _Host(self.rate, self.burst, self.max_rate, now)
+                    self.hosts[host] = state
+        return state
+
+    def max_connections(self, url):
+        """ Concurrent connection ceiling of the host of a URL """
+        return self.host_connections.get(urlparse(url).netloc, self.max_per_host)
+
+    def ready_in(self, url, now=None):
+        """ Seconds before a request may be sent to the host of a URL """
+        now = time.time() if now is None else now
+        state = self._host(url, now)
+        with state.lock:
+            return max(state.blocked_until - now, state.bucket.ready_in(now))
+
+    def take(self, url, now=None):
+        """ Spend the token of a request to the host of a URL """
+        now = time.time() if now is None else now
+        state = self._host(url, now)
+        with state.lock:
+            state.bucket.take(now)
+
+    def acquire(self, url):
+        """ Take a token if the host is ready
+
+        Return
+            0 when the request may go, or the seconds to wait before asking again
+
+        Raise
+            HostDeferred if the host is blocked for longer than max_wait
+        """
+        delay = self.ready_in(url)
+        if delay <= 0:
+            self.take(url)
+            return 0.0
+        if delay > self.max_wait:
+            raise HostDeferred(url, delay)
+        return delay
+
+    def wait(self, url):
+        """ Block until a request may be sent to the host of a URL (sequential scripts) """
+        while True:
+            delay = self.ready_in(url)
+            if delay <= 0:
+                self.take(url)
+                return
+            time.sleep(delay)
+
+    def allowed(self, url):
+        """ Whether robots.txt lets us fetch a URL (loads the host's robots.txt when due) """
+        if not self.robots or self.fetch is None:
+            return True
+        state = self._host(url)
+        now = time.time()
+        if state.robots_due is None or now >= state.robots_due:
+            self._load_robots(url, state, now)
+        return state.robots is None or state.robots.can_fetch(self.user_agent, url)
+
+    def _load_robots(self, url, state, now):
+        parts = urlparse(url)
+        robots_url = '{0}://{1}/robots.txt'.format(parts.scheme, parts.netloc)
+        parser = None
+        failed = False
+        try:
+            response = self.fetch(robots_url)
+            if 200 <= response.status_code < 300:
+                parser = RobotFileParser(robots_url)
+                parser.parse(response.text.splitlines())
+            # 4xx: no rules; 5xx: failed like an error
+            failed = response.status_code >= 500
+        except Exception as e:
+            print("-->Failed to fetch {0}: {1}".format(robots_url, e))
+            failed = True
+        with state.lock:
+            if failed:
+                # Keep the rules we had (if any) and try again soon rather than in robots_ttl
+                state.robots_due = now + self.robots_retry
+                return
+            state.robots = parser
+            state.robots_due = now + self.robots_ttl
+            state.max_rate = self.max_rate
+            if parser is not None:
+                delay = parser.crawl_delay(self.user_agent)
+                rate = parser.request_rate(self.user_agent)
+                if delay:
+                    state.max_rate = min(state.max_rate, 1.0 / float(delay))
+                if rate and rate.seconds:
+                    state.max_rate = min(state.max_rate, rate.requests / float(rate.seconds))
+                if state.max_rate < self.max_rate:
+                    # Crawl-delay means one request at a time
+                    state.bucket.rate = min(state.bucket.rate, state.max_rate)
+                    state.bucket.burst = 1
+                    state.bucket.tokens = min(state.bucket.tokens, 1)
+
+    def observe(self, url, status, retry_after=None, now=None):
+        """ Adapt the pace of a host to one of its responses
+
+        Arguments
+            url:         URL fetched
+            status:      HTTP status of the response
+            retry_after: Seconds requested by a Retry-After header
+        """
+        now = time.time() if now is None else now
+        state = self._host(url, now)
+        with state.lock:
+            bucket = state.bucket
+            if status in (429, 503):
+                state.backoff = min(self.max_backoff,
+                                    state.backoff * 2 if state.backoff else self.min_backoff)
+                state.blocked_until = max(state.blocked_until,
+                                          now + (retry_after if retry_after else state.backoff))
+                bucket.rate = max(self.min_rate, bucket.rate / 2)
+                bucket.tokens = min(bucket.tokens, 0)
+            elif status is not None and status < 400:
+                state.backoff = 0.0
+                # Additive increase: about doubles the rate over 10 * rate / base successes
+                bucket.rate = min(state.max_rate, bucket.rate + 0.1 * self.rate)
@@ -0,0 +1,411 @@
+"""
+Raw feed response cache
+
+Keeps the raw body of every fetched feed so that the archive can be rebuilt
+after a change of the parsing or cleaning logic without crawling again.
+Bodies are stored once per content hash (the same SHA-1 as the feed state),
+zlib-compressed, under objects/<2 hex>/<38 hex>; fetches.jsonl logs every
+fetch that returned a new body for its feed (time, URL, source, category,
+validators, hash) in crawl order. An unchanged body is not logged again: the
+crawl would skip it too. Feeds parsed while they download are still read to
+the end when the cache is on, so that their whole body is kept; such a body
+is compressed into tmp/ as it arrives and renamed to its content address
+once complete, never held in memory whole.
+
+The cache is bounded: bodies not fetched or replayed for max_age seconds are
+dropped, then the least recently used ones until the cache fits in
+max_bytes, and the log entries of dropped bodies go with them.
+
+Replay runs the logged fetches through the crawler's parse -> normalize ->
+persist path with no network (see RSSCrawler.replay), which also makes the
+cache a realistic offline benchmark corpus.
+
+Usage
+    python response_cache.py stats <cache path>
+    python response_cache.py evict <cache path> [--max-mb 1024] [--max-days 30]
+    python response_cache.py replay <cache path> <data path> [--segments]
+                             [--parse-workers N] [--since <epoch>] [--until <epoch>]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import tempfile
+import threading
+from fsutil import atomic_write
+
+
+LOG_FILE = 'fetches.jsonl'
+BLOBS_FILE = 'blobs.json'
+OBJECTS_DIR = 'objects'
+TMP_DIR = 'tmp'
+# Response headers replayed with the body
+HEADERS = ('ETag', 'Last-Modified', 'Content-Type')
+
+
+class BodyWriter(object):
+    def __init__(self, level=6):
+        """ Hash of a body held in memory, compressed only if the cache lacks it """
+        self.level = level
+        self._sha1 = hashlib.sha1()
+        self._parts = []
+        self.size = 0
+
+    def update(self, chunk):
+        self._sha1.update(chunk)
+        self._parts.append(chunk)
+        self.size += len(chunk)
+        return self
+
+    def digest(self):
+        return self._sha1.hexdigest()
+
+    def store(self, path):
+        """ Write the compressed body to path, return its compressed size """
+        data = zlib.compress(b''.join(self._parts), self.level)
+        with atomic_write(path, 'wb') as f:
+            f.write(data)
+        return len(data)
+
+    def discard(self):
+        self._parts = []
+
+
+class SpooledBodyWriter(BodyWriter):
+    def __init__(self, tmp_dir, level=6):
+        """ Hash and compress a body into a temporary file as its chunks arrive, so that a
+        streamed feed is never held in memory whole """
+        super(SpooledBodyWriter, self).__init__(level)
+        fd, self.tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix='body.')
+        self._file = os.fdopen(fd, 'wb')
+        self._compressor = zlib.compressobj(level)
+
+    def update(self, chunk):
+        self._sha1.update(chunk)
+        self._file.write(self._compressor.compress(chunk))
+        self.size += len(chunk)
+        return self
+
+    def store(self, path):
+        """ Move the compressed body to path, return its compressed size """
+        self._file.write(self._compressor.flush())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmp_path, path)
+        return os.path.getsize(path)
+
+    def discard(self):
+        """ Drop the temporary file (the body is stored already, or not wanted) """
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class CachedResponse(object):
+    def __init__(self, entry, content):
+        """ A logged fetch standing in for its HTTP response in a replay
+
+        Arguments
+            entry:   Log entry of the fetch
+            content: Raw body
+        """
+        self.status_code = 200
+        self.headers = entry['headers']
+        self.content = content
+        self.url = entry['url']
+
+
+class ReplayFetcher(object):
+    def __init__(self, cache, entries):
+        """ Stands in for AsyncFetcher in the crawl pipeline, serving logged fetches
+
+        Arguments
+            cache:   ResponseCache holding the bodies
+            entries: Log entries to replay, in order
+        """
+        self.cache = cache
+        self.entries = entries
+        self.served = 0
+
+    def fetch_all(self, urls, callback):
+        """ Hand every logged fetch to the callback, like a fetch of its URL
+
+        urls is ignored (the entries are replayed); the callback is invoked once per entry,
+        with an error if its body was evicted meanwhile.
+        """
+        for entry in self.entries:
+            content = self.cache.get(entry['digest'])
+            if content is None:
+                callback(entry['url'], None, IOError("body evicted from the response cache"))
+                continue
+            self.served += 1
+            callback(entry['url'], CachedResponse(entry, content), None)
+
+
+class ResponseCache(object):
+    def __init__(self, path, max_bytes=1 << 30, max_age=30 * 24 * 3600, level=6):
+        """ Content-addressed store of raw feed bodies
+
+        Arguments
+            path:      Cache directory
+            max_bytes: Compressed size the cache is evicted down to
+            max_age:   Bodies neither fetched nor replayed for this long are dropped (seconds)
+            level:     zlib compression level
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.level = level
+        # {digest: [compressed size, last used]}
+        self.blobs = {}
+        # Last logged digest of every feed
+        self.last = {}
+        self.size = 0
+        self.dirty = False
+        self._log = None
+        self._lock = threading.Lock()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, OBJECTS_DIR, digest[:2], digest[2:])
+
+    def open(self):
+        """ Load the blob table and the fetch log, and open the log for appending """
+        if not os.path.isdir(os.path.join(self.path, OBJECTS_DIR)):
+            os.makedirs(os.path.join(self.path, OBJECTS_DIR))
+        # Bodies being downloaded when the crawler stopped
+        tmp_dir = os.path.join(self.path, TMP_DIR)
+        if os.path.isdir(tmp_dir):
+            for name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, name))
+        else:
+            os.makedirs(tmp_dir)
+        blobs_path = os.path.join(self.path, BLOBS_FILE)
+        if os.path.isfile(blobs_path):
+            with open(blobs_path, 'r') as f:
+                self.blobs = json.load(f)
+        else:
+            self.blobs = self._scan()
+        for entry in self.entries():
+            digest = entry['digest']
+            self.last[entry['url']] = digest
+            if digest not in self.blobs and os.path.isfile(self._blob_path(digest)):
+                # Stored after the last save of the blob table
+                self.blobs[digest] = [os.path.getsize(self._blob_path(digest)), entry['time']]
+                self.dirty = True
+        self.size = sum(size for size, _ in self.blobs.values())
+        self._log = open(os.path.join(self.path, LOG_FILE), 'a')
+        print("Opened response cache of {0} bodies ({1:.1f} MB)".format(len(self.blobs),
+                                                                        self.size / 1e6))
+        return self
+
+    def _scan(self):
+        """ Blob table rebuilt from the objects on disk """
+        blobs = {}
+        objects = os.path.join(self.path, OBJECTS_DIR)
+        for prefix in os.listdir(objects):
+            for name in os.listdir(os.path.join(objects, prefix)):
+                if name.startswith('.'):
+                    continue
+                st = os.stat(os.path.join(objects, prefix, name))
+                blobs[prefix + name] = [st.st_size, st.st_mtime]
+        return blobs
+
+    def put(self, url, source, category, headers, body):
+        """ Store the body of a fetch (see commit) """
+        return self.commit(url, source, category, headers,
+                           BodyWriter(self.level).update(body))
+
+    def writer(self):
+        """ Writer of a body read in chunks, to commit() once complete (or discard()) """
+        return SpooledBodyWriter(os.path.join(self.path, TMP_DIR), self.level)
+
+    def commit(self, url, source, category, headers, writer, now=None):
+        """ Store a body and log its fetch
+
+        Arguments
+            url:      Feed URL
+            source:   Source name
+            category: Category name
+            headers:  Response headers
+            writer:   BodyWriter (or SpooledBodyWriter) fed with the whole body
+
+        Return
+            Content hash of the body
+        """
+        now = time.time() if now is None else now
+        digest = writer.digest()
+        with self._lock:
+            blob = self.blobs.get(digest)
+            if blob is None:
+                path = self._blob_path(digest)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                size = writer.store(path)
+                self.blobs[digest] = [size, now]
+                self.size += size
+            else:
+                # Most fetches return a body already stored
+                writer.discard()
+                blob[1] = now
+            self.dirty = True
+            if self.last.get(url) == digest:
+                return digest
+            self.last[url] = digest
+            entry = {'time': now, 'url': url, 'source': source, 'category': category,
+                     'headers': dict((h, headers[h]) for h in HEADERS if headers.get(h)),
+                     'digest': digest, 'size': writer.size}
+            self._log.write(json.dumps(entry) + '\n')
+            self._log.flush()
+        return digest
+
+    def get(self, digest):
+        """ Raw body of a content hash (None if it was evicted) """
+        try:
+            with open(self._blob_path(digest), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        with self._lock:
+            if digest in self.blobs:
+                self.blobs[digest][1] = time.time()
+                self.dirty = True
+        return zlib.decompress(data)
+
+    def has(self, digest):
+        """ Whether the body of a content hash is stored """
+        return digest in self.blobs or os.path.isfile(self._blob_path(digest))
+
+    def entries(self, since=None, until=None):
+        """ Logged fetches in crawl order, between two times (epoch seconds) """
+        log_path = os.path.join(self.path, LOG_FILE)
+        if not os.path.isfile(log_path):
+            return
+        with open(log_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line of a crash
+                    continue
+                if since is not None and entry['time'] < since:
+                    continue
+                if until is not None and entry['time'] >= until:
+                    continue
+                yield entry
+
+    def evict(self, now=None):
+        """ Drop the bodies over max_age, then the least recently used over max_bytes
+
+        Return
+            Number of bodies dropped
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            order = sorted(self.blobs, key=lambda d: self.blobs[d][1])
+            dropped = set()
+            size = self.size
+            for digest in order:
+                blob_size, used = self.blobs[digest]
+                if (self.max_age and now - used > self.max_age) or \
+                        (self.max_bytes and size > self.max_bytes):
+                    dropped.add(digest)
+                    size -= blob_size
+                else:
+                    break
+            if not dropped:
+                return 0
+            for digest in dropped:
+                del self.blobs[digest]
+                try:
+                    os.remove(self._blob_path(digest))
+                except OSError:
+                    pass
+            self.size = size
+            self.dirty = True
+            # Keep the log entries of the remaining bodies
+            self._log.close()
+            log_path = os.path.join(self.path, LOG_FILE)
+            with atomic_write(log_path) as f:
+                for entry in self.entries():
+                    if entry['digest'] not in dropped:
+                        f.write(json.dumps(entry) + '\n')
+            self._log = open(log_path, 'a')
+            for url in [u for u in self.last if self.last[u] in dropped]:
+                del self.last[url]
+        print("Evicted {0} bodies from the response cache ({1:.1f} MB left)"
+              .format(len(dropped), self.size / 1e6))
+        return len(dropped)
+
+    def save(self):
+        """ Evict what is over the bounds and write the blob table if anything changed """
+        self.evict()
+        if not self.dirty:
+            return
+        with self._lock:
+            with atomic_write(os.path.join(self.path, BLOBS_FILE)) as f:
+                json.dump(self.blobs, f)
+            self.dirty = False
+
+    def close(self):
+        self.save()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Raw feed response cache tools")
+    sub = parser.add_subparsers(dest='command')
+    stats_cmd = sub.add_parser('stats', help="Size of the cache")
+    stats_cmd.add_argument('cache_path')
+    evict_cmd = sub.add_parser('evict', help="Evict the cache down to its bounds")
+    evict_cmd.add_argument('cache_path')
+    evict_cmd.add_argument('--max-mb', type=float, default=1024)
+    evict_cmd.add_argument('--max-days', type=float, default=30)
+    replay_cmd = sub.add_parser('replay', help="Rebuild an archive from the cached fetches")
+    replay_cmd.add_argument('cache_path')
+    replay_cmd.add_argument('data_path')
+    replay_cmd.add_argument('--segments', action='store_true', help="Segment storage, not XML")
+    replay_cmd.add_argument('--parse-workers', type=int, default=0)
+    replay_cmd.add_argument('--since', type=float)
+    replay_cmd.add_argument('--until', type=float)
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        cache = ResponseCache(args.cache_path).open()
+        raw = sum(entry['size'] for entry in cache.entries())
+        print("{0} fetches logged, {1} bodies, {2:.1f} MB compressed ({3:.1f} MB logged raw)"
+              .format(len(list(cache.entries())), len(cache.blobs), cache.size / 1e6, raw / 1e6))
+        cache.close()
+    elif args.command == 'evict':
+        cache = ResponseCache(args.cache_path, max_bytes=int(args.max_mb * 1e6),
+                              max_age=args.max_days * 24 * 3600).open()
+        cache.close()
+    elif args.command == 'replay':
+        from rss_crawler import RSSCrawler
+        from storage import SegmentStorage
+
+        storage = SegmentStorage(args.data_path) if args.segments else None
+        crawler = RSSCrawler(args.data_path, storage=storage)
+        # Replaying must not evict what it reads
+        cache = ResponseCache(args.cache_path, max_bytes=0, max_age=0).open()
+        t0 = time.time()
+        num_fetches, num_new = crawler.replay(cache, since=args.since, until=args.until,
+                                              parse_workers=args.parse_workers)
+        print("Replayed {0} fetches, {1} new entries in {2:.1f}s"
+              .format(num_fetches, num_new, time.time() - t0))
+        cache.close()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,23 +9,149 @@ from __future__ import absolute_import, print_function
 import os
 import csv
 import time
-import requests
+from discovery import FeedDiscovery
 import feedparser
-import xml.etree.ElementTree as ET
-import mysql.connector as mdb
-from bs4 import BeautifulSoup
+from fetcher import AsyncFetcher
+from http_client import HTTPClient
+from feed_state import FeedStateStore, content_hash
+from feed_health import FeedHealth
+from dedup_index import DedupIndex
+from near_dup import NearDupIndex
+from search_index import SearchIndex
+from journal import CrawlJournal
+from politeness import Politeness, HostDeferred, RobotsDisallowed
+from storage import open_storage
+from db_sink import MySQLSink
+from scheduler import FeedScheduler, feed_min_interval, parse_retry_after
+from pipeline import CrawlPipeline
+from entry_normalizer import normalize_feed
+from feed_stream import StreamedFeed, stream_feed, CHUNK_SIZE
+from response_cache import ResponseCache, ReplayFetcher
+from metrics import StageTimer, Metrics, MetricsServer, SnapshotWriter, EventLog, SIZE_BUCKETS
+from date_normalizer import register_feedparser
+
+
+register_feedparser(feedparser)
+
+# Per-entry feed problems, rate-limited
+log = EventLog()
+
+# Feeds kept for the search index while it fails to take them
+SEARCH_BACKLOG = 1000
+
+
+def describe_metrics(metrics):
+    """ Help texts and buckets of the crawler metrics """
+    metrics.describe('feed_fetches_total', "Feed fetches by feed and HTTP status")
+    metrics.describe('http_responses_total', "HTTP responses by status")
+    metrics.describe('feed_bytes_total', "Bytes downloaded by feed")
+    metrics.describe('fetch_bytes', "Size of fetched feed bodies", buckets=SIZE_BUCKETS)
+    metrics.describe('fetch_latency_seconds', "Feed fetch latency by source")
+    metrics.describe('feed_fetch_seconds_total', "Wall-clock fetch time by feed")
+    metrics.describe('parse_seconds', "CPU time parsing and cleaning one feed, by source")
+    metrics.describe('feed_cpu_seconds_total', "Parse and clean CPU time by feed")
+    metrics.describe('fetches_deferred_total', "Feed fetches put off while their host is "
+                                               "throttled, by source")
+    metrics.describe('entries_total', "Feed entries by feed and kind (seen, new, duplicate, "
+                                      "near_duplicate)")
+    metrics.describe('feeds_quarantined', "Feeds quarantined by the circuit breaker")
+    metrics.describe('parse_events_total', "Feed problems found while parsing, by event")
+    metrics.describe('db_write_seconds', "Latency of one database flush")
+    metrics.describe('db_rows_total', "Rows written to the database")
+    metrics.describe('pipeline_queue_depth', "Items waiting in a pipeline hand-off")
+    metrics.describe('stage_cpu_seconds_total', "CPU time by crawl stage")
+
+
+def parse_feed(source, category, content, text_mode='ascii', seen=None):
+    """ Parse a feed body into the records of its entries
+
+    Module-level so that it can run in the parse worker processes.
+
+    Arguments
+        source:    Source name
+        category:  Category name
+        content:   Raw feed body
+        text_mode: Character normalization of titles and summaries (see text_cleaner)
+        seen:      Callable (uid, title) -> bool; entries already stored are not built
+
+    Return
+        (shortest polling interval asked by the feed, list of entry records,
+         {stage: CPU seconds} of the 'parse' and 'clean' stages,
+         {event: count} of the entries seen, already known and the problems found)
+    """
+    t0 = time.thread_time()
+    # Remove leading newlines (BetaKit XML feed), no copy when there are none
+    content = content.lstrip()
+
+    res = feedparser.parse(content)
+    t_parse = time.thread_time() - t0
+    t0 = time.thread_time()
+
+    events = {'seen': len(res.entries), 'known': 0}
+    records = normalize_feed(res, source, category, text_mode, seen, events, log)
+    t_clean = time.thread_time() - t0
+    return (feed_min_interval(res.feed), records, {'parse': t_parse, 'clean': t_clean},
+            events)
 
 
 class RSSCrawler(object):
-    def __init__(self, data_path):
+    def __init__(self, data_path, storage=None, db=None, text_mode='ascii', http=None,
+                 shard=None, near_dup=None, search=False, politeness=None, cache=False):
         """ RSS feed crawler
 
         Arguments
-            data_path: Path of XML data directory
+            data_path: Path of data directory
+            storage:   Storage backend of the entries, or 'segment' / 'xml' for that storage
+                       of data_path (default: see storage.open_storage)
+            db:        Database sink of the entries (default: MySQLSink when run with to_db)
+            text_mode: Character normalization of titles and summaries ('ascii' drops
+                       non-ASCII characters, 'translit' / 'NFC' / ... see text_cleaner)
+            http:      Shared HTTPClient of feeds and discovery (default: pooled HTTP/1.1)
+            shard:     ShardCoordinator; the crawler then only crawls the feeds of its shard
+                       and keeps its archives and state in data_path/shards/<member id>
+            near_dup:  Cluster near-duplicate stories across sources: 'tag' stores every entry
+                       with its cluster id (the 'cluster' field of the archive), 'collapse'
+                       only stores the first of a cluster
+                       (default: exact dedup per feed only)
+            search:    Index the titles and summaries of the stored entries for search
+                       (data_path/search, see search_index)
+            politeness: Politeness pacing the requests of every host (default: token
+                        buckets of 2 requests/s per host honoring robots.txt, 429 and 503)
+            cache:     Keep the raw body of every fetched feed for replay()
+                       (data_path/responses, see response_cache)
         """
         assert isinstance(data_path, str)
 
-        self.root_path = data_path
+        self.shard = shard
+        self.root_path = shard.partition_path(data_path) if shard else data_path
+        if storage is None or isinstance(storage, str):
+            storage = open_storage(self.root_path, storage)
+        self.storage = storage
+        self.db = db
+        self.http = http or HTTPClient()
+        self.scheduler = FeedScheduler()
+        self.politeness = politeness or Politeness()
+        if self.politeness.fetch is None:
+            self.politeness.fetch = self.http.get
+        self.text_mode = text_mode
+        self.metrics = Metrics()
+        describe_metrics(self.metrics)
+        self.timer = StageTimer(self.metrics)
+        self.num_new = 0
+        self.fetcher = None
+        self.pipeline = None
+        self.stream_threshold = 0
+        # Feeds whose body went over stream_threshold, and those the stream parser failed on
+        self.large_feeds = set()
+        self.unstreamable = set()
+        self.journal = None
+        # Seconds / feeds between two saves of the crawl state by crawl() (0: every crawl)
+        self.checkpoint_interval = 0
+        self.checkpoint_feeds = 0
+        self._last_checkpoint = time.time()
+        self._unsaved_feeds = 0
+        self.started = None
+        self.deadline = None
 
         self.targets = {'reuters_us':       'https://www.reuters.com/tools/rss',
                         'reuters_uk':       'https://uk.reuters.com/tools/rss',
@@ -42,74 +168,41 @@ class RSSCrawler(object):
                         'https://techcrunch.com/tag/fintech/feed/': ('techcrunch', 'FinTech'),
                         'https://news.google.com/news?cf=all&hl=en&pz=1&ned=us&q='
                         'fintech&output''=rss': ('google_news', 'FinTech')}
+        # Feeds kept in the registry whatever discovery finds
+        self.seeds = dict(self.sources)
+        self.discovery = None
 
         self.xml_list = []
-
-    def extract_url(self, csv_path):
-        """ Web scrape RSS feeds URLs and save to CSV (run only once in the first time)
+        self.feed_state = FeedStateStore(os.path.join(self.root_path, 'feed_state.csv'))
+        self.dedup = DedupIndex(os.path.join(self.root_path, 'dedup.idx')).load()
+        self.health = FeedHealth(os.path.join(self.root_path, 'feed_health.csv')).load()
+        self.near_dup = None
+        if near_dup:
+            self.near_dup = NearDupIndex(os.path.join(self.root_path, 'near_dup.idx'),
+                                         collapse=(near_dup == 'collapse')).load()
+        self.search = SearchIndex(os.path.join(self.root_path, 'search')).open() if search else None
+        self.search_backlog = []
+        self.cache = None
+        if cache:
+            self.cache = ResponseCache(os.path.join(self.root_path, 'responses')).open()
+
+    def extract_url(self, csv_path, max_age=None):
+        """ Web scrape RSS feeds URLs and save to CSV
 
         Arguments
             csv_path: Path of the CSV stored the feed URLs
+            max_age:  Re-discover the sites scraped more than max_age seconds ago
+                      (None: only discover when the CSV does not exist yet)
         """
         assert isinstance(csv_path, str)
 
-        if os.path.isfile(csv_path):
+        self.feed_state.load(self._state_path(csv_path))
+        self.discovery = FeedDiscovery(self.targets, csv_path, fetch=self.http.get)
+        if os.path.isfile(csv_path) and max_age is None:
             print("URL CSV already exits")
             return self.load_url(csv_path)
 
-        for source in self.targets:
-            try:
-                res = requests.get(self.targets[source])
-                assert res.status_code == 200
-            except AssertionError:
-                print("Cannot connect to {}, try again later".format(self.targets[source]))
-                continue
-            soup = BeautifulSoup(res.content, 'lxml')
-
-            groups = None
-            has_str = True
-            has_cls = False
-
-            if source == 'associated_press':
-                groups = soup.find_all('div', 'rssmTblFrm', limit=1)
-                has_cls = True
-            elif source == 'nytimes':
-                groups = soup.find_all('div', 'columnGroup doubleRule', limit=1)
-                has_str = False
-            elif source == 'finextra':
-                groups = soup.find_all('table', limit=1)
-            elif 'reuters' in source:
-                groups = soup.find_all('div', 'module', limit=3)
-                groups = groups[1:]
-
-            for gp in groups:
-                if source == 'finextra':
-                    tags = gp.find_all('tr')
-                else:
-                    tags = gp.find_all('a', attrs={'href': True, 'class': has_cls}, string=has_str)
-                if tags:
-                    for t in tags:
-                        if source == 'finextra':
-                            td = t.find_all('td', limit=2)
-                            category = td[0].get_text()
-                            link = td[1].find('a').get('href')
-                        else:
-                            s = t.get_text().replace('\n', '').replace('/', '')
-                            category = s.replace("'", '').replace('"', '').strip()
-                            link = t.get('href')
-                        # Update URL dictionary
-                        self.sources[link] = (source, category)
-                else:
-                    print("-->No target tag found!")
-
-            with open(csv_path, 'w') as f:
-                writer = csv.DictWriter(f, fieldnames=['URL', 'Source', 'Category'])
-                writer.writeheader()
-                for url in self.sources:
-                    writer.writerow({'URL': url,
-                                     'Source': self.sources[url][0],
-                                     'Category': self.sources[url][1]})
-
+        self.sources, _, _ = self.discovery.refresh(max_age or 0, seeds=self.seeds)
         print("Found {} URls".format(len(self.sources)))
         return
 
@@ -121,6 +214,7 @@ class RSSCrawler(object):
         """
         assert isinstance(csv_path, str)
 
+        self.feed_state.load(self._state_path(csv_path))
         if os.path.isfile(csv_path):
             with open(csv_path, 'r') as f:
                 reader = csv.DictReader(f)
@@ -130,6 +224,17 @@ class RSSCrawler(object):
         else:
             print("-->CSV path invalid!")
 
+    def _state_path(self, csv_path):
+        """ Feed state next to the URL CSV, or in the partition of a shard """
+        state_dir = self.root_path if self.shard else os.path.dirname(csv_path)
+        return os.path.join(state_dir, 'feed_state.csv')
+
+    def assigned(self):
+        """ The feed URLs this crawler is responsible for """
+        if self.shard is None:
+            return list(self.sources)
+        return self.shard.assigned(self.sources)
+
     def load_xml(self):
         self.xml_list = [os.path.join(root, f)
                          for root, _, files in os.walk(self.root_path)
@@ -137,241 +242,673 @@ class RSSCrawler(object):
                          if f.endswith('.xml')]
         return self.xml_list
 
-    def run(self, timeout, to_db=True):
+    def run(self, timeout, to_db=True, max_concurrency=0, max_per_host=4, interval=300,
+            adaptive=True, parse_workers=0, queue_size=64, discover_interval=0, metrics_port=0,
+            metrics_snapshot=None, snapshot_interval=60, resume=False,
+            stream_threshold=1024 * 1024, checkpoint_interval=60, checkpoint_feeds=500):
         """ Scraper
 
         Arguments
-            timeout: Running period
-            to_db:   Load to database
+            timeout:         Running period
+            to_db:           Load to database
+            max_concurrency: Number of feeds fetched concurrently (0: one at a time)
+            max_per_host:    Number of feeds fetched concurrently from the same host
+            interval:        Initial polling interval of every feed (seconds)
+            adaptive:        Adapt the polling interval of each feed to its update rate
+                             (False: poll every feed every interval)
+            parse_workers:   Number of parse processes fed by the fetchers (0: parse on the
+                             fetching thread); requires max_concurrency > 0
+            queue_size:      Capacity of the hand-offs between pipeline stages
+            discover_interval: Re-discover the feed URLs of the target sites every
+                             discover_interval seconds (0: never; needs extract_url first)
+            metrics_port:    Serve Prometheus metrics on this local port (0: no endpoint)
+            metrics_snapshot: Write a JSON snapshot of the metrics to this path
+            snapshot_interval: Seconds between two metrics snapshots
+            resume:          Continue the run recorded in the crawl journal (same deadline,
+                             schedule, validators and dedup state) instead of starting anew;
+                             a new run still keeps the validators and dedup state journaled
+            stream_threshold: Parse feeds of more than this many bytes while they download,
+                             stopping at the first known entries (0: never)
+            checkpoint_interval: Save the indexes and the feed state at most every
+                             checkpoint_interval seconds (the crawl journal covers the
+                             feeds in between)
+            checkpoint_feeds: ... or once this many feeds were crawled since the last save
         """
         # timeout = float(input("Please enter timeout period (day): "))
         timeout = float(timeout) * 3600 * 24
         time_start = time.time()
         time_end = time_start + timeout
+        self.journal = CrawlJournal(os.path.join(self.root_path, 'journal'))
+        self.scheduler = FeedScheduler(interval=interval, adaptive=adaptive)
+        if resume and self._resume():
+            time_start, time_end = self.started, self.deadline
+        else:
+            # A new run drops the old schedule and deadline, not what was stored under them
+            self._recover()
+            self.journal.reset()
+            self.started, self.deadline = time_start, time_end
         asctime_end = time.asctime(time.localtime(time_end))
         print("\nStarted at:", time.asctime(time.localtime(time_start)))
-        print("Running for: {} min".format(timeout / 60))
+        print("Running for: {} min".format((time_end - time_start) / 60))
         print("Terminated at:", asctime_end)
 
+        if to_db and self.db is None:
+            self.db = MySQLSink(host='localhost',
+                                user='root',
+                                password='yaochen',
+                                database='test_db_rss')
+            self.db.ensure_unique_uid()
+        elif not to_db:
+            self.db = None
+
+        self.configure(max_concurrency=max_concurrency, max_per_host=max_per_host,
+                       parse_workers=parse_workers, queue_size=queue_size,
+                       stream_threshold=stream_threshold)
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_feeds = checkpoint_feeds
+        server = MetricsServer(self.metrics, port=metrics_port).start() if metrics_port else None
+        snapshots = None
+        if metrics_snapshot:
+            snapshots = SnapshotWriter(self.metrics, metrics_snapshot, snapshot_interval).start()
+        try:
+            self._loop(time_start, time_end, discover_interval)
+        finally:
+            self._persist(force=True)
+            self.journal.close()
+            if self.shard is not None:
+                # Hand our feeds over to the other shards now rather than after the TTL
+                self.shard.leave()
+            if server is not None:
+                server.stop()
+            if snapshots is not None:
+                snapshots.stop()
+            if self.db is not None:
+                self.db.close()
+        self.report_budget()
+        self.health.report(self.sources)
+
+    def _loop(self, time_start, time_end, discover_interval):
+        """ Crawl the feeds as they fall due until time_end (see run()) """
+        if self.shard is not None:
+            self.shard.refresh()
+        self._rebalance()
+        self.journal.checkpoint(self._run_state())
+
+        next_discovery = time_start + discover_interval
         while time.time() < time_end:
+            if discover_interval > 0 and self.discovery is not None and \
+                    time.time() >= next_discovery:
+                self._rediscover(discover_interval)
+                next_discovery = time.time() + discover_interval
+            if self.shard is not None and self.shard.refresh():
+                self._rebalance()
+
+            urls = self.scheduler.pop_due()
+            if not urls:
+                next_due = self.scheduler.next_due()
+                if next_due is None and self.shard is None:
+                    break
+                if next_due is None:
+                    # No feed on this shard for now, wait for the membership to change
+                    next_due = time_end
+                if discover_interval > 0 and self.discovery is not None:
+                    next_due = min(next_due, next_discovery)
+                if self.shard is not None:
+                    next_due = min(next_due, self.shard.last_heartbeat +
+                                   self.shard.heartbeat_interval)
+                wait = min(next_due, time_end) - time.time()
+                if wait > 0:
+                    if self._unsaved_feeds and wait > self.checkpoint_interval:
+                        # Nothing to crawl for a while, save what is pending now
+                        self._persist(force=True)
+                    print("Now: {0}, next feed due in {1:.1f} min"
+                          .format(time.asctime(time.localtime()), wait / 60))
+                    time.sleep(wait)
+                continue
+
             time_left = (time_end - time.time()) / 60
-            print("\nStarting crawler, time remaining: {:.1f} min ({:.1f} hrs)"
-                  .format(time_left, time_left / 60))
-            if to_db:
-                try:
-                    print("Connecting to database...")
-                    cnx = mdb.connect(host='localhost',
-                                      user='root',
-                                      password='yaochen',
-                                      database='test_db_rss')
-                    cursor = cnx.cursor()
-                except Exception as e:
-                    print("-->Error: {}".format(e.args[1]))
-                    print("-->Reconnecting in 30s...")
-                    time.sleep(30)
-                    continue
+            print("\nCrawling {0} feeds, time remaining: {1:.1f} min ({2:.1f} hrs)"
+                  .format(len(urls), time_left, time_left / 60))
+            self.crawl(urls)
+
+        print("Terminated at:", time.asctime(time.localtime()))
+        self.http.close()
+
+    def report_budget(self, n=5):
+        """ Print the feeds that took the most fetch time and parse CPU """
+        for name, label in (('feed_fetch_seconds_total', 'fetch time'),
+                            ('feed_cpu_seconds_total', 'parse CPU')):
+            top = self.metrics.top(name, n)
+            if top:
+                print("Top {0} feeds by {1}:".format(len(top), label))
+                for labels, value in top:
+                    print("    {0:8.2f}s  {1} ({2})".format(value, labels['source'],
+                                                          labels['category']))
+
+    def configure(self, max_concurrency=0, max_per_host=4, parse_workers=0, queue_size=64,
+                  stream_threshold=1024 * 1024):
+        """ Choose how crawl() fetches and parses (see run() for the arguments) """
+        self.fetcher, self.pipeline = None, None
+        self.stream_threshold = stream_threshold
+        # Keep a pooled connection for every concurrent fetch to a host
+        if self.http.pool_maxsize < max_per_host:
+            self.http.close()
+            self.http = HTTPClient(pool_maxsize=max_per_host, http2=self.http.http2)
+            if self.discovery is not None:
+                self.discovery.fetch = self.http.get
+            self.politeness.fetch = self.http.get
+        self.politeness.max_per_host = max_per_host
+        if max_concurrency > 0:
+            self.fetcher = AsyncFetcher(max_concurrency=max_concurrency,
+                                        max_per_host=max_per_host, fetch=self._fetch,
+                                        politeness=self.politeness)
+            if parse_workers > 0:
+                self.pipeline = CrawlPipeline(self.fetcher, parse_feed,
+                                              parse_workers=parse_workers,
+                                              queue_size=queue_size, metrics=self.metrics)
+
+    def crawl(self, urls=None):
+        """ Fetch and process feeds once
 
-            for url in self.sources:
-                num_update = 0
-                # Unpack sources dictionary entry
-                source, category = self.sources[url]
-                # print(category, src)
-                try:
-                    # print("Connecting to {} ({})".format(src, category))
-                    response = requests.get(url)
-                    # assert response.status_code == 200
-                except Exception:
-                    print("-->Failed to connect to {0} ({1}), try again later"
-                          .format(source, category))
-                    time.sleep(5)
-                    continue
+        Arguments
+            urls: Feed URLs to crawl (default: every source)
+
+        Return
+            Number of new entries stored
+        """
+        urls = self.assigned() if urls is None else urls
+        self.num_new = 0
+        # Quarantined feeds are only fetched when their probe is due
+        now = time.time()
+        due = []
+        for url in urls:
+            if self.health.due(url, now):
+                due.append(url)
+            elif url in self.scheduler.feeds:
+                self._probe_later(url)
+        urls = due
+        if self.pipeline is not None:
+            self.pipeline.run(urls, self._prepare, self._write)
+        elif self.fetcher is not None:
+            self._crawl_async(self.fetcher, urls)
+        else:
+            self._crawl_serial(urls)
+        # Entries the search index or the database failed to take, even if no feed changed
+        self._index()
+        self._insert()
+        self._unsaved_feeds += len(urls)
+        self._persist()
+        return self.num_new
+
+    def replay(self, cache, since=None, until=None, parse_workers=0, queue_size=64):
+        """ Run the fetches logged in a response cache through parsing, cleaning and storage
+        again, with no network (e.g. into a new data path after a parser change)
 
-                content = response.content
-                # Remove leading newlines in the BetaKit XML feed
-                if source == 'betakit':
-                    content = content.decode('utf-8').replace('\n', '')
-
-                res = feedparser.parse(content)
-
-                xml_path = os.path.join(self.root_path, source, category + '.xml')
-                if os.path.isfile(xml_path):
-                    tree = ET.ElementTree()
-                    tree.parse(xml_path)
-                    data = tree.getroot()
-
-                    # Retrieve the current sets of UIDs, titles in the XML file
-                    uid_set = set(map(lambda i: i.text, data.iter('uid')))
-                    title_set = set(map(lambda t: t.text, data.iter('title')))
-
-                    for feed in res.entries:
-                        # Some feed doesn't have ID key, we use link instead
-                        try:
-                            feed_id = feed.id
-                        except AttributeError:
-                            print("-->No <id> in {0} ({1}), try <link>".format(source, category))
-                            try:
-                                feed_id = feed.link
-                            except AttributeError:
-                                print("-->No <link> in {0} ({1}), ignore".format(source, category))
-                                continue
-                        try:
-                            feed_title = feed.title.encode('ascii', 'ignore').decode('utf-8')
-                        except AttributeError:
-                            print("-->No <title> in {0} ({1}), ignore".format(source, category))
-                            continue
-
-                        if feed_id not in uid_set and feed_title not in title_set:
-                            entry = ET.SubElement(data, 'entry')
-                            uid = ET.SubElement(entry, 'uid')
-                            title = ET.SubElement(entry, 'title')
-                            link = ET.SubElement(entry, 'link')
-                            summary = ET.SubElement(entry, 'summary')
-                            published = ET.SubElement(entry, 'published_date')
-
-                            uid.text = feed_id
-                            title.text = feed_title
-                            link.text = feed.link
-
-                            try:
-                                s = feed.summary
-                            except AttributeError:
-                                print("-->No <summary> in {0} ({1}), ignore"
-                                      .format(category, source))
-                                s = None
-                            if s is None:
-                                print("-->Empty <summary> at UID: {0} in {1} ({2}), try <content>"
-                                      .format(feed_id, source, category))
-                                try:
-                                    s = feed.content[0].value
-                                except AttributeError:
-                                    print("-->No <content>")
-                                    continue
-                            # Remove HTML markup and non-ascii chars in summary
-                            s = BeautifulSoup(s, 'lxml').get_text()
-                            summary.text = s.encode('ascii', 'ignore').decode('utf-8')
-
-                            try:
-                                published.text = feed.published
-                                gmt_tp = feed.published_parsed
-                            except AttributeError:
-                                print("-->No <published> in {0} ({1}), try <updated>"
-                                      .format(source, category))
-                                try:
-                                    published.text = res.feed.updated
-                                    gmt_tp = res.feed.updated_parsed
-                                except AttributeError:
-                                    print("-->No <updated> in {0} ({1}), use system GMT"
-                                          .format(source, category))
-                                    gmt_tp = time.gmtime()
-                                    published.text = time.asctime(gmt_tp)
-                            # UTC/GMT conversion %Y-%m-%d %T
-                            # gmt_dt = str(parse(published.text).astimezone(to_zone)).split('+')[0]
-                            gmt_dt = time.strftime('%Y-%m-%d %H:%M:%S', gmt_tp) if gmt_tp else ''
-
-                            # Insert row into database table 'rss_feeds'
-                            if to_db:
-                                try:
-                                    query = ("INSERT INTO rss_feeds"
-                                             " (uid, title, link, summary, published_date,"
-                                             " gmt_date, source, category)"
-                                             " VALUE (%s, %s, %s, %s, %s,"
-                                             " STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s);")
-                                    cursor.execute(query, (uid.text, title.text, link.text,
-                                                           summary.text, published.text,
-                                                           gmt_dt, source, category))
-                                    cnx.commit()
-                                except Exception as e:
-                                    print("-->Error {}".format(e.args[1]))
-
-                            num_update += 1
-
-                    if num_update:
-                        print("Found {0} update in {1} ({2})".format(num_update, source, category))
-                        tree.write(xml_path)
-                        time.sleep(0.5)
-                else:
-                    print("Creating a new XML file")
-
-                    data = ET.Element('data')
-                    for feed in res.entries:
-                        entry = ET.SubElement(data, 'entry')
-                        uid = ET.SubElement(entry, 'uid')
-                        title = ET.SubElement(entry, 'title')
-                        link = ET.SubElement(entry, 'link')
-                        summary = ET.SubElement(entry, 'summary')
-                        published = ET.SubElement(entry, 'published_date')
-
-                        try:
-                            uid.text = feed.id
-                        except AttributeError:
-                            print("-->No <id> in {0} ({1}), try <link>".format(source, category))
-                            try:
-                                uid.text = feed.link
-                            except AttributeError:
-                                print("-->No <link> in {0} ({1}), ignore".format(source, category))
-                                continue
-                        try:
-                            title.text = feed.title.encode('ascii', 'ignore').decode('utf-8')
-                        except AttributeError:
-                            print("-->No <title> in {0} ({1}), ignore".format(source, category))
-                            continue
-
-                        link.text = feed.link
-
-                        try:
-                            s = feed.summary
-                        except AttributeError:
-                            print("-->No <summary> in {0} ({1}), ignore"
-                                  .format(category, source))
-                            s = None
-                        if s is None:
-                            print("-->Empty <summary> at UID: {0}, in {1} ({2}), try <content>"
-                                  .format(uid.text, source, category))
-                            try:
-                                s = feed.content[0].value
-                            except AttributeError:
-                                print("-->No <content>")
-                                continue
-                        # Remove HTML markup in the summary
-                        s = BeautifulSoup(s, 'lxml').get_text()
-                        summary.text = s.encode('ascii', 'ignore').decode('utf-8')
-
-                        try:
-                            published.text = feed.published
-                        except AttributeError:
-                            print("-->No <published> in {0} ({1}), try <updated>"
-                                  .format(source, category))
-                            try:
-                                published.text = res.feed.updated
-                            except AttributeError:
-                                print("-->No <updated> in {0} ({1}), use system GMT"
-                                      .format(source, category))
-                                published.text = time.asctime(time.gmtime())
-
-                        num_update += 1
-
-                    tree = ET.ElementTree(data)
-                    # num_update = len(res.entries)
-
-                    tree.write(xml_path)
-                    time.sleep(0.5)
-
-                    if to_db:
-                        try:
-                            query = ("LOAD XML LOCAL INFILE '" + xml_path + "' INTO TABLE rss_feeds"
-                                     " ROWS IDENTIFIED BY '<entry>' SET source=%s, category=%s;")
-                            cursor.execute(query, (source, category))
-                            cnx.commit()
-                        except Exception as e:
-                            print("Error {}".format(e.args[1]))
-
-                    print("Found {0} update in {1} ({2})".format(num_update, source, category))
-
-            if to_db:
-                cursor.close()
-                cnx.close()
-
-            print("Now:", time.asctime(time.localtime()))
-            print("Terminating at:", asctime_end)
-            print("Waiting for 5 min\n")
-            time.sleep(300)
+        Arguments
+            cache:         ResponseCache holding the raw bodies
+            since:         Replay the fetches logged from this time (epoch seconds)
+            until:         Replay the fetches logged before this time
+            parse_workers: Number of parse processes (0: parse on the calling thread)
+            queue_size:    Capacity of the hand-offs between pipeline stages
+
+        Return
+            (number of fetches replayed, number of new entries stored)
+        """
+        # Fetches whose body was evicted cannot be replayed
+        entries = [entry for entry in cache.entries(since, until) if cache.has(entry['digest'])]
+        for entry in entries:
+            self.sources.setdefault(entry['url'], (entry['source'], entry['category']))
+        self.num_new = 0
+        fetcher = ReplayFetcher(cache, entries)
+        urls = [entry['url'] for entry in entries]
+        if parse_workers > 0:
+            CrawlPipeline(fetcher, parse_feed, parse_workers=parse_workers, queue_size=queue_size,
+                          metrics=self.metrics).run(urls, self._prepare, self._write)
+        else:
+            fetcher.fetch_all(urls, self._handle)
+        self._persist(force=True)
+        return fetcher.served, self.num_new
+
+    def _persist(self, force=False):
+        """ Save the crawl state when a checkpoint is due (see run()) or forced """
+        if not force and (self.checkpoint_interval or self.checkpoint_feeds):
+            if time.time() - self._last_checkpoint < self.checkpoint_interval and \
+                    self._unsaved_feeds < (self.checkpoint_feeds or float('inf')):
+                return
+        self._last_checkpoint = time.time()
+        self._unsaved_feeds = 0
+        with self.timer.stage('persist'):
+            self.feed_state.save()
+            self.dedup.save()
+            self.health.save()
+            self.metrics.set('feeds_quarantined', len(self.health.quarantined()))
+            if self.near_dup is not None:
+                self.near_dup.save()
+            if self.search is not None:
+                self.search.commit()
+            if self.cache is not None:
+                self.cache.save()
+            if self.journal is not None:
+                self.journal.checkpoint(self._run_state())
+
+    def _run_state(self):
+        """ Snapshot of the run for the crawl journal """
+        return {'started': self.started,
+                'deadline': self.deadline,
+                'scheduler': self.scheduler.snapshot()}
+
+    def _resume(self):
+        """ Restore the run recorded in the crawl journal
+
+        Return
+            False if there is no run to resume
+        """
+        t0 = time.time()
+        snapshot, records = self.journal.recover()
+        if snapshot is None:
+            print("-->No crawl journal to resume from, starting a new run")
+            return False
+        self.started, self.deadline = snapshot['started'], snapshot['deadline']
+        self.scheduler.restore(snapshot['scheduler'])
+        for record in records:
+            if record['sched'] is not None:
+                self.scheduler.restore({record['url']: record['sched']})
+        self._replay(records)
+        print("Resumed the run ending {0}: {1} feeds, {2} journal records in {3:.0f} ms"
+              .format(time.asctime(time.localtime(self.deadline)), len(self.scheduler),
+                      len(records), (time.time() - t0) * 1e3))
+        return True
+
+    def _recover(self):
+        """ Keep the stored progress journaled by a previous run before it is reset
+
+        The feeds it crawled since its last checkpoint are in the archive already: without
+        their validators and dedup hashes the next run would store their entries again.
+        """
+        _, records = self.journal.recover()
+        if records:
+            self._replay(records)
+            print("Recovered {} journal records of the previous run".format(len(records)))
+
+    def _replay(self, records):
+        """ Apply the feed state and dedup hashes of journal records and save them """
+        for record in records:
+            if record['state'] is not None:
+                self.feed_state.set_state(record['url'], record['state'])
+            if record['uids'] or record['titles']:
+                self.dedup.add_hashes(record['source'], record['category'],
+                                      record['uids'], record['titles'])
+        # The replayed progress must be on disk before the journal is truncated
+        self.feed_state.save()
+        self.dedup.save()
+
+    def _journal(self, url, added=()):
+        """ Record the progress of a feed in the crawl journal (after it is persisted)
+
+        Arguments
+            url:   Feed URL
+            added: (UID hash, title hash) of the entries added to the dedup index
+        """
+        if self.journal is None:
+            return
+        source, category = self.sources[url]
+        self.journal.append({'url': url,
+                             'source': source,
+                             'category': category,
+                             'state': self.feed_state.get_state(url),
+                             'sched': self.scheduler.feeds.get(url),
+                             'uids': [u for u, _ in added if u is not None],
+                             'titles': [t for _, t in added if t is not None]})
+
+    def _index(self, source=None, category=None, records=()):
+        """ Add stored entries to the search index, after those it failed to take before """
+        if self.search is None:
+            return
+        if records:
+            self.search_backlog.append((source, category, records))
+        try:
+            while self.search_backlog:
+                self.search.add(*self.search_backlog[0])
+                self.search_backlog.pop(0)
+        except Exception as e:
+            # Bounded: past SEARCH_BACKLOG feeds, the oldest are left to a rebuild of the index
+            del self.search_backlog[:-SEARCH_BACKLOG]
+            print("-->Failed to update the search index: {0}, {1} feeds kept for a later try"
+                  .format(e, len(self.search_backlog)))
+
+    def _insert(self, source=None, category=None, records=()):
+        """ Insert stored entries into table 'rss_feeds', one transaction per feed
+
+        A failed flush keeps the rows in the sink, they go with its next flush.
+        """
+        if self.db is None or not (records or self.db.rows):
+            return
+        t0 = time.time()
+        try:
+            self.db.write(source, category, records)
+            self.metrics.inc('db_rows_total', self.db.flush())
+        except Exception as e:
+            print("-->Failed to insert into the database: {0}, {1} rows kept for the next flush"
+                  .format(e, len(self.db.rows)))
+        self.metrics.observe('db_write_seconds', time.time() - t0)
+
+    def _rediscover(self, max_age):
+        """ Refresh the feed URLs of the target sites and (un)schedule the changes """
+        self.sources, added, removed = self.discovery.refresh(max_age, seeds=self.seeds)
+        for url in added:
+            if self.shard is None or self.shard.owns(url):
+                self.scheduler.add(url, due=self.health.next_probe(url))
+        for url in removed:
+            self.scheduler.remove(url)
+
+    def _rebalance(self):
+        """ Schedule the feeds assigned to this crawler and drop the others """
+        assigned = set(self.assigned())
+        removed = [url for url in self.scheduler.feeds if url not in assigned]
+        for url in removed:
+            self.scheduler.remove(url)
+        added = [url for url in assigned if url not in self.scheduler.feeds]
+        for url in added:
+            self.scheduler.add(url, due=self.health.next_probe(url) or time.time())
+        if self.shard is not None and (added or removed):
+            print("Shard {0}: {1} feeds (+{2}, -{3})".format(self.shard.member_id, len(assigned),
+                                                            len(added), len(removed)))
+
+    def _crawl_serial(self, urls):
+        """ Fetch and process the feeds one after another, next the first one whose host is
+        ready (sleeps only while every host is waiting) """
+        pending = list(urls)
+        while pending:
+            now = time.time()
+            wait = None
+            for i, url in enumerate(pending):
+                delay = self.politeness.ready_in(url, now)
+                if delay <= 0 or delay > self.politeness.max_wait:
+                    break
+                wait = delay if wait is None else min(wait, delay)
+            else:
+                time.sleep(wait)
+                continue
+            del pending[i]
+            if delay > 0:
+                self._handle(url, None, HostDeferred(url, delay))
+                continue
+            self.politeness.take(url, now)
+            try:
+                response, error = self._fetch(url), None
+            except Exception as e:
+                response, error = None, e
+            self._handle(url, response, error)
+
+    def _crawl_async(self, fetcher, urls):
+        """ Fetch the feeds concurrently, processing each one as soon as it arrives """
+        fetcher.fetch_all(urls, self._handle)
+
+    def _handle(self, url, response, error):
+        """ Process the result of a fetch on the current thread
+
+        Arguments
+            url:      Feed URL
+            response: HTTP response of the feed (None if the request failed)
+            error:    Exception raised by the request (None if it succeeded)
+
+        Return
+            Number of new entries stored
+        """
+        args = None
+        if error is None:
+            args = self._prepare(url, response, error)
+        result = None
+        if args is not None:
+            source, category = self.sources[url]
+            with self.timer.stage('dedup'):
+                self._ensure_dedup(source, category)
+            result = parse_feed(*args, seen=lambda uid, title:
+                                self.dedup.seen(source, category, uid, title))
+        return self._write(url, response, error, result)
+
+    def _fetch(self, url):
+        """ Conditional GET of a feed using its stored ETag / Last-Modified """
+        source, category = self.sources[url]
+        if not self.politeness.allowed(url):
+            raise RobotsDisallowed("disallowed by robots.txt")
+        t0 = time.time()
+        status = 'error'
+        try:
+            with self.timer.stage('fetch'):
+                response = self.http.get(url, headers=self.feed_state.request_headers(url),
+                                         stream=True)
+                self.politeness.observe(url, response.status_code,
+                                        parse_retry_after(response.headers.get('Retry-After')))
+                streamed = self._streams(url, response)
+                if not streamed:
+                    # Read the body on the fetching thread
+                    body = self.http.read(response)
+                    size = len(body)
+                    if self.stream_threshold and size > self.stream_threshold:
+                        self.large_feeds.add(url)
+                    if self.cache is not None and response.status_code == 200:
+                        self.cache.put(url, source, category, response.headers, body)
+            if streamed:
+                response = self._stream(url, response)
+                size = response.size
+            status = response.status_code
+            self.metrics.inc('feed_bytes_total', size, source=source, category=category)
+            self.metrics.observe('fetch_bytes', size)
+            return response
+        finally:
+            latency = time.time() - t0
+            self.timer.add_latency(latency)
+            self.health.latency(url, latency)
+            self.metrics.observe('fetch_latency_seconds', latency, source=source)
+            self.metrics.inc('feed_fetch_seconds_total', latency, source=source, category=category)
+            self.metrics.inc('feed_fetches_total', source=source, category=category, status=status)
+            self.metrics.inc('http_responses_total', status=status)
+
+    def _streams(self, url, response):
+        """ Whether to parse a feed while it downloads: a large 200 body """
+        if not self.stream_threshold or response.status_code != 200 or url in self.unstreamable:
+            return False
+        if url in self.large_feeds:
+            return True
+        try:
+            return int(response.headers.get('Content-Length')) > self.stream_threshold
+        except (TypeError, ValueError):
+            return False
+
+    def _stream(self, url, response):
+        """ Download and parse a feed at once, stopping at the entries already stored
+
+        Return
+            StreamedFeed
+        """
+        source, category = self.sources[url]
+        seen = None
+        # The writer thread builds the index of new feeds; without one, read the whole feed
+        if self.dedup.has(source, category):
+            seen = lambda uid, title: self.dedup.seen(source, category, uid, title)
+        size = [0]
+        writer = self.cache.writer() if self.cache is not None else None
+
+        def chunks():
+            for chunk in self.http.iter_body(response, CHUNK_SIZE):
+                size[0] += len(chunk)
+                if writer is not None:
+                    writer.update(chunk)
+                yield chunk
+
+        body = chunks()
+        try:
+            result = stream_feed(body, source, category, self.text_mode, seen, log=log)
+            if writer is not None:
+                # The cache keeps whole bodies: read the rest without parsing it
+                for _ in body:
+                    pass
+        except Exception:
+            # Parse it whole with feedparser from now on
+            self.unstreamable.add(url)
+            if writer is not None:
+                writer.discard()
+            raise
+        finally:
+            # A body left unread cannot go back to the connection pool
+            response.close()
+        if writer is not None:
+            self.cache.commit(url, source, category, response.headers, writer)
+        return StreamedFeed(response, result, size[0])
+
+    def _prepare(self, url, response, error):
+        """ Decide whether a fetched feed needs parsing (read-only, any thread)
+
+        Return
+            Arguments of parse_feed, or None if there is nothing to parse
+        """
+        if response.status_code == 304 or response.status_code >= 400:
+            return None
+        if isinstance(response, StreamedFeed):
+            # Parsed while it downloaded
+            return None
+        source, category = self.sources[url]
+        # Nothing changed since the last fetch, skip parsing and storage I/O
+        if (self.feed_state.is_unchanged(url, content_hash(response.content)) and
+                self.storage.exists(source, category)):
+            return None
+        return source, category, response.content, self.text_mode
+
+    def _probe_later(self, url):
+        """ Schedule a quarantined feed at its next probe only """
+        next_probe = self.health.next_probe(url)
+        if next_probe is not None:
+            self.scheduler.defer(url, max(0.0, next_probe - time.time()))
+
+    def _ensure_dedup(self, source, category):
+        """ Make sure the dedup index covers a feed """
+        if not self.dedup.has(source, category):
+            if self.storage.exists(source, category):
+                # The archive predates the dedup index, index it once
+                self.dedup.seed(source, category, self.storage.iter_records(source, category))
+            else:
+                print("Creating a new archive for {0} ({1})".format(source, category))
+                self.dedup.reset(source, category)
+
+    def _write(self, url, response, error, result):
+        """ Persist the new entries of a feed and schedule its next fetch (writer thread)
+
+        Arguments
+            url:      Feed URL
+            response: HTTP response of the feed (None if the request failed)
+            error:    Exception raised by the request or the parser (None if none)
+            result:   Output of parse_feed (None if parsing was skipped)
+
+        Return
+            Number of new entries stored
+        """
+        source, category = self.sources[url]
+        retry_after = None
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if error is None and response.status_code >= 400:
+                error = 'HTTP {}'.format(response.status_code)
+
+        if isinstance(error, HostDeferred):
+            # Not the feed's failure, fetch it once its host takes requests again
+            self.scheduler.defer(url, error.delay)
+            self.metrics.inc('fetches_deferred_total', source=source)
+            self._journal(url)
+            return 0
+        if error is not None:
+            print("-->Failed to fetch {0} ({1}): {2}, try again later"
+                  .format(source, category, error))
+            self.health.failure(url, error)
+            self.scheduler.failure(url, retry_after=retry_after)
+            self._probe_later(url)
+            self._journal(url)
+            return 0
+
+        if isinstance(response, StreamedFeed):
+            # The body was not kept (nor always read to the end), the validators still apply
+            self.feed_state.update(url, response.headers, None)
+            result = response.result
+        elif response.status_code != 304:
+            self.feed_state.update(url, response.headers, content_hash(response.content))
+        if result is None:
+            self.health.success(url)
+            self.scheduler.success(url, 0, retry_after=retry_after)
+            self._probe_later(url)
+            self._journal(url)
+            return 0
+
+        floor, candidates, timings, events = result
+        for stage in timings:
+            self.timer.add(stage, timings[stage])
+        cpu = sum(timings.values())
+        self.metrics.observe('parse_seconds', cpu, source=source)
+        self.metrics.inc('feed_cpu_seconds_total', cpu, source=source, category=category)
+        seen = events.pop('seen')
+        self.metrics.inc('entries_total', seen, source=source, category=category, kind='seen')
+        known = events.pop('known')
+        for name in events:
+            self.metrics.inc('parse_events_total', events[name], event=name)
+        self.scheduler.set_floor(url, floor)
+
+        with self.timer.stage('dedup'):
+            self._ensure_dedup(source, category)
+            records, collapsed, near = [], [], 0
+            # UIDs / titles of this batch, marked in the dedup index once stored
+            uids, titles = set(), set()
+            for record in candidates:
+                uid, title = record['uid'], record['title']
+                if self.dedup.seen(source, category, uid, title) or \
+                        (uid and uid in uids) or (title and title in titles):
+                    continue
+                uids.add(uid)
+                titles.add(title)
+                if self.near_dup is not None:
+                    cluster, duplicate = self.near_dup.add(uid, title, record['summary'])
+                    near += duplicate
+                    if duplicate and self.near_dup.collapse:
+                        collapsed.append(record)
+                        continue
+                    if not self.near_dup.collapse:
+                        record.cluster = cluster
+                records.append(record)
+
+        try:
+            with self.timer.stage('persist'):
+                if records:
+                    self.storage.append(source, category, records)
+        except Exception as e:
+            print("-->Failed to store {0} ({1}): {2}, try again later"
+                  .format(source, category, e))
+            # Fetch the whole body again next time, a 304 would skip the entries
+            self.feed_state.forget(url)
+            self.scheduler.failure(url, retry_after=retry_after)
+            self._journal(url)
+            return 0
+
+        with self.timer.stage('persist'):
+            # Only entries that made it to storage count as seen; the search index and the
+            # database keep what they fail to take and catch up later
+            added = [self.dedup.add(source, category, r['uid'], r['title'])
+                     for r in records + collapsed]
+            self._index(source, category, records)
+            self._insert(source, category, records)
+
+        if records:
+            print("Found {0} update in {1} ({2})".format(len(records), source, category))
+
+        self.metrics.inc('entries_total', len(records), source=source, category=category,
+                         kind='new')
+        self.metrics.inc('entries_total',
+                         known + len(candidates) - len(records) - len(collapsed),
+                         source=source, category=category, kind='duplicate')
+        if near:
+            # Not stored when collapsed, stored and counted as new too when tagged
+            self.metrics.inc('entries_total', near, source=source, category=category,
+                             kind='near_duplicate')
+        self.health.success(url, seen)
+        self.scheduler.success(url, len(records), retry_after=retry_after)
+        self._probe_later(url)
+        self._journal(url, added)
+        self.num_new += len(records)
+        return len(records)
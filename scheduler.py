@@ -0,0 +1,216 @@
+"""
+Per-feed polling scheduler
+
+Every feed has its own next-due time in a priority queue. The polling
+interval adapts to the observed update rate (new entries per fetch), never
+goes below the feed's own <ttl> / sy:updatePeriod hint, honours Retry-After
+and backs off exponentially with jitter on failures.
+
+"""
+from __future__ import absolute_import, print_function
+import time
+import heapq
+import random
+from email.utils import parsedate_to_datetime
+
+
+# sy:updatePeriod in seconds
+UPDATE_PERIODS = {'hourly': 3600,
+                  'daily': 86400,
+                  'weekly': 7 * 86400,
+                  'monthly': 30 * 86400,
+                  'yearly': 365 * 86400}
+
+
+def parse_retry_after(value, now=None):
+    """ Seconds to wait according to a Retry-After header (None if absent or invalid) """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(0.0, when - (now or time.time()))
+
+
+def feed_min_interval(feed):
+    """ Shortest polling interval (seconds) a feed asks for via <ttl> or sy:updatePeriod
+
+    Arguments
+        feed: feedparser feed-level dict (res.feed)
+    """
+    hints = []
+    try:
+        hints.append(float(feed.get('ttl')) * 60)
+    except (TypeError, ValueError):
+        pass
+    period = UPDATE_PERIODS.get((feed.get('sy_updateperiod') or '').strip().lower())
+    if period:
+        try:
+            frequency = max(1, int(feed.get('sy_updatefrequency') or 1))
+        except ValueError:
+            frequency = 1
+        hints.append(period / frequency)
+    return max(hints) if hints else 0
+
+
+class FeedScheduler(object):
+    def __init__(self, interval=300, min_interval=60, max_interval=6 * 3600, adaptive=True,
+                 max_backoff=24 * 3600, jitter=0.1):
+        """ Priority queue of feeds ordered by next due time
+
+        Arguments
+            interval:     Initial polling interval (seconds), and the fixed one if not adaptive
+            min_interval: Shortest adaptive interval (seconds)
+            max_interval: Longest adaptive interval (seconds)
+            adaptive:     Adapt the interval to the update rate of each feed
+            max_backoff:  Longest delay (seconds) after repeated failures
+            jitter:       Relative random spread applied to every interval
+        """
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.adaptive = adaptive
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+        self.queue = []
+        self.feeds = {}
+        self._seq = 0
+
+    def _state(self, url):
+        if url not in self.feeds:
+            self.feeds[url] = {'interval': self.interval,
+                               'floor': 0,
+                               'rate': None,
+                               'failures': 0,
+                               'last': None,
+                               'due': None}
+        return self.feeds[url]
+
+    def add(self, url, due=None):
+        """ Schedule a feed (due immediately by default) """
+        self._state(url)
+        self._push(url, time.time() if due is None else due)
+
+    def remove(self, url):
+        """ Stop scheduling a feed """
+        self.feeds.pop(url, None)
+
+    def set_floor(self, url, floor):
+        """ Shortest interval a feed asks for (<ttl> / sy:updatePeriod), in seconds """
+        self._state(url)['floor'] = floor
+
+    def _push(self, url, due):
+        self.feeds[url]['due'] = due
+        self._seq += 1
+        heapq.heappush(self.queue, (due, self._seq, url))
+
+    def __len__(self):
+        return len(self.feeds)
+
+    def snapshot(self):
+        """ Copy of the per-feed states (JSON-serializable) """
+        return dict((url, dict(state)) for url, state in self.feeds.items())
+
+    def restore(self, feeds, now=None):
+        """ Reload per-feed states saved by snapshot()
+
+        Feeds that were in flight (no due time) are due immediately.
+        """
+        now = time.time() if now is None else now
+        for url, state in feeds.items():
+            self.feeds[url] = dict(state)
+            self._push(url, now if state.get('due') is None else state['due'])
+
+    def next_due(self):
+        """ Time the next feed is due (None if nothing is scheduled) """
+        while self.queue:
+            due, _, url = self.queue[0]
+            # Skip stale heap items left by rescheduling
+            if url in self.feeds and self.feeds[url].get('due') == due:
+                return due
+            heapq.heappop(self.queue)
+        return None
+
+    def pop_due(self, now=None):
+        """ Remove and return every feed due at the given time """
+        now = time.time() if now is None else now
+        urls = []
+        while self.next_due() is not None and self.queue[0][0] <= now:
+            _, _, url = heapq.heappop(self.queue)
+            self.feeds[url]['due'] = None
+            urls.append(url)
+        return urls
+
+    def _jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def success(self, url, num_new, retry_after=None, now=None):
+        """ Reschedule a feed after a successful fetch
+
+        Arguments
+            url:         Feed URL
+            num_new:     Number of new entries found
+            retry_after: Seconds requested by a Retry-After header
+        """
+        now = time.time() if now is None else now
+        state = self._state(url)
+        state['failures'] = 0
+
+        if self.adaptive:
+            if state['last'] is not None:
+                # Exponentially weighted rate of new entries per second
+                rate = num_new / max(1.0, now - state['last'])
+                state['rate'] = rate if state['rate'] is None else 0.5 * rate + 0.5 * state['rate']
+            if state['rate']:
+                # Poll about as often as one new entry is expected
+                interval = 1.0 / state['rate']
+            else:
+                interval = state['interval'] * 1.5
+            interval = min(self.max_interval, max(self.min_interval, state['floor'], interval))
+        else:
+            interval = max(self.interval, state['floor'])
+        state['interval'] = interval
+        state['last'] = now
+
+        delay = self._jittered(interval)
+        if retry_after:
+            delay = max(delay, retry_after)
+        self._push(url, now + delay)
+
+    def failure(self, url, retry_after=None, now=None):
+        """ Reschedule a feed after a failed fetch with exponential backoff
+
+        Arguments
+            url:         Feed URL
+            retry_after: Seconds requested by a Retry-After header
+        """
+        now = time.time() if now is None else now
+        state = self._state(url)
+        state['failures'] += 1
+        if self.adaptive:
+            backoff = min(self.max_backoff, state['interval'] * 2 ** state['failures'])
+            # Full jitter keeps feeds of a failing host from retrying in lockstep
+            delay = random.uniform(state['interval'], max(state['interval'], backoff))
+        else:
+            delay = self._jittered(self.interval)
+        if retry_after:
+            delay = max(delay, retry_after)
+        self._push(url, now + delay)
+
+    def defer(self, url, delay, now=None):
+        """ Reschedule a feed that is not to be fetched for a while (throttled host,
+        quarantine), keeping its state
+
+        Arguments
+            url:   Feed URL
+            delay: Seconds before it may be fetched again
+        """
+        now = time.time() if now is None else now
+        self._state(url)
+        # Never earlier than asked
+        self._push(url, now + delay * random.uniform(1, 1 + self.jitter))
@@ -1,8 +1,33 @@
 from rss_crawler import RSSCrawler
+from sharding import ShardCoordinator, open_membership
 import os.path
+import argparse
+import logging
 
 
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+
+parser = argparse.ArgumentParser()
+# Continue an interrupted run where it stopped
+parser.add_argument('--resume', action='store_true')
+# Crawl one shard of the feeds, coordinating with the other shards through the membership
+parser.add_argument('--shard', help="Id of this shard, the same at every restart "
+                                    "(default: <hostname>)")
+parser.add_argument('--membership', help="Membership database (*.db) or directory of the shards")
+parser.add_argument('--metrics-port', type=int, default=9108)
+# Keep the raw feed bodies for replay (see response_cache)
+parser.add_argument('--cache', action='store_true')
+parser.add_argument('--storage', choices=('segment', 'xml'),
+                    help="Archive storage (default: xml for a data directory that already has "
+                         "XML archives, else segment)")
+args = parser.parse_args()
+
 data_path = 'data'
-crawler = RSSCrawler(data_path=data_path)
-crawler.extract_url(csv_path=os.path.join(crawler.root_path, 'feed_url.csv'))
-crawler.run(timeout=7, to_db=True)
+shard = None
+if args.membership:
+    shard = ShardCoordinator(open_membership(args.membership), member_id=args.shard)
+crawler = RSSCrawler(data_path=data_path, storage=args.storage, shard=shard, cache=args.cache)
+crawler.extract_url(csv_path=os.path.join(data_path, 'feed_url.csv'))
+crawler.run(timeout=7, to_db=True, max_concurrency=32, max_per_host=4,
+            metrics_port=args.metrics_port,
+            metrics_snapshot=os.path.join(crawler.root_path, 'metrics.json'), resume=args.resume)
@@ -0,0 +1,488 @@
+"""
+Full-text search index of crawled entries
+
+The crawler hands every stored entry to the index; the words of its title
+and summary go to an in-memory segment that is written to disk at the end
+of each crawl cycle as an immutable segment file:
+
+    header | facets (JSON) | gmt column | facet column | doc offsets |
+    doc store (JSON lines) | term offsets | postings offsets | doc freqs |
+    term blob (sorted) | postings (zlib of delta-coded doc ids)
+
+Segments are opened with mmap: a query binary-searches the sorted term table
+in place, decompresses only the postings of its terms and reads the time
+and facet columns as zero-copy array views, so the index never has to fit
+in memory. The entries of a segment are numbered in gmt_date order: a
+date range is a bisection of the postings and the newest matches are the
+last ones. segments.json lists the live segments and is replaced
+atomically; segments of the same size tier are merged once merge_factor of
+them pile up, keeping the number of segments logarithmic.
+
+Entries stored after the last committed cycle of an interrupted run are
+not indexed; `build` re-indexes the archives.
+
+Usage
+    python search_index.py query <index path> <words> [--since 2017-01-01] [--until ...]
+                                 [--source S] [--category C] [--limit 20] [--facets]
+    python search_index.py build <data path> [--index <path>] [--xml]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import re
+import sys
+import json
+import mmap
+import math
+import zlib
+import heapq
+import bisect
+import struct
+import calendar
+import argparse
+from array import array
+from itertools import accumulate
+from collections import Counter
+from fsutil import atomic_write
+from date_normalizer import to_gmt
+
+
+MAGIC = b'RSSSEARCH1\n\x00'
+_HEADER = struct.Struct('<QQ10Q')
+# Entry dates are kept as array('I') epoch seconds
+MAX_SECONDS = 2 ** 32 - 1
+
+_WORD = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has',
+                       'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'this', 'to',
+                       'was', 'were', 'will', 'with'])
+
+
+def tokenize(text):
+    """ Index terms of a text: lowercase words of two characters or more, no stopwords """
+    return [w for w in _WORD.findall(text.lower()) if len(w) > 1 and w not in STOPWORDS]
+
+
+def gmt_seconds(gmt_date):
+    """ Epoch seconds of a '%Y-%m-%d %H:%M:%S' (or '%Y-%m-%d') date, 0 if it is empty
+
+    Clamped to the unsigned 32-bit range of the date arrays (a pre-1970 date is 0).
+    """
+    if not gmt_date:
+        return 0
+    try:
+        fields = [int(gmt_date[0:4]), int(gmt_date[5:7]), int(gmt_date[8:10])]
+        if len(gmt_date) >= 19:
+            fields += [int(gmt_date[11:13]), int(gmt_date[14:16]), int(gmt_date[17:19])]
+        else:
+            fields += [0, 0, 0]
+        return min(max(calendar.timegm(fields), 0), MAX_SECONDS)
+    except ValueError:
+        return 0
+
+
+def _le(arr):
+    if sys.byteorder == 'big':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _column(buf, offset, typecode, count):
+    """ Little-endian array stored in a buffer, as a zero-copy view where possible """
+    size = array(typecode).itemsize
+    view = memoryview(buf)[offset:offset + count * size].cast(typecode)
+    if sys.byteorder == 'big':
+        view = array(typecode, view)
+        view.byteswap()
+    return view
+
+
+def write_segment(path, facets, gmt, facet_ids, docs, postings):
+    """ Write an immutable segment file
+
+    Arguments
+        path:      Segment file path
+        facets:    List of (source, category), indexed by facet_ids
+        gmt:       array('I') of the entry dates (epoch seconds)
+        facet_ids: array('I') of the entry facets
+        docs:      List of stored entries as JSON bytes
+        postings:  {term: ascending doc ids}
+    """
+    # Renumber the entries by date
+    order = sorted(range(len(docs)), key=gmt.__getitem__)
+    renumber = array('I', bytes(4 * len(docs)))
+    for new, old in enumerate(order):
+        renumber[old] = new
+    gmt = array('I', [gmt[i] for i in order])
+    facet_ids = array('I', [facet_ids[i] for i in order])
+    docs = [docs[i] for i in order]
+
+    terms = sorted(postings, key=lambda t: t.encode('utf-8'))
+    doc_offsets = array('Q', accumulate([len(d) for d in docs], initial=0))
+    blobs = [t.encode('utf-8') for t in terms]
+    term_offsets = array('Q', accumulate([len(b) for b in blobs], initial=0))
+    lists = []
+    for term in terms:
+        ids = sorted(renumber[d] for d in postings[term])
+        deltas = array('I', [ids[0]]) + array('I', [b - a for a, b in zip(ids, ids[1:])])
+        lists.append(zlib.compress(_le(deltas), 1))
+    post_offsets = array('Q', accumulate([len(p) for p in lists], initial=0))
+    freqs = array('I', [len(postings[t]) for t in terms])
+
+    sections = [json.dumps(facets).encode('utf-8'), _le(gmt), _le(facet_ids), _le(doc_offsets),
+                b''.join(docs), _le(term_offsets), _le(post_offsets), _le(freqs),
+                b''.join(blobs), b''.join(lists)]
+    offsets, pos = [], len(MAGIC) + _HEADER.size
+    for section in sections:
+        # 8-byte alignment of the columns
+        pos += -pos % 8
+        offsets.append(pos)
+        pos += len(section)
+    with atomic_write(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER.pack(len(docs), len(terms), *offsets))
+        for offset, section in zip(offsets, sections):
+            f.write(b'\x00' * (offset - f.tell()))
+            f.write(section)
+
+
+class Segment(object):
+    def __init__(self, path):
+        """ Read-only memory-mapped segment """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self._map
+        if buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("Invalid search segment {}".format(path))
+        header = _HEADER.unpack_from(buf, len(MAGIC))
+        self.num_docs, self.num_terms = header[:2]
+        (facets, gmt, facet_ids, doc_offsets, self._docs, term_offsets, post_offsets, freqs,
+         self._terms, self._postings) = header[2:]
+        n, t = self.num_docs, self.num_terms
+        self.facets = [tuple(f) for f in
+                       json.loads(buf[facets:gmt].rstrip(b'\x00').decode('utf-8'))]
+        self.gmt = _column(buf, gmt, 'I', n)
+        self.facet_ids = _column(buf, facet_ids, 'I', n)
+        self.doc_offsets = _column(buf, doc_offsets, 'Q', n + 1)
+        self.term_offsets = _column(buf, term_offsets, 'Q', t + 1)
+        self.post_offsets = _column(buf, post_offsets, 'Q', t + 1)
+        self.freqs = _column(buf, freqs, 'I', t)
+
+    def term(self, i):
+        return self._map[self._terms + self.term_offsets[i]:
+                         self._terms + self.term_offsets[i + 1]]
+
+    def find(self, term):
+        """ Index of a term in the sorted term table (-1 if absent) """
+        key = term.encode('utf-8')
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.num_terms and self.term(lo) == key else -1
+
+    def postings(self, i):
+        """ Ascending doc ids of the i-th term """
+        raw = zlib.decompress(self._map[self._postings + self.post_offsets[i]:
+                                        self._postings + self.post_offsets[i + 1]])
+        deltas = array('I')
+        deltas.frombytes(raw)
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        return list(accumulate(deltas))
+
+    def doc(self, i):
+        """ Stored fields of an entry """
+        return json.loads(self._map[self._docs + self.doc_offsets[i]:
+                                    self._docs + self.doc_offsets[i + 1]].decode('utf-8'))
+
+    def raw_doc(self, i):
+        return self._map[self._docs + self.doc_offsets[i]:self._docs + self.doc_offsets[i + 1]]
+
+    def iter_terms(self):
+        """ (term, index) in term order """
+        for i in range(self.num_terms):
+            yield self.term(i).decode('utf-8'), i
+
+    def close(self):
+        # Views of the map must be released before it can be closed
+        for name in ('gmt', 'facet_ids', 'doc_offsets', 'term_offsets', 'post_offsets', 'freqs'):
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                column.release()
+        self._map.close()
+        self._file.close()
+
+
+class SearchIndex(object):
+    def __init__(self, path, merge_factor=10):
+        """ Segmented inverted index of titles and summaries
+
+        Arguments
+            path:         Directory of the segments
+            merge_factor: Number of segments of a size tier merged into one
+        """
+        self.path = path
+        self.merge_factor = merge_factor
+        self.registry_path = os.path.join(path, 'segments.json')
+        self.names = []
+        self.segments = []
+        self.next_id = 0
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self._facets = {}
+        self._gmt = array('I')
+        self._facet_ids = array('I')
+        self._docs = []
+        self._postings = {}
+
+    def open(self):
+        """ Open the committed segments """
+        self.close()
+        if os.path.isfile(self.registry_path):
+            with open(self.registry_path, 'r') as f:
+                registry = json.load(f)
+            self.names, self.next_id = registry['segments'], registry['next_id']
+            self.segments = [Segment(os.path.join(self.path, name)) for name in self.names]
+        return self
+
+    def __len__(self):
+        return sum(s.num_docs for s in self.segments)
+
+    def add(self, source, category, records):
+        """ Buffer the entries of a feed until the next commit """
+        facet = self._facets.setdefault((source, category), len(self._facets))
+        postings = self._postings
+        for record in records:
+            doc = len(self._docs)
+            # XML archives do not keep gmt_date
+            gmt_date = record.get('gmt_date') or \
+                to_gmt(record.get('published_date'), (source, category)) or ''
+            self._gmt.append(gmt_seconds(gmt_date))
+            self._facet_ids.append(facet)
+            self._docs.append(json.dumps({'uid': record.get('uid'), 'title': record.get('title'),
+                                          'link': record.get('link'),
+                                          'gmt_date': gmt_date}).encode('utf-8'))
+            for term in set(tokenize(record.get('title') or '') +
+                            tokenize(record.get('summary') or '')):
+                postings.setdefault(term, []).append(doc)
+
+    def commit(self):
+        """ Write the buffered entries as a new segment and merge the full size tiers """
+        if not self._docs:
+            return
+        facets = sorted(self._facets, key=self._facets.get)
+        name = self._new_segment(facets, self._gmt, self._facet_ids, self._docs, self._postings)
+        self._reset_buffer()
+        self._publish(self.names + [name])
+        self._merge_tiers()
+
+    def _new_segment(self, facets, gmt, facet_ids, docs, postings):
+        name = 'seg_{:06d}.idx'.format(self.next_id)
+        self.next_id += 1
+        write_segment(os.path.join(self.path, name), facets, gmt, facet_ids, docs, postings)
+        return name
+
+    def _publish(self, names):
+        """ Switch to a new list of segments and delete the ones left out """
+        with atomic_write(self.registry_path) as f:
+            json.dump({'segments': names, 'next_id': self.next_id}, f)
+        dropped = [n for n in self.names if n not in names]
+        self.open()
+        for name in dropped:
+            os.remove(os.path.join(self.path, name))
+
+    def _tier(self, segment):
+        return int(math.log(max(segment.num_docs, 1), self.merge_factor))
+
+    def _merge_tiers(self):
+        while True:
+            tiers = {}
+            for name, segment in zip(self.names, self.segments):
+                tiers.setdefault(self._tier(segment), []).append(name)
+            full = [names for names in tiers.values() if len(names) >= self.merge_factor]
+            if not full:
+                return
+            self.merge(full[0][:self.merge_factor])
+
+    def merge(self, names=None):
+        """ Merge segments into one (default: all of them) """
+        names = list(self.names if names is None else names)
+        if len(names) < 2:
+            return
+        segments = [self.segments[self.names.index(n)] for n in names]
+        facets, gmt, facet_ids, docs, postings = [], array('I'), array('I'), [], {}
+        for segment in segments:
+            base = len(docs)
+            remap = []
+            for facet in segment.facets:
+                if facet not in facets:
+                    facets.append(facet)
+                remap.append(facets.index(facet))
+            gmt.extend(segment.gmt)
+            facet_ids.extend(remap[f] for f in segment.facet_ids)
+            docs.extend(segment.raw_doc(i) for i in range(segment.num_docs))
+            for term, i in segment.iter_terms():
+                ids = segment.postings(i)
+                postings.setdefault(term, []).extend(d + base for d in ids)
+        name = self._new_segment(facets, gmt, facet_ids, docs, postings)
+        self._publish([n for n in self.names if n not in names] + [name])
+
+    def search(self, query, since=None, until=None, source=None, category=None, limit=20,
+               facets=False):
+        """ Entries containing every word of the query, newest first
+
+        Arguments
+            query:    Keywords (all of them must match)
+            since:    Earliest gmt_date ('%Y-%m-%d' or '%Y-%m-%d %H:%M:%S')
+            until:    gmt_date before which entries are kept
+            source:   Only entries of this source
+            category: Only entries of this category
+            limit:    Number of entries returned
+            facets:   Count the matches by source and by category
+
+        Return
+            {'total': number of matches, 'hits': stored fields of the newest matches
+             (plus source and category), 'facets': {'source': {name: count},
+             'category': {name: count}} of all matches (empty if not asked)}
+        """
+        terms = sorted(set(tokenize(query)))
+        total, best = 0, []
+        sources, categories = Counter(), Counter()
+        for n, segment in enumerate(self.segments):
+            docs = self._match(segment, terms)
+            if not docs:
+                continue
+            # Entries are numbered by date: the range is a slice of the postings
+            if since or until:
+                first = bisect.bisect_left(segment.gmt, gmt_seconds(since)) if since else 0
+                last = (bisect.bisect_left(segment.gmt, gmt_seconds(until)) if until
+                        else segment.num_docs)
+                docs = docs[bisect.bisect_left(docs, first):bisect.bisect_left(docs, last)]
+            if source is not None or category is not None:
+                wanted = set(i for i, (s, c) in enumerate(segment.facets)
+                             if (source is None or s == source) and
+                             (category is None or c == category))
+                facet_ids = segment.facet_ids
+                docs = [d for d in docs if facet_ids[d] in wanted]
+            total += len(docs)
+            if facets:
+                counts = Counter(segment.facet_ids[d] for d in docs)
+                for facet, count in counts.items():
+                    sources[segment.facets[facet][0]] += count
+                    categories[segment.facets[facet][1]] += count
+            best = heapq.nlargest(limit, best + [(segment.gmt[d], n, d) for d in docs[-limit:]])
+        hits = []
+        for _, n, d in best:
+            segment = self.segments[n]
+            hit = segment.doc(d)
+            hit['source'], hit['category'] = segment.facets[segment.facet_ids[d]]
+            hits.append(hit)
+        return {'total': total, 'hits': hits,
+                'facets': {'source': dict(sources), 'category': dict(categories)} if facets
+                else {}}
+
+    @staticmethod
+    def _match(segment, terms):
+        """ Ascending doc ids of a segment containing every term """
+        if not terms:
+            return []
+        found = []
+        for term in terms:
+            i = segment.find(term)
+            if i < 0:
+                return []
+            found.append(i)
+        # Intersect starting from the rarest term
+        found.sort(key=lambda i: segment.freqs[i])
+        docs = segment.postings(found[0])
+        for i in found[1:]:
+            docs = sorted(set(docs).intersection(segment.postings(i)))
+            if not docs:
+                break
+        return docs
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+def build(storage, index, batch_size=100000):
+    """ Index the stored entries of every feed
+
+    Return
+        Number of entries indexed
+    """
+    num = 0
+    for source, category in storage.feeds():
+        batch = []
+        for record in storage.iter_records(source, category):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                index.add(source, category, batch)
+                index.commit()
+                num += len(batch)
+                batch = []
+        index.add(source, category, batch)
+        num += len(batch)
+    index.commit()
+    return num
+
+
+def main():
+    from storage import SegmentStorage, XMLStorage
+
+    parser = argparse.ArgumentParser(description="Search the crawled entries")
+    sub = parser.add_subparsers(dest='command')
+    query_cmd = sub.add_parser('query', help="Keyword query")
+    query_cmd.add_argument('index')
+    query_cmd.add_argument('words', nargs='+')
+    query_cmd.add_argument('--since', help="Earliest gmt_date, e.g. 2017-01-01")
+    query_cmd.add_argument('--until', help="gmt_date before which entries are kept")
+    query_cmd.add_argument('--source')
+    query_cmd.add_argument('--category')
+    query_cmd.add_argument('--limit', type=int, default=20)
+    query_cmd.add_argument('--facets', action='store_true', help="Print the match counts by "
+                                                                 "source and category")
+    build_cmd = sub.add_parser('build', help="Index the entries of a data directory")
+    build_cmd.add_argument('data_path')
+    build_cmd.add_argument('--index', help="Index path (default: <data path>/search)")
+    build_cmd.add_argument('--xml', action='store_true', help="XML archives, not segments")
+    args = parser.parse_args()
+
+    if args.command == 'query':
+        index = SearchIndex(args.index).open()
+        result = index.search(' '.join(args.words), since=args.since, until=args.until,
+                              source=args.source, category=args.category, limit=args.limit,
+                              facets=args.facets)
+        for hit in result['hits']:
+            print("{0}  {1} ({2})  {3}\n    {4}".format(hit['gmt_date'], hit['source'],
+                                                       hit['category'], hit['title'],
+                                                       hit['link']))
+        print("{} matches".format(result['total']))
+        if args.facets:
+            for facet in ('source', 'category'):
+                counts = result['facets'][facet]
+                print("By {0}: {1}".format(facet, ', '.join(
+                    '{0} {1}'.format(k, counts[k]) for k in sorted(counts, key=counts.get,
+                                                                 reverse=True))))
+        index.close()
+    elif args.command == 'build':
+        storage = XMLStorage(args.data_path) if args.xml else SegmentStorage(args.data_path)
+        index = SearchIndex(args.index or os.path.join(args.data_path, 'search')).open()
+        print("Indexed {} entries".format(build(storage, index)))
+        index.close()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
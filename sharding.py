@@ -0,0 +1,289 @@
+"""
+Sharded crawling
+
+N crawler instances split the feeds with a consistent-hash ring keyed by
+feed host, so all feeds of a site stay on one shard (and under its per-host
+limits) and a membership change only moves the hosts of the shards that
+joined or left. Members announce themselves with heartbeats through a
+pluggable membership backend (SQLite database or a shared directory).
+Every shard writes to its own partition <data>/shards/<member id>/, and
+merge_partitions() combines the partitions into one store.
+
+Usage
+    python sharding.py members <membership path>
+    python sharding.py merge <shards path> <output path> --storage segment|xml [--xml]
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import time
+import bisect
+import socket
+import sqlite3
+import argparse
+from urllib.parse import urlparse
+from dedup_index import key_hash
+from storage import SegmentStorage, XMLStorage, export_all
+
+
+def shard_key(url):
+    """ Key placing a feed on the ring: its host, so a site is never split """
+    return urlparse(url).netloc.lower()
+
+
+def default_member_id():
+    """ The host name: stable across restarts, so that a restarted shard finds its partition
+    (archives, dedup state, journal) again; shards sharing a host need explicit ids """
+    return socket.gethostname()
+
+
+class HashRing(object):
+    def __init__(self, members, vnodes=64):
+        """ Consistent-hash ring
+
+        Arguments
+            members: Member ids
+            vnodes:  Points per member on the ring (more: more even split)
+        """
+        self.members = sorted(members)
+        points = sorted((key_hash('{0}#{1}'.format(m, i)), m)
+                        for m in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [m for _, m in points]
+
+    def owner(self, key):
+        """ Member owning a key (None on an empty ring) """
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, key_hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+class SQLiteMembership(object):
+    def __init__(self, db_path, ttl=60.0):
+        """ Membership in a SQLite table (one shared database file)
+
+        Arguments
+            db_path: Path of the membership database
+            ttl:     Seconds without heartbeat after which a member is gone
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+
+    def _connect(self):
+        cnx = sqlite3.connect(self.db_path, timeout=10)
+        cnx.execute("CREATE TABLE IF NOT EXISTS members (id TEXT PRIMARY KEY, heartbeat REAL)")
+        return cnx
+
+    def heartbeat(self, member_id):
+        """ Join, or confirm that a member is alive """
+        cnx = self._connect()
+        try:
+            with cnx:
+                cnx.execute("INSERT OR REPLACE INTO members (id, heartbeat) VALUES (?, ?)",
+                            (member_id, time.time()))
+        finally:
+            cnx.close()
+
+    def leave(self, member_id):
+        cnx = self._connect()
+        try:
+            with cnx:
+                cnx.execute("DELETE FROM members WHERE id = ?", (member_id,))
+        finally:
+            cnx.close()
+
+    def members(self):
+        """ Ids of the live members """
+        cnx = self._connect()
+        try:
+            rows = cnx.execute("SELECT id FROM members WHERE heartbeat >= ? ORDER BY id",
+                               (time.time() - self.ttl,)).fetchall()
+        finally:
+            cnx.close()
+        return [r[0] for r in rows]
+
+
+class FileMembership(object):
+    def __init__(self, dir_path, ttl=60.0):
+        """ Membership as one file per member in a shared directory (mtime = heartbeat)
+
+        Arguments
+            dir_path: Path of the membership directory
+            ttl:      Seconds without heartbeat after which a member is gone
+        """
+        self.dir_path = dir_path
+        self.ttl = ttl
+
+    def _path(self, member_id):
+        return os.path.join(self.dir_path, member_id + '.member')
+
+    def heartbeat(self, member_id):
+        """ Join, or confirm that a member is alive """
+        if not os.path.isdir(self.dir_path):
+            os.makedirs(self.dir_path)
+        with open(self._path(member_id), 'a'):
+            pass
+        os.utime(self._path(member_id), None)
+
+    def leave(self, member_id):
+        if os.path.isfile(self._path(member_id)):
+            os.remove(self._path(member_id))
+
+    def members(self):
+        """ Ids of the live members """
+        if not os.path.isdir(self.dir_path):
+            return []
+        now = time.time()
+        alive = []
+        for name in os.listdir(self.dir_path):
+            if not name.endswith('.member'):
+                continue
+            try:
+                if now - os.path.getmtime(os.path.join(self.dir_path, name)) <= self.ttl:
+                    alive.append(name[:-len('.member')])
+            except OSError:
+                # Removed by its member meanwhile
+                pass
+        return sorted(alive)
+
+
+def open_membership(path, ttl=60.0):
+    """ SQLite membership for a *.db / *.sqlite path, file membership for a directory """
+    if path.endswith('.db') or path.endswith('.sqlite'):
+        return SQLiteMembership(path, ttl)
+    return FileMembership(path, ttl)
+
+
+class ShardCoordinator(object):
+    def __init__(self, membership, member_id=None, vnodes=64, heartbeat_interval=None):
+        """ This crawler's share of the feeds
+
+        Arguments
+            membership:         Membership backend (SQLiteMembership / FileMembership)
+            member_id:          Id of this shard (default: <hostname>)
+            vnodes:             Points per member on the ring
+            heartbeat_interval: Seconds between heartbeats (default: a third of the TTL)
+        """
+        self.membership = membership
+        self.member_id = member_id or default_member_id()
+        self.vnodes = vnodes
+        self.heartbeat_interval = heartbeat_interval or membership.ttl / 3.0
+        self.ring = HashRing([self.member_id], vnodes)
+        self.last_heartbeat = 0.0
+
+    def partition_path(self, data_path):
+        """ Storage partition of this shard under a data directory """
+        return os.path.join(data_path, 'shards', self.member_id)
+
+    def refresh(self, now=None):
+        """ Heartbeat and reload the membership when due
+
+        Return
+            True if the ring changed (the feeds must be rebalanced)
+        """
+        now = time.time() if now is None else now
+        if now - self.last_heartbeat < self.heartbeat_interval:
+            return False
+        self.last_heartbeat = now
+        self.membership.heartbeat(self.member_id)
+        members = self.membership.members()
+        # Our own heartbeat may not be visible yet on a shared file system
+        if self.member_id not in members:
+            members.append(self.member_id)
+        if sorted(members) == self.ring.members:
+            return False
+        print("Shard {0}: members {1}".format(self.member_id, ', '.join(sorted(members))))
+        self.ring = HashRing(members, self.vnodes)
+        return True
+
+    def owns(self, url):
+        return self.ring.owner(shard_key(url)) == self.member_id
+
+    def assigned(self, urls):
+        """ The URLs of this shard """
+        return [u for u in urls if self.owns(u)]
+
+    def leave(self):
+        self.membership.leave(self.member_id)
+
+
+def merge_partitions(shards_path, out_path, storage='segment', xml=False, batch_size=1000):
+    """ Combine the storage partitions of every shard into one segment store
+
+    A feed that moved between shards was stored by each of them; its entries
+    are deduplicated on UID and title.
+
+    Arguments
+        shards_path: Directory of the partitions (<data>/shards)
+        out_path:    Output data directory
+        storage:     Storage the shards were run with: 'segment' or 'xml'
+        xml:         Also export the merged store as XML archives to <out_path>/xml
+        batch_size:  Entries appended per write
+
+    Return
+        Number of entries in the merged store
+    """
+    assert storage in ('xml', 'segment')
+    backend = XMLStorage if storage == 'xml' else SegmentStorage
+    partitions = [backend(os.path.join(shards_path, p))
+                  for p in sorted(os.listdir(shards_path))
+                  if os.path.isdir(os.path.join(shards_path, p))]
+
+    feeds = sorted(set(f for p in partitions for f in p.feeds()))
+    out = SegmentStorage(out_path)
+    total = 0
+    for source, category in feeds:
+        uids, titles = set(), set()
+        batch, num = [], 0
+        for partition in partitions:
+            for record in partition.iter_records(source, category):
+                uid, title = record.get('uid'), record.get('title')
+                if (uid and uid in uids) or (title and title in titles):
+                    continue
+                uids.add(uid)
+                titles.add(title)
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    out.append(source, category, batch)
+                    num += len(batch)
+                    batch = []
+        if batch:
+            out.append(source, category, batch)
+            num += len(batch)
+        print("Merged {0} entries of {1} ({2})".format(num, source, category))
+        total += num
+    out.seal_all()
+    if xml:
+        export_all(out, os.path.join(out_path, 'xml'))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded crawling tools")
+    sub = parser.add_subparsers(dest='command')
+    members = sub.add_parser('members', help="List the live shards")
+    members.add_argument('membership', help="Membership database (*.db) or directory")
+    members.add_argument('--ttl', type=float, default=60.0)
+    merge = sub.add_parser('merge', help="Merge the shard partitions")
+    merge.add_argument('shards_path', help="Directory of the partitions (<data>/shards)")
+    merge.add_argument('out_path', help="Output data directory")
+    merge.add_argument('--storage', choices=('segment', 'xml'), required=True,
+                       help="Storage the shards were run with")
+    merge.add_argument('--xml', action='store_true', help="Also export XML archives")
+    args = parser.parse_args()
+
+    if args.command == 'members':
+        for member in open_membership(args.membership, args.ttl).members():
+            print(member)
+    elif args.command == 'merge':
+        print("Merged {} entries".format(merge_partitions(args.shards_path, args.out_path,
+                                                          storage=args.storage, xml=args.xml)))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+"""
+Storage backends of crawled entries
+
+XMLStorage keeps the original one XML document per (source, category),
+parsed and rewritten whole on every update. SegmentStorage (the default of
+a new data directory, see open_storage) appends entries as newline-delimited
+JSON to size/time rotated segments, so an update only writes the new
+entries. Segments are sealed with an atomic rename, and export_xml()
+converts them back into the <data><entry>... layout expected by LOAD XML
+LOCAL INFILE (bulk_loader.py reads both).
+
+Usage
+    python storage.py export <segment data path> <XML output path>
+
+"""
+from __future__ import absolute_import, print_function
+import os
+import sys
+import json
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from fsutil import atomic_write
+
+
+# Fields of an <entry> element, in document order
+FIELDS = ('uid', 'title', 'link', 'summary', 'published_date')
+
+# Near-duplicate cluster id, written only for the entries that have one
+CLUSTER = 'cluster'
+
+# Closing tag of an entry in an XML archive, and read size of iter_from()
+ENTRY_END = b'</entry>'
+READ_SIZE = 1 << 16
+
+# Directories the crawler keeps next to the archives, not sources
+STATE_DIRS = frozenset(['responses', 'journal', 'search', 'shards'])
+
+
+class XMLStorage(object):
+    def __init__(self, root_path):
+        """ One XML document per (source, category), rewritten on update
+
+        Arguments
+            root_path: Path of XML data directory
+        """
+        self.root_path = root_path
+
+    def _path(self, source, category):
+        return os.path.join(self.root_path, source, category + '.xml')
+
+    def feeds(self):
+        """ List the stored (source, category) pairs """
+        pairs = []
+        for source in sorted(os.listdir(self.root_path)):
+            src_dir = os.path.join(self.root_path, source)
+            if os.path.isdir(src_dir) and source not in STATE_DIRS:
+                pairs.extend((source, f[:-4]) for f in sorted(os.listdir(src_dir))
+                             if f.endswith('.xml'))
+        return pairs
+
+    def exists(self, source, category):
+        return os.path.isfile(self._path(source, category))
+
+    def iter_records(self, source, category):
+        """ Stream the stored entries of a feed """
+        xml_path = self._path(source, category)
+        if not os.path.isfile(xml_path):
+            return
+        root = None
+        for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+            if root is None:
+                root = elem
+            elif event == 'end' and elem.tag == 'entry':
+                record = dict((f, elem.findtext(f)) for f in FIELDS)
+                cluster = elem.findtext(CLUSTER)
+                if cluster:
+                    record[CLUSTER] = int(cluster)
+                yield record
+                root.clear()
+
+    def iter_from(self, source, category, position=None):
+        """ Stream the entries stored after a position, each with the position after it
+
+        The position is the byte offset of the end of an </entry>: entries are only added
+        before </data>, and the entries already stored are written back byte for byte, so
+        a position stays valid while the archive grows.
+
+        Arguments
+            source:   Source name
+            category: Category name
+            position: Position yielded with an earlier entry (None: from the start)
+        """
+        xml_path = self._path(source, category)
+        if not os.path.isfile(xml_path):
+            return
+        offset = position or 0
+        with open(xml_path, 'rb') as xml_file:
+            if offset:
+                xml_file.seek(offset - len(ENTRY_END))
+                if xml_file.read(len(ENTRY_END)) != ENTRY_END:
+                    raise ValueError("{0} was rewritten, position {1} is stale"
+                                     .format(xml_path, offset))
+            buf = b''
+            for chunk in iter(lambda: xml_file.read(READ_SIZE), b''):
+                buf += chunk
+                # Text is escaped, so '</entry>' only ever closes an entry
+                end = buf.find(ENTRY_END)
+                while end >= 0:
+                    end += len(ENTRY_END)
+                    elem = ET.fromstring(buf[buf.find(b'<entry>'):end])
+                    record = dict((f, elem.findtext(f)) for f in FIELDS)
+                    cluster = elem.findtext(CLUSTER)
+                    if cluster:
+                        record[CLUSTER] = int(cluster)
+                    offset += end
+                    buf = buf[end:]
+                    yield record, offset
+                    end = buf.find(ENTRY_END)
+
+    def append(self, source, category, records):
+        """ Add entries to a feed
+
+        Arguments
+            source:   Source name
+            category: Category name
+            records:  List of entry dicts (or entry_normalizer.Entry) keyed by FIELDS
+                      (and CLUSTER for tagged near duplicates)
+        """
+        xml_path = self._path(source, category)
+        if os.path.isfile(xml_path):
+            tree = ET.ElementTree()
+            tree.parse(xml_path)
+            data = tree.getroot()
+        else:
+            data = ET.Element('data')
+            tree = ET.ElementTree(data)
+        for record in records:
+            entry = ET.SubElement(data, 'entry')
+            for field in FIELDS:
+                ET.SubElement(entry, field).text = record.get(field)
+            if record.get(CLUSTER) is not None:
+                ET.SubElement(entry, CLUSTER).text = str(record.get(CLUSTER))
+        with atomic_write(xml_path, 'wb') as f:
+            tree.write(f)
+
+    def close(self):
+        pass
+
+
+class SegmentStorage(object):
+    def __init__(self, root_path, max_bytes=16 * 1024 * 1024, max_age=24 * 3600):
+        """ Append-only newline-delimited JSON segments per (source, category)
+
+        Entries go to <root>/<source>/<category>/<n>.<created>.ndjson.open,
+        which is sealed into <n>.<created>.ndjson once it grows past
+        max_bytes or gets older than max_age seconds.
+
+        Arguments
+            root_path: Path of the segment data directory
+            max_bytes: Size after which the open segment is sealed
+            max_age:   Age (seconds) after which the open segment is sealed
+        """
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def _dir(self, source, category):
+        return os.path.join(self.root_path, source, category)
+
+    def _segments(self, seg_dir):
+        """ Sealed segment paths in order, and the open segment path (or None) """
+        sealed, active = [], None
+        if os.path.isdir(seg_dir):
+            for name in os.listdir(seg_dir):
+                if name.endswith('.ndjson'):
+                    sealed.append(name)
+                elif name.endswith('.ndjson.open'):
+                    active = os.path.join(seg_dir, name)
+        sealed.sort(key=lambda n: int(n.split('.')[0]))
+        return [os.path.join(seg_dir, n) for n in sealed], active
+
+    def feeds(self):
+        """ List the stored (source, category) pairs """
+        pairs = []
+        if not os.path.isdir(self.root_path):
+            return pairs
+        for source in sorted(os.listdir(self.root_path)):
+            src_dir = os.path.join(self.root_path, source)
+            if os.path.isdir(src_dir) and source not in STATE_DIRS:
+                pairs.extend((source, c) for c in sorted(os.listdir(src_dir))
+                             if os.path.isdir(os.path.join(src_dir, c)))
+        return pairs
+
+    def exists(self, source, category):
+        sealed, active = self._segments(self._dir(source, category))
+        return bool(sealed) or active is not None
+
+    def iter_records(self, source, category):
+        """ Stream the stored entries of a feed, oldest first """
+        for record, _ in self.iter_from(source, category):
+            yield record
+
+    def iter_from(self, source, category, position=None):
+        """ Stream the entries stored after a position, each with the position after it
+
+        The position is [segment number, byte offset in the segment]; sealing a segment
+        keeps its number and content, so a position stays valid.
+
+        Arguments
+            source:   Source name
+            category: Category name
+            position: Position yielded with an earlier entry (None: from the start)
+        """
+        number, offset = position or (0, 0)
+        sealed, active = self._segments(self._dir(source, category))
+        for path in sealed + ([active] if active else []):
+            n = int(os.path.basename(path).split('.')[0])
+            if n < number:
+                continue
+            pos = offset if n == number else 0
+            with open(path, 'rb') as f:
+                f.seek(pos)
+                for line in f:
+                    # A torn line at the end of the open segment is ignored
+                    if not line.endswith(b'\n'):
+                        break
+                    pos += len(line)
+                    yield json.loads(line.decode('utf-8')), [n, pos]
+
+    def append(self, source, category, records):
+        """ Add entries to a feed
+
+        Arguments
+            source:   Source name
+            category: Category name
+            records:  List of entry dicts (or entry_normalizer.Entry) keyed by FIELDS
+        """
+        seg_dir = self._dir(source, category)
+        if not os.path.isdir(seg_dir):
+            os.makedirs(seg_dir)
+        sealed, active = self._segments(seg_dir)
+        if active is None:
+            number = int(os.path.basename(sealed[-1]).split('.')[0]) + 1 if sealed else 0
+            active = os.path.join(seg_dir, '{:08d}.{:d}.ndjson.open'.format(number, int(time.time())))
+        else:
+            self._repair(active)
+
+        data = ''.join(json.dumps(dict(r), ensure_ascii=False) + '\n' for r in records)
+        with open(active, 'a', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if (os.path.getsize(active) >= self.max_bytes or
+                time.time() - int(os.path.basename(active).split('.')[1]) >= self.max_age):
+            self._seal(active)
+
+    @staticmethod
+    def _repair(path):
+        """ Drop a torn trailing line left by a crash in the middle of an append """
+        with open(path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if not size:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            data = f.read()
+            f.truncate(data.rfind(b'\n') + 1)
+
+    def _seal(self, path):
+        """ Atomically turn the open segment into a sealed one """
+        os.replace(path, path[:-len('.open')])
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def seal_all(self):
+        """ Seal every open segment (e.g. before an export) """
+        for source, category in self.feeds():
+            _, active = self._segments(self._dir(source, category))
+            if active:
+                self._repair(active)
+                self._seal(active)
+
+    def close(self):
+        pass
+
+
+STORAGES = {'xml': XMLStorage, 'segment': SegmentStorage}
+
+
+def open_storage(root_path, kind=None):
+    """ Storage backend of a data directory
+
+    Arguments
+        root_path: Path of the data directory
+        kind:      'segment' or 'xml' (None: 'xml' if the directory already holds XML
+                   archives, so that an existing archive keeps growing, else 'segment')
+    """
+    if kind is None:
+        kind = 'xml' if os.path.isdir(root_path) and XMLStorage(root_path).feeds() else 'segment'
+    if kind not in STORAGES:
+        raise ValueError("unknown storage {!r}".format(kind))
+    return STORAGES[kind](root_path)
+
+
+def export_xml(storage, source, category, xml_path):
+    """ Write the entries of a feed as a <data><entry>... XML document
+
+    Arguments
+        storage:  Storage backend
+        source:   Source name
+        category: Category name
+        xml_path: Output XML file path
+
+    Return
+        Number of entries written
+    """
+    num = 0
+    with atomic_write(xml_path, encoding='utf-8') as f:
+        f.write('<data>')
+        for record in storage.iter_records(source, category):
+            f.write('<entry>')
+            for field in FIELDS:
+                value = record.get(field)
+                if value is None:
+                    f.write('<{0} />'.format(field))
+                else:
+                    f.write('<{0}>{1}</{0}>'.format(field, escape(value)))
+            if record.get(CLUSTER) is not None:
+                f.write('<{0}>{1}</{0}>'.format(CLUSTER, record[CLUSTER]))
+            f.write('</entry>')
+            num += 1
+        f.write('</data>')
+    return num
+
+
+def export_all(storage, out_path):
+    """ Export every feed to <out_path>/<source>/<category>.xml """
+    for source, category in storage.feeds():
+        xml_path = os.path.join(out_path, source, category + '.xml')
+        num = export_xml(storage, source, category, xml_path)
+        print("Exported {0} entries of {1} ({2})".format(num, source, category))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'export':
+        print("Usage: python storage.py export <segment data path> <XML output path>")
+        sys.exit(1)
+    export_all(SegmentStorage(sys.argv[2]), sys.argv[3])
@@ -0,0 +1,71 @@
+"""
+HTML to text cleaner for feed summaries
+
+A streaming html.parser tokenizer that keeps the text nodes of a summary,
+giving the same text as BeautifulSoup(s, 'lxml').get_text() without
+building a DOM per entry.
+
+"""
+from __future__ import absolute_import, print_function
+import unicodedata
+from html.parser import HTMLParser
+
+
+# Elements whose content is not text
+SKIP_TAGS = frozenset(['script', 'style', 'template'])
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    """ Text content of an HTML fragment (markup removed, entities decoded) """
+    if not html:
+        return ''
+    # Plain text needs no tokenizing
+    if '<' not in html and '&' not in html:
+        return html
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return ''.join(parser.parts)
+
+
+def normalize_text(text, mode='ascii'):
+    """ Normalize the characters of a text
+
+    Arguments
+        text: Text to normalize
+        mode: 'ascii'    drop non-ASCII characters (the original crawler behaviour)
+              'translit' decompose accents first so that e.g. 'é' becomes 'e'
+              'NFC' / 'NFKC' / ... keep Unicode, in the given normalization form
+              None       leave the text unchanged
+    """
+    if mode is None or not text:
+        return text
+    if mode == 'ascii':
+        return text.encode('ascii', 'ignore').decode('utf-8')
+    if mode == 'translit':
+        return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('utf-8')
+    return unicodedata.normalize(mode, text)
+
+
+def clean_summary(html, mode='ascii'):
+    """ Remove HTML markup from a summary and normalize its characters """
+    return normalize_text(html_to_text(html), mode)